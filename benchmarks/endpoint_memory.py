@@ -0,0 +1,173 @@
+"""
+Memory benchmark: peak allocation of each endpoint
+
+Seeds each dataset size, then drives every route of service/routes.py
+through the Flask test client under tracemalloc, reporting the peak
+memory each request allocated above what was in use before it, its
+budget, and the lines that still hold the most of it afterwards. The
+listing result cache is turned off so that every listing runs its query;
+each endpoint is called once beforehand so that the per-worker indexes
+it builds on first use are not counted against the request.
+
+A request's budget is BUDGETS[name] = (bytes, bytes per seeded row).
+The run exits with status 1 when any request goes over its budget, so
+it can gate a change that makes an endpoint load more than it should.
+Compare the budgets with the 64Mi container limit in deploy/deployment.yaml,
+shared by the worker's baseline, its caches and its concurrent requests.
+
+Usage:
+  python -m benchmarks.endpoint_memory [row count ...]
+"""
+import gc
+import sys
+import time
+import tracemalloc
+from benchmarks import require_empty_table
+from benchmarks.record_memory import seed
+from service import app
+from service.models import Promotion, db
+from service.utils import name_search, result_cache, stats, suggest, vip_index
+from service.utils.memory_profile import request_peak
+
+DEFAULT_SIZES = (100, 1000, 10000)
+TOP_SITES = 3
+KIB = 1024
+
+# endpoint -> (budget in bytes, budget in bytes per seeded row)
+BUDGETS = {
+    "health": (64 * KIB, 0),
+    "metrics": (128 * KIB, 0),
+    "list": (1024 * KIB, 1536),
+    "list_fields": (512 * KIB, 1 * KIB),
+    "list_filtered": (512 * KIB, 1 * KIB),
+    "list_page": (1024 * KIB, 0),
+    "list_search": (512 * KIB, 256),
+    "count": (256 * KIB, 0),
+    "read": (256 * KIB, 0),
+    "lookup": (512 * KIB, 0),
+    "suggest": (128 * KIB, 0),
+    "vip": (256 * KIB, 0),
+    "stats": (256 * KIB, 0),
+    "create": (512 * KIB, 0),
+    "update": (512 * KIB, 0),
+    "patch": (512 * KIB, 0),
+    "cancel": (512 * KIB, 0),
+    "delete": (256 * KIB, 0),
+    "job_cancel": (512 * KIB, 0),
+    "job_export": (1024 * KIB, 0),
+}
+
+
+def promotion_body(name):
+    """Returns the JSON body of a promotion named name"""
+    return {"name": name, "type": "PERCENT_DISCOUNT", "discount": 10, "customer": None,
+            "start_date": "2022-07-01", "end_date": "2022-09-01"}
+
+
+def run_job(client, body):
+    """Submits a job and returns the response of its final state"""
+    response = client.post("/api/jobs", json=body)
+    location = response.headers.get("Location")
+    while response.status_code in (200, 202) and response.get_json()["state"] in ("queued", "running"):
+        time.sleep(0.01)
+        response = client.get(location)
+    return response
+
+
+def scenarios(ids):
+    """Returns (endpoint, request) pairs; each request takes the test client and a call number"""
+    read_id = ids[0]
+    vip_customer = 3  # seed() gives every fourth promotion, from the fourth, a VIP customer
+    writes = iter(ids[1:])
+    return [
+        ("health", lambda client, _: client.get("/health")),
+        ("metrics", lambda client, _: client.get("/metrics")),
+        ("list", lambda client, _: client.get("/api/promotions")),
+        ("list_fields", lambda client, _: client.get("/api/promotions?fields=id,name")),
+        ("list_filtered", lambda client, _: client.get("/api/promotions?type=PERCENT_DISCOUNT")),
+        ("list_page", lambda client, _: client.get("/api/promotions?sort=-end_date&limit=100")),
+        ("list_search", lambda client, _: client.get("/api/promotions?q=benchmark promotion 42")),
+        ("count", lambda client, _: client.head("/api/promotions")),
+        ("read", lambda client, _: client.get(f"/api/promotions/{read_id}")),
+        ("lookup", lambda client, _: client.post("/api/promotions/lookup", json={"ids": ids[:100]})),
+        ("suggest", lambda client, _: client.get("/api/promotions/suggest?prefix=bench")),
+        ("vip", lambda client, _: client.get(f"/api/promotions/vip/{vip_customer}")),
+        ("stats", lambda client, _: client.get("/api/promotions/stats")),
+        ("create", lambda client, call: client.post("/api/promotions",
+                                                    json=promotion_body(f"endpoint memory {call}"))),
+        ("update", lambda client, call: client.put(f"/api/promotions/{next(writes)}", headers={"If-Match": "*"},
+                                                   json=promotion_body(f"endpoint memory update {call}"))),
+        ("patch", lambda client, _: client.patch(f"/api/promotions/{next(writes)}", headers={"If-Match": "*"},
+                                                 json={"discount": 20})),
+        ("cancel", lambda client, _: client.put(f"/api/promotions/{next(writes)}/cancel",
+                                                headers={"If-Match": "*"})),
+        ("delete", lambda client, _: client.delete(f"/api/promotions/{next(writes)}")),
+        ("job_cancel", lambda client, _: run_job(client, {"kind": "cancel", "ids": [next(writes)]})),
+        ("job_export", lambda client, _: run_job(client, {"kind": "export"})),
+    ]
+
+
+def budget(endpoint, rows):
+    """Returns the bytes a request to endpoint may allocate with rows seeded"""
+    fixed, per_row = BUDGETS[endpoint]
+    return fixed + per_row * rows
+
+
+def measure(client, request, call):
+    """Returns (response, peak bytes, [(site, bytes still held)]) of one request"""
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    start = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    response = request(client, call)
+    peak = request_peak(start)
+    after = tracemalloc.take_snapshot()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    sites = [(f"{'/'.join(stat.traceback[0].filename.split('/')[-2:])}:{stat.traceback[0].lineno}",
+              stat.size_diff)
+             for stat in after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+             if stat.size_diff > 0][:TOP_SITES]
+    return response, peak, sites
+
+
+def reset(size):
+    """Replaces the promotions with `size` benchmark promotions; returns their ids"""
+    db.session.query(Promotion).delete()
+    db.session.commit()
+    seed(size)
+    for module in (name_search, stats, suggest, vip_index):
+        module.reset()
+    result_cache.invalidate()
+    return [promo_id for (promo_id,) in db.session.query(Promotion.id).order_by(Promotion.id)]
+
+
+def run(sizes):
+    """Runs every endpoint at each dataset size, prints a table and returns the requests over budget"""
+    require_empty_table()
+    app.config["RESULT_CACHE"] = False
+    client = app.test_client()
+    over = []
+    print(f"{'rows':>6} {'endpoint':<14} {'peak KiB':>9} {'budget':>7}  top sites still held (KiB)")
+    tracemalloc.start()
+    try:
+        for size in sizes:
+            ids = reset(size)
+            for endpoint, request in scenarios(ids):
+                request(client, 0)  # builds what the endpoint caches on first use
+                response, peak, sites = measure(client, request, 1)
+                limit = budget(endpoint, size)
+                flag = ""
+                if response.status_code >= 400 or peak > limit:
+                    flag = f" <- {response.status_code}" if response.status_code >= 400 else " <- over budget"
+                    over.append((size, endpoint))
+                held = ", ".join(f"{site} {size_diff / KIB:.1f}" for site, size_diff in sites)
+                print(f"{size:>6} {endpoint:<14} {peak / KIB:>9.0f} {limit / KIB:>7.0f}  {held}{flag}")
+    finally:
+        tracemalloc.stop()
+        db.session.query(Promotion).delete()
+        db.session.commit()
+    return over
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES) else 0)
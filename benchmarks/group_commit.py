@@ -0,0 +1,85 @@
+"""
+Group commit benchmark: create throughput with GROUP_COMMIT off and on
+
+Runs the same number of concurrent Promotion.create() calls with each
+commit on its own and with group commit, and reports creates per second
+and the number of transactions used: every commit on the engine, plus
+the write generation bump that follows each one while the result cache
+is on.
+
+A lone writer is slower with group commit, since every create waits
+out GROUP_COMMIT_WINDOW for company: on a local Postgres, 240 against
+538 creates/s. With concurrent writers the saved commits win: 1492
+against 693 creates/s with 8 writers and 3135 against 812 with 32, on
+100 and 114 transactions instead of 800 and 3200. The difference grows
+with the fsync cost of the database.
+
+Usage:
+  python -m benchmarks.group_commit [writer count ...]
+"""
+import sys
+import threading
+import time
+from datetime import date
+from sqlalchemy import event
+from benchmarks import require_empty_table
+from service import app
+from service.models import Promotion, PromoType, db
+
+DEFAULT_WRITERS = (1, 8, 32)
+CREATES_PER_WRITER = 50
+
+
+def writer(number):
+    """Creates CREATES_PER_WRITER promotions from one thread"""
+    with app.app_context():
+        for i in range(CREATES_PER_WRITER):
+            Promotion(name=f"benchmark {number}-{i}", type=PromoType.VIP, customer=number,
+                      start_date=date(2022, 7, 1), end_date=date(2022, 7, 31)).create()
+        db.session.remove()
+
+
+def measure(writers, group_commit):
+    """
+    Returns (creates per second, transactions) for one run, counting every
+    transaction committed on the engine and every write generation bump
+    """
+    app.config["GROUP_COMMIT"] = group_commit
+    commits = []
+
+    def count_commit(conn):  # pylint: disable=unused-argument
+        commits.append(1)  # list.append is thread-safe
+
+    generation = Promotion.write_generation()
+    threads = [threading.Thread(target=writer, args=(number,)) for number in range(writers)]
+    event.listen(db.engine, "commit", count_commit)
+    start = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+    finally:
+        event.remove(db.engine, "commit", count_commit)
+    creates = writers * CREATES_PER_WRITER
+    return creates / seconds, len(commits) + Promotion.write_generation() - generation
+
+
+def run(writer_counts):
+    """Runs the benchmark for each number of concurrent writers and prints a table"""
+    require_empty_table()
+    print(f"{'writers':>7} {'mode':<6} {'creates/s':>10} {'transactions':>13}")
+    for writers in writer_counts:
+        for group_commit in (False, True):
+            db.session.query(Promotion).delete()
+            db.session.commit()
+            rate, transactions = measure(writers, group_commit)
+            mode = "group" if group_commit else "single"
+            print(f"{writers:>7} {mode:<6} {rate:>10.0f} {transactions:>13}")
+    db.session.query(Promotion).delete()
+    db.session.commit()
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or DEFAULT_WRITERS)
@@ -0,0 +1,67 @@
+"""
+Payload benchmark: list response size and CPU per representation
+
+Encodes the same marshalled promotion listing as JSON, MessagePack and
+CSV, each raw, gzipped and brotli compressed, and reports the payload
+size and the encode (+ compress) time. No database access is needed.
+
+Usage:
+  python -m benchmarks.payload_formats [row count ...]
+"""
+import sys
+import timeit
+from datetime import date, timedelta
+from flask import json
+from flask_restx import marshal
+from service import app
+from service.models import PromotionRecord
+from service.routes import promotion_model
+from service.utils import compression
+from service.utils.representations import encode_csv, encode_msgpack
+
+DEFAULT_SIZES = (100, 1000, 10000)
+REPEAT = 5
+
+
+def listing(count):
+    """Returns a marshalled listing of `count` promotions"""
+    start = date(2022, 7, 1)
+    records = [
+        PromotionRecord(i, f"benchmark promotion {i}", i % 4,
+                        i % 100 if i % 4 == 1 else None, i if i % 4 == 3 else None,
+                        start + timedelta(days=i % 60), start + timedelta(days=60 + i % 60))
+        for i in range(count)
+    ]
+    return marshal([record.serialize() for record in records], promotion_model)
+
+
+def encoders():
+    """Yields (name, encode function) for every representation"""
+    formats = {
+        "json": lambda data: json.dumps(data).encode("utf-8"),
+        "msgpack": encode_msgpack,
+        "csv": lambda data: encode_csv(data).encode("utf-8"),
+    }
+    for name, encode in formats.items():
+        yield name, encode
+        yield f"{name}+gzip", lambda data, encode=encode: compression.compress(
+            encode(data), "gzip", app.config["COMPRESSION_GZIP_LEVEL"])
+        if compression.brotli is not None:
+            yield f"{name}+br", lambda data, encode=encode: compression.compress(
+                encode(data), "br", app.config["COMPRESSION_BROTLI_QUALITY"])
+
+
+def run(sizes):
+    """Runs the benchmark for each dataset size and prints a table"""
+    print(f"{'rows':>6} {'format':<13} {'bytes':>10} {'B/row':>7} {'ms':>8}")
+    with app.app_context():
+        for size in sizes:
+            data = listing(size)
+            for name, encode in encoders():
+                payload = encode(data)
+                seconds = min(timeit.repeat(lambda: encode(data), number=1, repeat=REPEAT))
+                print(f"{size:>6} {name:<13} {len(payload):>10} {len(payload) / size:>7.1f} {seconds * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,70 @@
+"""
+Memory benchmark: ORM Promotion vs PromotionRecord
+
+Loads the same rows as full Promotion instances and as PromotionRecords
+and reports the bytes held per promotion while the results are alive.
+
+Usage:
+  python -m benchmarks.record_memory [row count ...]
+"""
+import gc
+import sys
+import tracemalloc
+from datetime import date, timedelta
+from benchmarks import require_empty_table
+from service import app  # noqa: F401  (initializes the database)
+from service.models import Promotion, PromoType, db
+
+DEFAULT_SIZES = (1000, 10000)
+
+
+def seed(count):
+    """Inserts `count` benchmark promotions"""
+    start = date(2022, 7, 1)
+    db.session.bulk_insert_mappings(Promotion, [
+        {"name": f"benchmark promotion {i}",
+         "type": list(PromoType)[i % 4],
+         "discount": i % 100 if i % 4 == 1 else None,
+         "customer": i if i % 4 == 3 else None,
+         "start_date": start + timedelta(days=i % 60),
+         "end_date": start + timedelta(days=60 + i % 60)}
+        for i in range(count)
+    ])
+    db.session.commit()
+
+
+def measure(loader):
+    """Returns (bytes held, number of promotions) for the result of loader()"""
+    db.session.expunge_all()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    results = loader()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    held = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    count = len(results)
+    del results
+    db.session.expunge_all()
+    return held, count
+
+
+def run(sizes):
+    """Runs the benchmark for each dataset size and prints a table"""
+    require_empty_table()
+    print(f"{'rows':>8} {'orm B/promo':>12} {'record B/promo':>15} {'ratio':>6}")
+    for size in sizes:
+        db.session.query(Promotion).delete()
+        db.session.commit()
+        seed(size)
+        orm_bytes, orm_count = measure(Promotion.all)
+        record_bytes, record_count = measure(Promotion.all_records)
+        orm_per = orm_bytes / orm_count
+        record_per = record_bytes / record_count
+        print(f"{size:>8} {orm_per:>12.0f} {record_per:>15.0f} {orm_per / record_per:>5.1f}x")
+    db.session.query(Promotion).delete()
+    db.session.commit()
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
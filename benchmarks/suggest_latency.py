@@ -0,0 +1,53 @@
+"""
+Suggest benchmark: name typeahead latency and index memory
+
+Builds a PrefixIndex over generated promotion names and times random
+prefix lookups of one to four characters, reporting p50/p99 latency in
+microseconds and the approximate index size. No database access is
+needed; compare with the LIKE scans of ?name= in the listing.
+
+Usage:
+  python -m benchmarks.suggest_latency [name count ...]
+"""
+import random
+import sys
+import time
+from service.utils.prefix_index import PrefixIndex
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+LOOKUPS = 20000
+LIMIT = 10
+WORDS = ("summer", "spring", "winter", "autumn", "sale", "vip", "free", "shipping",
+         "bogo", "clearance", "weekend", "flash", "member", "holiday", "launch")
+
+
+def names(count, rng):
+    """Returns `count` promotion names made of random words"""
+    return [f"{' '.join(rng.sample(WORDS, 3))} {i}" for i in range(count)]
+
+
+def percentile(samples, fraction):
+    """Returns the sample at `fraction` of the sorted samples"""
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(sizes):
+    """Runs the benchmark for each index size and prints a table"""
+    rng = random.Random(42)
+    print(f"{'names':>7} {'MiB':>7} {'p50 us':>8} {'p99 us':>8}")
+    for size in sizes:
+        index = PrefixIndex(max_bytes=1 << 40)
+        index.build(enumerate(names(size, rng)))
+        prefixes = [rng.choice(WORDS)[:rng.randint(1, 4)] for _ in range(LOOKUPS)]
+        samples = []
+        for prefix in prefixes:
+            start = time.perf_counter_ns()
+            index.search(prefix, LIMIT)
+            samples.append(time.perf_counter_ns() - start)
+        samples.sort()
+        print(f"{size:>7} {index.size_bytes / 2 ** 20:>7.1f} "
+              f"{percentile(samples, 0.5) / 1000:>8.1f} {percentile(samples, 0.99) / 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
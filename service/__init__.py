@@ -46,7 +46,13 @@ api = Api(app,
 # Dependencies require we import the routes AFTER the Flask app is created
 # pylint: disable=wrong-import-position, wrong-import-order
 from service import routes, models        # noqa: F401, E402
-from service.utils import error_handlers, cli_commands  # noqa: F401, E402
+from service.utils import error_handlers, cli_commands, representations  # noqa: F401, E402
+from service.utils import admission, compression, db_routing, memory_profile, warm_up  # noqa: E402
+
+admission.init_admission(app, routes.route_class)
+compression.init_compression(app)
+db_routing.init_replica_routing(app, routes.READ_ONLY_ENDPOINTS)
+memory_profile.init_memory_profiling(app)
 
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
@@ -62,4 +68,6 @@ except Exception as error:  # pylint: disable=broad-except
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
 
+warm_up.init_warm_up(app)
+
 app.logger.info("Service initialized!")
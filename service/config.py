@@ -3,6 +3,7 @@ Global Configuration for Application
 """
 import os
 import json
+import tempfile
 import logging
 
 # Get configuration from environment
@@ -21,6 +22,111 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_POOL_SIZE = 2
 
+# Optional read replicas (comma separated URIs) that serve GET traffic.
+# Clients read from the primary for REPLICA_STICKINESS seconds after a write
+REPLICA_DATABASE_URIS = [uri for uri in os.getenv("REPLICA_DATABASE_URI", "").split(",") if uri]
+SQLALCHEMY_BINDS = {
+    f"replica_{index}": uri for index, uri in enumerate(REPLICA_DATABASE_URIS)
+}
+REPLICA_STICKINESS = int(os.getenv("REPLICA_STICKINESS", "5"))  # seconds
+
+# Admission control: concurrent requests and wait queue per route class.
+# Budgets only bite when a worker serves requests concurrently (gunicorn --threads)
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+ADMISSION_READS_LIMIT = int(os.getenv("ADMISSION_READS_LIMIT", "8"))
+ADMISSION_READS_QUEUE = int(os.getenv("ADMISSION_READS_QUEUE", "16"))
+ADMISSION_WRITES_LIMIT = int(os.getenv("ADMISSION_WRITES_LIMIT", "4"))
+ADMISSION_WRITES_QUEUE = int(os.getenv("ADMISSION_WRITES_QUEUE", "8"))
+ADMISSION_BULK_LIMIT = int(os.getenv("ADMISSION_BULK_LIMIT", "1"))
+ADMISSION_BULK_QUEUE = int(os.getenv("ADMISSION_BULK_QUEUE", "2"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2.0"))  # seconds
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))  # seconds
+
+# Response compression (brotli when installed, otherwise gzip)
+COMPRESSION = os.getenv("COMPRESSION", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))  # bytes
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+
+# Idempotency-Key handling for POST /api/promotions
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))  # seconds a response is replayed
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))  # rows kept in the table
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "5.0"))  # seconds a replay waits for the first
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "30"))  # seconds before takeover
+
+# Serve GET /api/promotions/stats from a per-worker summary that writes keep
+# current, rebuilt every STATS_SUMMARY_REFRESH seconds and at midnight
+STATS_SUMMARY = os.getenv("STATS_SUMMARY", "false").lower() == "true"
+STATS_SUMMARY_REFRESH = float(os.getenv("STATS_SUMMARY_REFRESH", "300"))  # seconds between rebuilds
+
+# Background jobs (POST /api/jobs): threads per worker, jobs waiting for one,
+# items per transaction, and how long finished jobs are kept
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))  # keep below SQLALCHEMY_POOL_SIZE
+JOB_QUEUE = int(os.getenv("JOB_QUEUE", "8"))
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", "100"))
+JOB_TTL = int(os.getenv("JOB_TTL", "86400"))  # seconds
+JOB_ABANDONED_AFTER = int(os.getenv("JOB_ABANDONED_AFTER", "600"))  # seconds without progress
+
+# Most ids in one POST /api/promotions/lookup
+LOOKUP_MAX_IDS = int(os.getenv("LOOKUP_MAX_IDS", "100"))
+
+# Per-worker name prefix index behind GET /api/promotions/suggest
+SUGGEST_INDEX_MAX_BYTES = int(os.getenv("SUGGEST_INDEX_MAX_BYTES", str(8 * 1024 * 1024)))  # 0 disables
+SUGGEST_INDEX_REFRESH = float(os.getenv("SUGGEST_INDEX_REFRESH", "60"))  # seconds between rebuilds
+
+# Fuzzy name search (?q=) for the listing
+SEARCH_SIMILARITY_THRESHOLD = float(os.getenv("SEARCH_SIMILARITY_THRESHOLD", "0.3"))  # 0 to 1
+SEARCH_INDEX_REFRESH = float(os.getenv("SEARCH_INDEX_REFRESH", "60"))  # seconds between rebuilds
+
+# Per-worker index of the customers with VIP promotions
+VIP_INDEX_CAPACITY = int(os.getenv("VIP_INDEX_CAPACITY", "100000"))  # VIP customers to size the Bloom filter for
+VIP_INDEX_ERROR_RATE = float(os.getenv("VIP_INDEX_ERROR_RATE", "0.01"))  # target false positive rate
+VIP_INDEX_REFRESH = float(os.getenv("VIP_INDEX_REFRESH", "60"))  # seconds between rebuilds
+VIP_INDEX_SYNC = float(os.getenv("VIP_INDEX_SYNC", "1"))  # seconds between write generation checks; 0 is off
+
+# Group commit: coalesce concurrent creates into one transaction and INSERT
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "false").lower() == "true"
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW", "0.002"))  # seconds a batch stays open
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "100"))  # creates per transaction
+
+# Per-worker cache of listing responses, invalidated by writes
+RESULT_CACHE = os.getenv("RESULT_CACHE", "true").lower() == "true"
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+RESULT_CACHE_MAX_AGE = float(os.getenv("RESULT_CACHE_MAX_AGE", "5"))  # bounds staleness if a generation bump fails
+RESULT_CACHE_GENERATION_TTL = float(os.getenv("RESULT_CACHE_GENERATION_TTL", "0.5"))  # seconds between reads
+
+# Record cache shared by the workers of a host through a memory-mapped file
+SHARED_CACHE = os.getenv("SHARED_CACHE", "false").lower() == "true"
+SHARED_CACHE_PATH = os.getenv(
+    "SHARED_CACHE_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "promotions-cache"),
+)
+SHARED_CACHE_SLOTS = int(os.getenv("SHARED_CACHE_SLOTS", "16384"))  # 112 bytes each
+SHARED_CACHE_MAX_AGE = float(os.getenv("SHARED_CACHE_MAX_AGE", "30"))  # bounds staleness across hosts
+
+# Concurrent identical reads in a worker wait on one database fetch
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() == "true"
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "5"))  # seconds a waiting read gives the fetch
+
+# Stale-while-revalidate: keep answering reads from their last good responses
+# when the database is slow or down
+STALE_WHILE_REVALIDATE = os.getenv("STALE_WHILE_REVALIDATE", "false").lower() == "true"
+STALE_SOFT_TTL = float(os.getenv("STALE_SOFT_TTL", "5"))  # seconds before a response is refreshed
+STALE_MAX_AGE = float(os.getenv("STALE_MAX_AGE", "300"))  # seconds a response may be served stale
+STALE_CACHE_MAX_BYTES = int(os.getenv("STALE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+STALE_REFRESH_WORKERS = int(os.getenv("STALE_REFRESH_WORKERS", "2"))  # background refresh threads
+STALE_REFRESH_TRIES = int(os.getenv("STALE_REFRESH_TRIES", "3"))  # attempts to reach the database
+STALE_REFRESH_DELAY = float(os.getenv("STALE_REFRESH_DELAY", "0.5"))  # seconds before the first retry, doubling
+
+# Warm-up of the read caches and indexes before a worker reports ready on /health:
+# "preload" (at import, before the fork with gunicorn --preload), "background"
+# (in a thread of each worker) or empty for none
+WARM_UP = os.getenv("WARM_UP", "").lower()
+
+# Per-request peak memory (tracemalloc) in the metrics and logs; slows requests down
+MEMORY_PROFILE = os.getenv("MEMORY_PROFILE", "false").lower() == "true"
+MEMORY_PROFILE_BUDGET = int(os.getenv("MEMORY_PROFILE_BUDGET", str(4 * 1024 * 1024)))  # bytes a request may allocate
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
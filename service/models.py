@@ -3,15 +3,29 @@ Models for Promotion
 
 All of the models are stored in this module
 """
+import json
 import logging
-from datetime import date
+import threading
+from collections import namedtuple
+from datetime import date, timedelta
 from enum import Enum
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, and_, case, event, func, or_, select, text, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import Pool
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from service.utils.db_routing import RoutingSQLAlchemy, read_bind
+from service.utils.group_commit import GroupCommitter
+from service.utils.shared_cache import SharedRecordCache
+from service.utils.single_flight import SingleFlight
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# (routes the reads of GET requests to read replicas when configured)
+db = RoutingSQLAlchemy()
 
 
 class DataValidationError(Exception):
@@ -20,8 +34,45 @@ class DataValidationError(Exception):
     pass
 
 
+class VersionMismatchError(Exception):
+    """ Used when a write expects a version of a Promotion that is no longer current """
+
+    pass
+
+
+def check_date_order(start_date, end_date):
+    """ Raises DataValidationError unless a Promotion ends on or after its start date """
+    if end_date < start_date:
+        raise DataValidationError("Invalid Promotion: end_date is before start_date")
+
+
 VALID_TYPES = ["BUY_ONE_GET_ONE", "PERCENT_DISCOUNT", "FREE_SHIPPING", "VIP"]
 
+
+def convert_changes(changes):
+    """
+    Converts the client supplied values in changes to column values in place,
+    raising TypeError or ValueError for a bad one
+    """
+    if "type" in changes:
+        if changes["type"] not in VALID_TYPES:
+            raise ValueError
+        changes["type"] = getattr(PromoType, changes["type"])
+    for key in ("discount", "customer"):
+        if changes.get(key) == "":
+            changes[key] = None
+    for key in ("start_date", "end_date"):
+        if key in changes:
+            changes[key] = date.fromisoformat(changes[key])
+
+
+# planner estimates below this many rows are replaced by an exact count
+ESTIMATE_EXACT_BELOW = 1000
+
+# the client supplied fields of a Promotion
+DESERIALIZED_FIELDS = ("name", "type", "discount", "customer", "start_date", "end_date")
+
+
 class PromoType(Enum):
     """Enumeration of valid Promotion types"""
 
@@ -33,6 +84,125 @@ class PromoType(Enum):
     UNKNOWN = 9
 
 
+######################################################################
+#  C O M P A C T   R E A D   M O D E L
+######################################################################
+
+# columns that make up a PromotionRecord, in tuple order
+RECORD_FIELDS = ("id", "name", "type", "discount", "customer", "start_date", "end_date", "version")
+
+# the fields a listing can be sorted on; each has a (field, id) index, so
+# that sorted pages are read in index order rather than sorted in memory
+SORT_FIELDS = ("id", "name", "start_date", "end_date", "discount")
+
+# width of the discount histogram buckets of Promotion.statistics()
+DISCOUNT_BUCKET_WIDTH = 10
+
+
+class PromotionRecord(namedtuple("PromotionRecord", RECORD_FIELDS, defaults=(None,))):
+    """
+    Immutable, ORM-free view of a Promotion row
+
+    Used for read-only caches and bulk listings where a full Promotion
+    instance (identity map entry plus instrumentation state) is too heavy.
+    The type is held as the small int value of its PromoType.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds a record from a column query row (or any object with the same attributes)
+
+        Columns missing from a projected row are left as None
+        """
+        promo_type = getattr(row, "type", None)
+        if isinstance(promo_type, PromoType):
+            promo_type = promo_type.value
+        return cls(*[getattr(row, field, None) for field in RECORD_FIELDS[:2]], promo_type,
+                   *[getattr(row, field, None) for field in RECORD_FIELDS[3:]])
+
+    @property
+    def promo_type(self):
+        """ The PromoType enum member for this record """
+        return PromoType(self.type)
+
+    def serialize(self):
+        """ Serializes a PromotionRecord into the same dictionary as Promotion.serialize() """
+        return {"id": self.id,
+                "name": self.name,
+                "type": PromoType(self.type).name if self.type is not None else None,
+                "discount": self.discount,
+                "customer": self.customer,
+                "start_date": self.start_date.isoformat() if self.start_date else None,
+                "end_date": self.end_date.isoformat() if self.end_date else None,
+                "version": self.version}
+
+
+######################################################################
+#  W R I T E   N O T I F I C A T I O N S
+######################################################################
+
+# listeners called as listener(promo_id, record) after each committed write;
+# record is the new PromotionRecord, or None when the Promotion was deleted
+_write_listeners = []
+
+# bumped by every committed write, so that a read started after a write
+# never shares the fetch of a read started before it
+_write_count = 0
+_write_count_lock = threading.Lock()
+
+
+def on_write(listener):
+    """ Registers a write listener (usable as a decorator) """
+    _write_listeners.append(listener)
+    return listener
+
+
+# predicates of the app config telling whether something reads the write generation
+_write_generation_readers = []
+
+
+def reads_write_generation(predicate):
+    """
+    Registers a predicate of the app config that tells whether its module
+    reads the write generation (usable as a decorator); the generation is
+    only bumped while one of them is true
+    """
+    _write_generation_readers.append(predicate)
+    return predicate
+
+
+def notify_write(promo_id, record):
+    """ Tells every write listener about a committed write """
+    global _write_count  # pylint: disable=global-statement
+    with _write_count_lock:
+        _write_count += 1
+    for listener in _write_listeners:
+        try:
+            listener(promo_id, record)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Write listener %r failed", listener)
+
+
+# batches the creates of this worker when GROUP_COMMIT is on
+_group_committer = None
+_group_committer_lock = threading.Lock()
+
+# records shared with the other workers on this host when SHARED_CACHE is on
+_shared_records = None
+_shared_records_lock = threading.Lock()
+
+# coalesces the concurrent identical record lookups of this worker when SINGLE_FLIGHT is on
+_record_flights = SingleFlight("record")
+
+# bumped once after each committed transaction that wrote promotions, in any worker or
+# pod, so that caches of query results can tell whether anything changed since they
+# stored a result (see _flag_promotion_write below)
+write_generation_sequence = db.Sequence("promotion_write_generation", metadata=db.Model.metadata)
+
+
 class Promotion(db.Model):
     """
     Class that represents a Promotion
@@ -53,6 +223,18 @@ class Promotion(db.Model):
     start_date = db.Column(db.Date(), nullable=False)
     # date after which promotion is no longer effective
     end_date = db.Column(db.Date(), nullable=False)
+    # bumped by every write; a write can require the version it read (optimistic concurrency)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+    # (field, id) indexes for the SORT_FIELDS: the id breaks ties, so that a
+    # keyset (field, id) continues a sorted listing with an index range scan
+    __table_args__ = (
+        db.Index("ix_promotion_name_id", "name", "id"),
+        db.Index("ix_promotion_start_date_id", "start_date", "id"),
+        db.Index("ix_promotion_end_date_id", "end_date", "id"),
+        db.Index("ix_promotion_discount_id", "discount", "id"),
+    )
 
     def __repr__(self):
         return "<Promotion %r id=[%s]>" % (self.name, self.id)
@@ -63,8 +245,90 @@ class Promotion(db.Model):
         """
         logger.info("Creating %s", self.name)
         self.id = None  # id must be none to generate next primary key
+        if self.app is not None and self.app.config.get("GROUP_COMMIT"):
+            # coalesced with concurrent creates into one INSERT; the Promotion stays transient
+            self.id = Promotion.group_committer().submit(self.insert_values())
+            self.version = 1  # the server default
+            record = PromotionRecord.from_row(self)
+            notify_write(record.id, record)
+            return
         db.session.add(self)
+        db.session.flush()  # assigns the id
+        record = PromotionRecord.from_row(self)
         db.session.commit()
+        notify_write(record.id, record)
+
+    def insert_values(self) -> dict:
+        """ Returns the column values of a new Promotion for a Core INSERT """
+        return {"name": self.name,
+                "type": self.type if self.type is not None else PromoType.UNKNOWN,
+                "discount": self.discount,
+                "customer": self.customer,
+                "start_date": self.start_date,
+                "end_date": self.end_date}
+
+    @classmethod
+    def create_many(cls, promotions) -> list:
+        """ Creates Promotions in one transaction and INSERT; returns their ids in order """
+        ids = cls.insert_many([promo.insert_values() for promo in promotions])
+        for promo, promo_id in zip(promotions, ids):
+            promo.id, promo.version = promo_id, 1  # the server default
+            notify_write(promo_id, PromotionRecord.from_row(promo))
+        return ids
+
+    @classmethod
+    def insert_many(cls, rows) -> list:
+        """ Inserts rows of column values in one transaction and returns their ids in order """
+        logger.info("Inserting %d promotions in one transaction", len(rows))
+        table = cls.__table__
+        with db.engine.begin() as conn:
+            return [row.id for row in conn.execute(table.insert().values(rows).returning(table.c.id))]
+
+    @classmethod
+    def group_committer(cls) -> GroupCommitter:
+        """ Returns this worker's group committer for create(), made on first use """
+        global _group_committer  # pylint: disable=global-statement
+        with _group_committer_lock:
+            if _group_committer is None:
+                _group_committer = GroupCommitter(cls.insert_many,
+                                                  cls.app.config["GROUP_COMMIT_WINDOW"],
+                                                  cls.app.config["GROUP_COMMIT_MAX_BATCH"])
+        return _group_committer
+
+    @classmethod
+    def shared_records(cls):
+        """ Returns the record cache shared by the workers on this host, None if SHARED_CACHE is off """
+        global _shared_records  # pylint: disable=global-statement
+        if cls.app is None or not cls.app.config.get("SHARED_CACHE"):
+            return None
+        with _shared_records_lock:
+            if _shared_records is None:
+                _shared_records = SharedRecordCache(cls.app.config["SHARED_CACHE_PATH"],
+                                                    cls.app.config["SHARED_CACHE_SLOTS"])
+        return _shared_records
+
+    @classmethod
+    def write_generation(cls) -> int:
+        """ Returns the database-wide write generation, read from the primary """
+        with db.engine.connect() as conn:
+            row = conn.execute(text(
+                f"SELECT last_value, is_called FROM {write_generation_sequence.name}")).one()
+        return row.last_value if row.is_called else 0
+
+    @classmethod
+    def next_write_generation(cls) -> int:
+        """ Bumps the database-wide write generation and returns it """
+        with db.engine.begin() as conn:
+            return conn.execute(select(write_generation_sequence.next_value())).scalar()
+
+    @classmethod
+    def close_shared_records(cls):
+        """ Unmaps the shared record cache; the next use maps it again (e.g. in a forked worker) """
+        global _shared_records  # pylint: disable=global-statement
+        with _shared_records_lock:
+            if _shared_records is not None:
+                _shared_records.close()
+                _shared_records = None
 
     def update(self):
         """
@@ -73,13 +337,18 @@ class Promotion(db.Model):
         logger.info("Saving %s", self.name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
+        db.session.flush()
+        record = PromotionRecord.from_row(self)
         db.session.commit()
+        notify_write(record.id, record)
 
     def delete(self):
         """ Removes a Promotion from the data store """
         logger.info("Deleting %s", self.name)
+        promo_id = self.id
         db.session.delete(self)
         db.session.commit()
+        notify_write(promo_id, None)
 
     def serialize(self):
         """ Serializes a Promotion into a dictionary """
@@ -90,7 +359,8 @@ class Promotion(db.Model):
                           "discount": self.discount,
                           "customer": self.customer,
                           "start_date": self.start_date.isoformat(),
-                          "end_date": self.end_date.isoformat()}
+                          "end_date": self.end_date.isoformat(),
+                          "version": self.version}
         except:
             logger.warn("Unable to serialize Promotion data")
             serialized = {}
@@ -116,6 +386,7 @@ class Promotion(db.Model):
             self.customer = data["customer"]
             self.start_date = date.fromisoformat(data["start_date"])
             self.end_date = date.fromisoformat(data["end_date"])
+            check_date_order(self.start_date, self.end_date)
         except KeyError as error:
             raise DataValidationError(
                 "Invalid Promotion: missing " + error.args[0]
@@ -126,6 +397,64 @@ class Promotion(db.Model):
             )
         return self
 
+    @classmethod
+    def deserialize_new(cls, data):
+        """
+        Deserializes a new Promotion as it is created: an empty discount or
+        customer is null
+
+        Args:
+            data (dict): A dictionary containing the resource data
+        """
+        promo = cls().deserialize(data)
+        for field in ("discount", "customer"):
+            if getattr(promo, field) == "":
+                setattr(promo, field, None)
+        return promo
+
+    @classmethod
+    def find_duplicates(cls, promotions) -> set:
+        """
+        Returns the (name, type) pairs of the given Promotions that a stored
+        Promotion already has, in one query: Promotions are duplicates if
+        they have the same name and type
+        """
+        pairs = {(promo.name, promo.type) for promo in promotions}
+        if not pairs:
+            return set()
+        rows = db.session.query(cls.name, cls.type).filter(tuple_(cls.name, cls.type).in_(pairs)).distinct()
+        return {(row.name, row.type) for row in rows}
+
+    @staticmethod
+    def deserialize_changes(data, partial=False) -> dict:
+        """
+        Deserializes a dictionary into the column values of a Promotion
+
+        Args:
+            data (dict): A dictionary containing the resource data
+            partial (bool): only the keys present in data are required
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError(
+                "Invalid Promotion: body of request contained bad or no data"
+            )
+        changes = {}
+        for key in DESERIALIZED_FIELDS:
+            if key not in data:
+                if partial:
+                    continue
+                raise DataValidationError("Invalid Promotion: missing " + key)
+            changes[key] = data[key]
+        try:
+            convert_changes(changes)
+        except (TypeError, ValueError):
+            raise DataValidationError(
+                "Invalid Promotion: body of request contained bad or no data"
+            )
+        if "start_date" in changes and "end_date" in changes:
+            check_date_order(changes["start_date"], changes["end_date"])
+        return changes
+
     @classmethod
     def init_db(cls, app):
         """ Initializes the database session """
@@ -135,6 +464,8 @@ class Promotion(db.Model):
         db.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
+        with db.engine.begin() as connection:
+            upgrade_schema(connection)  # and bring tables made by older releases up to date
 
     @classmethod
     def all(cls):
@@ -148,6 +479,267 @@ class Promotion(db.Model):
         logger.info("Processing lookup for id %s ...", by_id)
         return cls.query.get(by_id)
 
+    @classmethod
+    def update_by_id(cls, by_id, changes: dict, versions=None):
+        """
+        Updates a Promotion in a single UPDATE ... RETURNING statement
+
+        Args:
+            by_id (int): the ID of the Promotion to update
+            changes (dict): the column values to set
+            versions (list): only update if the current version is one of these
+                (None updates any version)
+
+        Returns the updated PromotionRecord, or None if no Promotion has the ID
+
+        Raises:
+            VersionMismatchError: the Promotion exists at another version
+        """
+        logger.info("Updating id %s with %s", by_id, list(changes))
+        if not changes:
+            record = cls.find_record(by_id)
+            if record and versions is not None and record.version not in versions:
+                raise VersionMismatchError(f"Promotion {by_id} is at version {record.version}")
+            return record
+        table = cls.__table__
+        condition = table.c.id == by_id
+        if versions is not None:
+            condition = and_(condition, table.c.version.in_(versions))
+        dated = ("start_date" in changes) != ("end_date" in changes)
+        if dated:
+            # a change of one date must keep it in order with the other
+            condition = and_(condition, changes.get("start_date", table.c.start_date)
+                             <= changes.get("end_date", table.c.end_date))
+        statement = (
+            table.update()
+            .where(condition)
+            .values(**changes, version=table.c.version + 1)
+            .returning(*[table.c[field] for field in RECORD_FIELDS])
+        )
+        row = db.session.execute(statement).first()
+        db.session.commit()
+        if not row:
+            # only a failed write pays for telling a stale version or reversed dates from a missing row
+            record = cls.find_record(by_id, ["id"]) if versions is not None or dated else None
+            if record and versions is not None and (not dated or record.version not in versions):
+                raise VersionMismatchError(f"Promotion {by_id} is not at version {versions}")
+            if record:
+                raise DataValidationError("Invalid Promotion: end_date is before start_date")
+            return None
+        record = PromotionRecord.from_row(row)
+        notify_write(record.id, record)
+        return record
+
+    @classmethod
+    def cancel(cls, by_id, versions=None):
+        """
+        Cancels a Promotion early by setting its end_date to its start_date
+
+        Runs as a single UPDATE ... RETURNING statement without loading the row.
+        Returns the cancelled PromotionRecord, or None if no Promotion has the ID;
+        raises VersionMismatchError if versions does not hold its current version
+        """
+        logger.info("Cancelling id %s", by_id)
+        return cls.update_by_id(by_id, {"end_date": cls.__table__.c.start_date}, versions)
+
+    @classmethod
+    def cancel_many(cls, ids) -> list:
+        """
+        Cancels Promotions early, whatever their version, in a single
+        UPDATE ... WHERE id IN (...) RETURNING statement and commit
+
+        Returns the cancelled PromotionRecords; ids without a Promotion are skipped
+        """
+        logger.info("Cancelling %d ids", len(ids))
+        table = cls.__table__
+        statement = (
+            table.update()
+            .where(table.c.id.in_(ids))
+            .values(end_date=table.c.start_date, version=table.c.version + 1)
+            .returning(*[table.c[field] for field in RECORD_FIELDS])
+        )
+        records = [PromotionRecord.from_row(row) for row in db.session.execute(statement)]
+        db.session.commit()
+        for record in records:
+            notify_write(record.id, record)
+        return records
+
+    @classmethod
+    def delete_by_id(cls, by_id) -> bool:
+        """
+        Removes a Promotion from the data store in a single DELETE statement
+
+        Returns True if a Promotion with the ID was deleted
+        """
+        logger.info("Deleting id %s", by_id)
+        table = cls.__table__
+        result = db.session.execute(table.delete().where(table.c.id == by_id))
+        db.session.commit()
+        if result.rowcount == 0:
+            return False
+        notify_write(by_id, None)
+        return True
+
+    @classmethod
+    def record_query(cls, fields=None):
+        """
+        Returns a column query that loads PromotionRecords without the ORM
+
+        Args:
+            fields (list): only select these columns (the id and version are always selected)
+        """
+        if fields:
+            fields = [field for field in RECORD_FIELDS if field in ("id", "version") or field in fields]
+        else:
+            fields = RECORD_FIELDS
+        return db.session.query(*[getattr(cls, field) for field in fields])
+
+    @classmethod
+    def all_records(cls, fields=None) -> list:
+        """ Returns all of the Promotions in the database as PromotionRecords """
+        logger.info("Processing all Promotion records")
+        return [PromotionRecord.from_row(row) for row in cls.record_query(fields)]
+
+    @classmethod
+    def find_record(cls, by_id, fields=None):
+        """
+        Finds a Promotion by its ID and returns it as a PromotionRecord
+
+        Served from the shared record cache when SHARED_CACHE is on; a
+        cached record has every field, whatever fields were asked for.
+        With SINGLE_FLIGHT on, concurrent lookups of the same record share
+        one fetch
+        """
+        logger.info("Processing record lookup for id %s ...", by_id)
+        cache = cls.shared_records()
+        if cache is not None:
+            cached = cache.get(by_id, cls.app.config["SHARED_CACHE_MAX_AGE"])
+            if cached is not None:
+                return PromotionRecord(*cached)
+        if read_bind() is not None:
+            cache = None  # a lagging replica's row stays out of the cache
+        if not cls.app.config.get("SINGLE_FLIGHT"):
+            return cls.fetch_record(by_id, fields, cache)
+        # a read-your-writes read from the primary never joins a lagging replica's fetch
+        return _record_flights.do((by_id, tuple(fields or ()), read_bind(), _write_count),
+                                  lambda: cls.fetch_record(by_id, fields, cache),
+                                  cls.app.config["SINGLE_FLIGHT_TIMEOUT"])
+
+    @classmethod
+    def find_records(cls, ids) -> dict:
+        """
+        Finds the Promotions with the given IDs and returns their PromotionRecords by ID
+
+        IDs that are served by the shared record cache (when SHARED_CACHE is
+        on) are not queried; the rest are loaded with a single IN query.
+        IDs without a Promotion are left out
+        """
+        logger.info("Processing record lookup for %d ids ...", len(ids))
+        records = {}
+        missing = set(ids)
+        cache = cls.shared_records()
+        store = cache if read_bind() is None else None  # a lagging replica's rows stay out of the cache
+        if cache is not None:
+            max_age = cls.app.config["SHARED_CACHE_MAX_AGE"]
+            for by_id in ids:
+                cached = cache.get(by_id, max_age)
+                if cached is not None:
+                    records[by_id] = PromotionRecord(*cached)
+                    missing.discard(by_id)
+            generation = cache.generation()  # a write after this keeps our reads out of the cache
+        if missing:
+            for row in cls.record_query().filter(cls.id.in_(missing)):
+                record = PromotionRecord.from_row(row)
+                records[record.id] = record
+                if store is not None:
+                    store.put(record, generation)
+        return records
+
+    @classmethod
+    def fetch_record(cls, by_id, fields=None, cache=None):
+        """ Loads a PromotionRecord from the database, storing it in the shared cache if given """
+        if cache is not None:
+            generation = cache.generation()  # a write after this keeps our read out of the cache
+        row = cls.record_query(fields).filter(cls.id == by_id).first()
+        if not row:
+            return None
+        record = PromotionRecord.from_row(row)
+        if cache is not None and not fields:
+            cache.put(record, generation)
+        return record
+
+    @classmethod
+    def find_matching_any(cls, queries, fields=None, sort="id", descending=False,
+                          after=None, limit=None) -> list:
+        """Returns the Promotions matched by any of the given finder queries
+
+        The criteria of the queries (e.g. from find_by_type, find_by_name)
+        are OR-ed together into a single SELECT, so each Promotion is
+        returned once. Results are sorted by the sort field, then by id;
+        NULLs come last in ascending order and first in descending order.
+
+        :param queries: the finder queries to combine
+        :type of queries: list
+        :param fields: only select these columns (the id and sort field are always selected)
+        :type of fields: list
+        :param sort: one of SORT_FIELDS
+        :type of sort: str
+        :param descending: sort in descending order
+        :type of descending: bool
+        :param after: the (sort field value, id) of the last Promotion of the
+            previous page; only Promotions sorted after it are returned
+        :type of after: tuple
+        :param limit: the most Promotions to return
+        :type of limit: int
+
+        :return: a collection of PromotionRecords
+        :rtype: list
+
+        """
+        logger.info("Processing query matching any of %d filters ...", len(queries))
+        if fields and sort not in fields:
+            fields = [*fields, sort]
+        column = getattr(cls, sort)
+        if sort == "id":
+            order = [cls.id.desc() if descending else cls.id]
+        else:
+            order = [column.desc(), cls.id.desc()] if descending else [column, cls.id]
+        records = []
+        for condition in cls._keyset_ranges(sort, descending, after):
+            query = cls.record_query(fields)
+            if queries:
+                query = query.filter(or_(*[finder.whereclause for finder in queries]))
+            if condition is not None:
+                query = query.filter(condition)
+            query = query.order_by(*order)
+            if limit is not None:
+                query = query.limit(limit - len(records))
+            records.extend(PromotionRecord.from_row(row) for row in query)
+            if limit is not None and len(records) >= limit:
+                break
+        return records
+
+    @classmethod
+    def _keyset_ranges(cls, sort, descending, after) -> list:
+        """
+        Returns the conditions, in sort order, that select the Promotions
+        sorted after a keyset; each one is a range of the (field, id) index
+        (a row comparison never matches NULLs, so they get their own range)
+        """
+        if after is None:
+            return [None]
+        value, last_id = after
+        if sort == "id":
+            return [cls.id < last_id if descending else cls.id > last_id]
+        column = getattr(cls, sort)
+        if descending:
+            if value is None:
+                return [and_(column.is_(None), cls.id < last_id), column.isnot(None)]
+            return [tuple_(column, cls.id) < tuple_(value, last_id)]
+        if value is None:
+            return [and_(column.is_(None), cls.id > last_id)]
+        return [tuple_(column, cls.id) > tuple_(value, last_id), column.is_(None)]
+
     @classmethod
     def find_by_name(cls, name: str) -> list:
         """Returns all Promotions with the given name
@@ -157,7 +749,102 @@ class Promotion(db.Model):
         """
         logger.info("Processing name query for %s ...", name)
         return cls.query.filter(cls.name.contains(name))
-    
+
+    @classmethod
+    def suggest_names(cls, prefix: str, limit: int) -> list:
+        """Returns up to limit (id, name) pairs whose name starts with prefix, ignoring case
+
+        Args:
+            prefix (string): the start of the names to match
+            limit (int): the maximum number of names to return
+        """
+        logger.info("Processing name prefix query for %s ...", prefix)
+        rows = (db.session.query(cls.id, cls.name)
+                .filter(func.lower(cls.name).startswith(prefix.lower(), autoescape=True))
+                .order_by(func.lower(cls.name), cls.id)
+                .limit(limit))
+        return [(row.id, row.name) for row in rows]
+
+    @classmethod
+    def all_names(cls) -> list:
+        """Returns the (id, name) pairs of all Promotions"""
+        return [(row.id, row.name) for row in db.session.query(cls.id, cls.name)]
+
+    @classmethod
+    def vip_customers(cls) -> list:
+        """Returns the (id, customer) pairs of the VIP Promotions that belong to a customer"""
+        rows = db.session.query(cls.id, cls.customer).filter(
+            cls.type == PromoType.VIP, cls.customer.isnot(None))
+        return [(row.id, row.customer) for row in rows]
+
+    @classmethod
+    def find_records_by_ids(cls, ids, queries=(), fields=None) -> list:
+        """Returns the PromotionRecords with the given ids that match any of the finder queries
+
+        Args:
+            ids (list): the ids of the Promotions to load
+            queries (list): finder queries to OR together (all Promotions when empty)
+            fields (list): only select these columns (the id is always selected)
+        """
+        query = cls.record_query(fields).filter(cls.id.in_(ids))
+        if queries:
+            query = query.filter(or_(*[finder.whereclause for finder in queries]))
+        return [PromotionRecord.from_row(row) for row in query]
+
+    @classmethod
+    def has_trigram_search(cls) -> bool:
+        """Returns True when the database has the pg_trgm extension installed"""
+        engine = db.session().get_bind(clause=select(cls.id))  # the database the search would read
+        if engine.url not in _trigram_support:
+            supported = False
+            if engine.dialect.name == "postgresql":
+                with engine.connect() as conn:
+                    supported = conn.execute(
+                        text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+                    ).scalar() is not None
+            _trigram_support[engine.url] = supported
+        return _trigram_support[engine.url]
+
+    @classmethod
+    def _set_similarity_threshold(cls, threshold):
+        """ Sets the threshold of the % operator for this transaction, on the database the search reads """
+        # a SELECT, so that it is routed to the same database (e.g. a replica) as the search
+        db.session.execute(select(func.set_config("pg_trgm.similarity_threshold", str(threshold), True)))
+
+    @classmethod
+    def search_by_similarity(cls, text_query, limit, threshold, queries=(), fields=None) -> list:
+        """Returns the Promotions whose name is most similar to text_query (Postgres pg_trgm)
+
+        Args:
+            text_query (string): the text to compare names against
+            limit (int): the maximum number of Promotions to return
+            threshold (float): the minimum similarity, from 0 to 1
+            queries (list): finder queries to OR together to narrow the search
+            fields (list): only select these columns (the id is always selected)
+
+        Returns:
+            list: (PromotionRecord, score) pairs, most similar first
+        """
+        logger.info("Processing similarity search for %s ...", text_query)
+        # the % operator uses the trigram index with this transaction's threshold
+        cls._set_similarity_threshold(threshold)
+        score = func.similarity(cls.name, text_query).label("score")
+        query = cls.record_query(fields).add_columns(score).filter(cls.name.op("%")(text_query))
+        if queries:
+            query = query.filter(or_(*[finder.whereclause for finder in queries]))
+        rows = query.order_by(score.desc(), cls.id).limit(limit)
+        return [(PromotionRecord.from_row(row), row.score) for row in rows]
+
+    @classmethod
+    def count_by_similarity(cls, text_query, threshold, queries=()) -> int:
+        """Returns the number of Promotions whose name is at least threshold similar to text_query (pg_trgm)"""
+        logger.info("Counting similarity matches for %s ...", text_query)
+        cls._set_similarity_threshold(threshold)
+        query = db.session.query(func.count(cls.id)).filter(cls.name.op("%")(text_query))
+        if queries:
+            query = query.filter(or_(*[finder.whereclause for finder in queries]))
+        return query.scalar()
+
     @classmethod
     def find_by_type(cls, type: str) -> list:
         """Returns all of the Promotions in a type
@@ -232,3 +919,456 @@ class Promotion(db.Model):
         logger.info("Processing end_date query for %s ...", end_date)
         return cls.query.filter(cls.end_date == end_date)
 
+    @classmethod
+    def find_by_date_range(cls, active_on=None, starts_after=None, starts_before=None,
+                           ends_after=None, ends_before=None, overlaps=None) -> list:
+        """Returns all of the Promotions matching every given date bound
+
+        Start and end dates are inclusive, so a Promotion is active on both
+        of them. The after/before bounds are strict.
+
+        :param active_on: a date on which the Promotion is in effect
+        :param starts_after: the Promotion starts after this date
+        :param starts_before: the Promotion starts before this date
+        :param ends_after: the Promotion ends after this date
+        :param ends_before: the Promotion ends before this date
+        :param overlaps: a (from, to) tuple of dates the Promotion overlaps
+        :type of all params: date
+
+        :return: a collection of Promotions within the date range
+        :rtype: list
+
+        """
+        logger.info("Processing date range query ...")
+        query = cls.query
+        # on Postgres containment and overlap go through the GiST daterange index
+        use_ranges = db.engine.dialect.name == "postgresql"
+        if active_on:
+            if use_ranges:
+                query = query.filter(cls.date_range().op("@>")(active_on))
+            else:
+                query = query.filter(cls.start_date <= active_on, cls.end_date >= active_on)
+        if overlaps:
+            from_date, to_date = overlaps
+            if use_ranges:
+                query = query.filter(
+                    cls.date_range().op("&&")(func.daterange(from_date, to_date, "[]")))
+            else:
+                query = query.filter(cls.start_date <= to_date, cls.end_date >= from_date)
+        if starts_after:
+            query = query.filter(cls.start_date > starts_after)
+        if starts_before:
+            query = query.filter(cls.start_date < starts_before)
+        if ends_after:
+            query = query.filter(cls.end_date > ends_after)
+        if ends_before:
+            query = query.filter(cls.end_date < ends_before)
+        return query
+
+    @classmethod
+    def statistics(cls, today) -> list:
+        """
+        Returns the (type, discount bucket, status, count) groups of all
+        Promotions from a single grouped query
+
+        The discount bucket is the discount rounded down to a multiple of
+        DISCOUNT_BUCKET_WIDTH (None without a discount). The status on the
+        given day is "cancelled" for Promotions ending on their start date,
+        otherwise "expired", "upcoming" or "active"
+        """
+        logger.info("Processing statistics as of %s", today)
+        bucket = cls.discount - cls.discount % DISCOUNT_BUCKET_WIDTH
+        state = case(
+            (cls.end_date == cls.start_date, "cancelled"),
+            (cls.end_date < today, "expired"),
+            (cls.start_date > today, "upcoming"),
+            else_="active",
+        )
+        rows = select(cls.type, bucket.label("bucket"), state.label("status")).subquery()
+        statement = select(rows.c.type, rows.c.bucket, rows.c.status, func.count()).group_by(
+            rows.c.type, rows.c.bucket, rows.c.status)
+        return [tuple(row) for row in db.session.execute(statement)]
+
+    @classmethod
+    def count_matching_any(cls, queries, estimate=False) -> int:
+        """Counts the Promotions matched by any of the given finder queries
+
+        Exact counts run a single COUNT(*) over the same OR-ed criteria as
+        find_matching_any, without transferring any rows. Estimates read
+        the planner statistics on Postgres (pg_class.reltuples when
+        unfiltered, the EXPLAIN row estimate otherwise) and fall back to an
+        exact count for small results or on other databases.
+
+        :param queries: the finder queries to combine
+        :type of queries: list
+        :param estimate: allow a planner estimate instead of an exact count
+        :type of estimate: bool
+
+        :return: the number of matching Promotions
+        :rtype: int
+
+        """
+        logger.info("Processing count matching any of %d filters ...", len(queries))
+        statement = select(func.count()).select_from(cls)
+        if queries:
+            statement = statement.where(or_(*[finder.whereclause for finder in queries]))
+        if estimate and db.engine.dialect.name == "postgresql":
+            approximate = cls._estimate_rows(queries)
+            if approximate >= ESTIMATE_EXACT_BELOW:
+                return approximate
+        return db.session.execute(statement).scalar()
+
+    @classmethod
+    def _estimate_rows(cls, queries) -> int:
+        """ Returns the Postgres planner estimate of the matching rows, -1 if unknown """
+        if not queries:
+            reltuples = db.session.execute(
+                text("SELECT reltuples FROM pg_class WHERE relname = :table"),
+                {"table": cls.__tablename__},
+            ).scalar()
+            return int(reltuples) if reltuples is not None else -1
+        statement = select(cls.id).where(or_(*[finder.whereclause for finder in queries]))
+        plan = db.session.execute(Explain(statement)).scalar()
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    @classmethod
+    def date_range(cls):
+        """ The inclusive Postgres daterange covered by a Promotion """
+        return func.daterange(cls.start_date, cls.end_date, "[]")
+
+
+@on_write
+def _update_shared_records(promo_id, record):
+    """ Writes every committed change through to the shared record cache """
+    cache = Promotion.shared_records()
+    if cache is None:
+        return
+    cache.bump()
+    if record is None:
+        cache.remove(promo_id)
+    else:
+        cache.put(record)
+
+
+# database URL -> whether pg_trgm is installed there
+_trigram_support = {}
+
+
+class Explain(Executable, ClauseElement):
+    """ EXPLAIN (FORMAT JSON) of a SELECT, for reading planner estimates (Postgres only) """
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def _tracks_write_generation() -> bool:
+    """ Whether anything reads the write generation """
+    return Promotion.app is not None and any(reads(Promotion.app.config) for reads in _write_generation_readers)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _flag_promotion_write(conn, cursor, statement, parameters, context,  # pylint: disable=unused-argument
+                          executemany):  # pylint: disable=unused-argument
+    """ Notes on the connection that its transaction wrote promotions """
+    if context is None or not (context.isinsert or context.isupdate or context.isdelete):
+        return
+    if getattr(context.compiled, "statement", None) is None:
+        return
+    if getattr(context.compiled.statement, "table", None) is Promotion.__table__ and _tracks_write_generation():
+        conn.info["promotion_written"] = True
+
+
+@event.listens_for(Engine, "commit")
+def _commit_promotion_write(conn):
+    if conn.info.pop("promotion_written", False):
+        conn.info["promotion_committed"] = True
+
+
+@event.listens_for(Engine, "rollback")
+def _discard_promotion_write(conn):
+    conn.info.pop("promotion_written", None)
+
+
+@event.listens_for(Pool, "reset")
+def _bump_write_generation(dbapi_connection, connection_record):
+    """
+    Bumps the write generation once for the committed writes of a connection
+    as it goes back to the pool: after the commit, so that no other worker
+    can read the new generation and then the old rows, and in one autocommit
+    statement rather than a transaction of its own
+    """
+    if not connection_record.info.pop("promotion_committed", False):
+        return
+    raw = dbapi_connection.dbapi_connection
+    try:
+        raw.autocommit = True  # the connection is between transactions
+        try:
+            with raw.cursor() as cursor:
+                cursor.execute(f"SELECT nextval('{write_generation_sequence.name}')")
+        finally:
+            raw.autocommit = False
+    except Exception:  # pylint: disable=broad-except
+        # other workers' cached results then live out RESULT_CACHE_MAX_AGE
+        logger.exception("Could not bump the write generation")
+
+
+def upgrade_schema(connection):
+    """
+    Adds the columns that create_all() does not add to a promotion table
+    made by an older release; safe to run on every start
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    connection.execute(text(f"ALTER TABLE {Promotion.__table__.name} "
+                            "ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1"))
+
+
+# GiST index backing the containment / overlap range queries (Postgres only)
+event.listen(
+    Promotion.__table__,
+    "after_create",
+    DDL("CREATE INDEX IF NOT EXISTS ix_promotion_date_range ON %(table)s "
+        "USING gist (daterange(start_date, end_date, '[]'))").execute_if(dialect="postgresql"),
+)
+
+
+@event.listens_for(Promotion.__table__, "after_create")
+def _create_trigram_index(table, connection, **kw):
+    """ Adds the pg_trgm name index used by similarity search where the extension is available """
+    if connection.dialect.name != "postgresql":
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_promotion_name_trgm ON {table.name} "
+                                    "USING gin (name gin_trgm_ops)"))
+    except DBAPIError:
+        logger.warning("pg_trgm is not available; name search uses the in-process trigram index")
+
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y S
+######################################################################
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the stored response for an Idempotency-Key
+
+    A row without a status_code belongs to a request still in flight
+    """
+
+    key = db.Column(db.String(255), primary_key=True)
+    # hash of the request body, so a key cannot be reused for another request
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)
+    body = db.Column(db.Text, nullable=True)
+    location = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime(), nullable=False, server_default=func.now(), index=True)
+
+    def __repr__(self):
+        return "<IdempotencyKey %r status=[%s]>" % (self.key, self.status_code)
+
+    @classmethod
+    def claim(cls, key, fingerprint, ttl, lock_timeout) -> bool:
+        """
+        Claims a key for the current request in a single INSERT ... ON CONFLICT
+
+        Keys past their ttl, and keys left in flight for longer than
+        lock_timeout (e.g. by a worker that died), are taken over.
+
+        Returns True if the current request owns the key
+        """
+        table = cls.__table__
+        now = func.now()
+        statement = pg_insert(table).values(key=key, fingerprint=fingerprint, created_at=now)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={"fingerprint": statement.excluded.fingerprint, "status_code": None,
+                  "body": None, "location": None, "created_at": now},
+            where=or_(
+                table.c.created_at < now - timedelta(seconds=ttl),
+                and_(table.c.status_code.is_(None),
+                     table.c.created_at < now - timedelta(seconds=lock_timeout)),
+            ),
+        ).returning(table.c.key)
+        claimed = db.session.execute(statement).first() is not None
+        db.session.commit()
+        logger.info("Idempotency key %s claimed: %s", key, claimed)
+        return claimed
+
+    @classmethod
+    def lookup(cls, key):
+        """ Returns the stored (fingerprint, status_code, body, location) row for a key, or None """
+        row = db.session.query(cls.fingerprint, cls.status_code, cls.body, cls.location) \
+            .filter(cls.key == key).first()
+        db.session.commit()
+        return row
+
+    @classmethod
+    def complete(cls, key, status_code, body, location=None):
+        """ Stores the response of the request that owns a key """
+        table = cls.__table__
+        db.session.execute(
+            table.update().where(table.c.key == key)
+            .values(status_code=status_code, body=body, location=location)
+        )
+        db.session.commit()
+
+    @classmethod
+    def release(cls, key):
+        """ Forgets a key whose request failed, so that a retry runs again """
+        table = cls.__table__
+        db.session.execute(table.delete().where(table.c.key == key))
+        db.session.commit()
+
+    @classmethod
+    def prune(cls, ttl, max_keys):
+        """ Removes expired keys and the oldest keys beyond max_keys """
+        table = cls.__table__
+        db.session.execute(
+            table.delete().where(table.c.created_at < func.now() - timedelta(seconds=ttl)))
+        newest = select(table.c.key).order_by(table.c.created_at.desc()).offset(max_keys)
+        db.session.execute(table.delete().where(table.c.key.in_(newest)))
+        db.session.commit()
+
+
+######################################################################
+#  J O B S
+######################################################################
+
+
+class Job(db.Model):
+    """
+    Class that represents a long-running bulk operation and its progress
+
+    A job is "queued" until a worker thread picks it up, "running" while it
+    works through its items, then "succeeded" with a result or "failed"
+    with an error
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    state = db.Column(db.String(16), nullable=False, default="queued")
+    total = db.Column(db.Integer, nullable=False, default=0)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.Text, nullable=True)  # JSON
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime(), nullable=False, server_default=func.now(), index=True)
+    updated_at = db.Column(db.DateTime(), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return "<Job %r id=[%s] state=[%s]>" % (self.kind, self.id, self.state)
+
+    def serialize(self):
+        """ Serializes a Job into a dictionary """
+        return {"id": self.id,
+                "kind": self.kind,
+                "state": self.state,
+                "total": self.total,
+                "done": self.done,
+                "result": json.loads(self.result) if self.result is not None else None,
+                "error": self.error,
+                "created_at": self.created_at.isoformat(),
+                "updated_at": self.updated_at.isoformat()}
+
+    @classmethod
+    def submit(cls, kind, total):
+        """ Records a new queued Job and returns it """
+        job = cls(kind=kind, state="queued", total=total, done=0)
+        db.session.add(job)
+        db.session.commit()
+        logger.info("Queued %s job %s for %d items", kind, job.id, total)
+        return job
+
+    @classmethod
+    def find(cls, by_id):
+        """ Finds a Job by its ID """
+        job = cls.query.get(by_id)
+        db.session.commit()  # a polling client must not see a stale snapshot next time
+        return job
+
+    @classmethod
+    def mark(cls, by_id, **values):
+        """ Updates the state, progress or outcome of a Job in a single UPDATE """
+        table = cls.__table__
+        if "result" in values:
+            values["result"] = json.dumps(values["result"])
+        db.session.execute(table.update().where(table.c.id == by_id).values(updated_at=func.now(), **values))
+        db.session.commit()
+
+    @classmethod
+    def start(cls, by_id) -> bool:
+        """ Marks a queued Job running; returns False if it is no longer queued (e.g. it was abandoned) """
+        table = cls.__table__
+        result = db.session.execute(
+            table.update().where(table.c.id == by_id, table.c.state == "queued")
+            .values(state="running", updated_at=func.now()))
+        db.session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    def touch(cls, ids):
+        """ Records that the queued Jobs with these ids are still waiting in a live worker """
+        table = cls.__table__
+        db.session.execute(
+            table.update().where(table.c.id.in_(ids), table.c.state == "queued").values(updated_at=func.now()))
+        db.session.commit()
+
+    @classmethod
+    def fail_abandoned(cls, timeout):
+        """
+        Fails the unfinished Jobs without progress for timeout seconds (e.g. their worker died);
+        a live worker touches the Jobs it has queued, so only a dead worker's go quiet
+        """
+        table = cls.__table__
+        result = db.session.execute(
+            table.update()
+            .where(table.c.state.in_(("queued", "running")),
+                   table.c.updated_at < func.now() - timedelta(seconds=timeout))
+            .values(state="failed", error="Abandoned by its worker", updated_at=func.now()))
+        db.session.commit()
+        return result.rowcount
+
+    @classmethod
+    def add_page(cls, by_id, number, data):
+        """ Stores page number of the output of a Job, as JSON """
+        db.session.execute(JobPage.__table__.insert().values(job_id=by_id, number=number, data=json.dumps(data)))
+        db.session.commit()
+
+    @classmethod
+    def page(cls, by_id, number):
+        """ Returns page number of the output of a Job, or None if it has no such page """
+        data = db.session.execute(
+            select(JobPage.data).where(JobPage.job_id == by_id, JobPage.number == number)).scalar()
+        db.session.commit()
+        return json.loads(data) if data is not None else None
+
+    @classmethod
+    def prune(cls, ttl):
+        """ Removes the finished Jobs older than ttl seconds, and their pages """
+        table = cls.__table__
+        db.session.execute(
+            table.delete().where(table.c.state.in_(("succeeded", "failed")),
+                                 table.c.created_at < func.now() - timedelta(seconds=ttl)))
+        db.session.commit()
+
+
+class JobPage(db.Model):
+    """
+    Class that represents one page of the output of a Job (e.g. the
+    Promotions an export read), so that the output is never held whole
+    """
+
+    __tablename__ = "job_page"
+
+    job_id = db.Column(db.Integer, db.ForeignKey("job.id", ondelete="CASCADE"), primary_key=True)
+    number = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.Text, nullable=False)  # JSON
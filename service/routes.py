@@ -6,15 +6,24 @@ Describe what your service does here
 
 import os
 import sys
+import json
+import base64
 import logging
+from copy import copy
+from datetime import date
+from urllib.parse import urlencode
 from flask import Flask, jsonify, request, url_for, make_response, render_template, abort
-from flask_restx import Api, Resource, fields, reqparse, inputs
-from .utils import error_handlers, status  # HTTP Status Codes
+from functools import wraps
+from flask_restx import Api, Resource, fields, marshal, reqparse, inputs
+from flask_restx.utils import unpack
+from .utils import error_handlers, metrics, status  # HTTP Status Codes
+from .utils import jobs, name_search, result_cache, stale_cache, stats, suggest, vip_index, warm_up
+from .utils.idempotency import idempotent
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Promotion, PromoType, DataValidationError
+from service.models import SORT_FIELDS, Job, Promotion, PromoType, DataValidationError
 
 # Import Flask application
 from . import app, api
@@ -28,8 +37,23 @@ CONTENT_TYPE_JSON = "application/json"
 
 @app.route("/health")
 def healthcheck():
-    """Let them know our heart is still beating"""
-    return make_response(jsonify(status=200, message="OK"), status.HTTP_200_OK)
+    """Let them know our heart is still beating, once the caches are warm"""
+    if not warm_up.is_ready():
+        return make_response(jsonify(status=503, message="Warming up"), status.HTTP_503_SERVICE_UNAVAILABLE)
+    return make_response(jsonify(status=200, message="OK", warm_up_seconds=warm_up.seconds()),
+                         status.HTTP_200_OK)
+
+
+######################################################################
+# GET METRICS
+######################################################################
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Exposes the service metrics in the Prometheus text format"""
+    return make_response(metrics.render(), status.HTTP_200_OK,
+                         {"Content-Type": "text/plain; version=0.0.4"})
 
 
 ######################################################################
@@ -63,15 +87,87 @@ create_model = api.model('Promotion', {
                             description='The date on which the promotion ends (at midnight)')
 })
 
+# same fields as create_model, none of them required, for partial updates
+patch_model = api.model('PromotionPatch', {
+    key: copy(field) for key, field in create_model.items()
+})
+for patch_field in patch_model.values():
+    patch_field.required = False
+
 promotion_model = api.inherit(
     'PromotionModel',
     create_model,
     {
         'id': fields.Integer(readOnly=True, # change to 'id' if this doesn't work; '_id' might be a couchdb thing
-                             description='The unique ID assigned internally by the service')
+                             description='The unique ID assigned internally by the service'),
+        'version': fields.Integer(readOnly=True,
+                                  description='Bumped by every change; send it back in If-Match to update')
+    }
+)
+
+search_result_model = api.inherit(
+    'PromotionSearchResult',
+    promotion_model,
+    {
+        'score': fields.Float(readOnly=True,
+                              description='Trigram similarity of the name to the q= search, from 0 to 1')
     }
 )
 
+lookup_model = api.model('PromotionLookup', {
+    'ids': fields.List(fields.Integer, required=True,
+                       description='The IDs of the Promotions to look up, in the order wanted')
+})
+
+lookup_result_model = api.model('PromotionLookupResult', {
+    'id': fields.Integer(description='An ID that was looked up'),
+    'found': fields.Boolean(description='Whether a Promotion has the ID'),
+    'promotion': fields.Nested(promotion_model, allow_null=True,
+                               description='The Promotion, or null when not found')
+})
+
+discount_bucket_model = api.model('PromotionDiscountBucket', {
+    'min': fields.Integer(description='The smallest discount in the bucket'),
+    'max': fields.Integer(description='The largest discount in the bucket'),
+    'count': fields.Integer(description='The number of Promotions with a discount in the bucket')
+})
+
+stats_model = api.model('PromotionStats', {
+    'as_of': fields.Date(description='The day the statuses are computed for'),
+    'total': fields.Integer(description='The number of Promotions'),
+    'by_type': fields.Raw(description='The number of Promotions of each type'),
+    'by_status': fields.Raw(description='The number of active, upcoming, expired and cancelled Promotions; '
+                                        'one-day Promotions (start_date == end_date) count as cancelled'),
+    'by_discount': fields.List(fields.Nested(discount_bucket_model),
+                               description='Discount histogram, in buckets of 10 percentage points'),
+    'no_discount': fields.Integer(description='The number of Promotions without a discount')
+})
+
+job_create_model = api.model('JobRequest', {
+    'kind': fields.String(required=True, enum=list(jobs.KINDS),
+                          description='import (Promotions), cancel (Promotions by id) or export (all Promotions)'),
+    'promotions': fields.List(fields.Nested(create_model), description='The Promotions to import'),
+    'ids': fields.List(fields.Integer, description='The IDs of the Promotions to cancel')
+})
+
+job_model = api.model('Job', {
+    'id': fields.Integer(readOnly=True, description='The unique ID assigned internally by the service'),
+    'kind': fields.String(description='The kind of bulk operation'),
+    'state': fields.String(enum=['queued', 'running', 'succeeded', 'failed'], description='Where the job is at'),
+    'total': fields.Integer(description='The number of items the job works through'),
+    'done': fields.Integer(description='The number of items done so far'),
+    'result': fields.Raw(description='What the job did (up to its error, if it failed); '
+                                     'an export pages its Promotions at /jobs/{id}/result'),
+    'error': fields.String(description='Why the job failed'),
+    'created_at': fields.DateTime(description='When the job was submitted'),
+    'updated_at': fields.DateTime(description='When the job last made progress')
+})
+
+suggestion_model = api.model('PromotionSuggestion', {
+    'id': fields.Integer(readOnly=True, description='The unique ID assigned internally by the service'),
+    'name': fields.String(description='The name of the Promotion')
+})
+
 
 ######################################################################
 # PARSE REQUEST ARGUMENTS
@@ -85,6 +181,113 @@ promotion_args.add_argument('discount', type=int, required=False, help='List Pro
 promotion_args.add_argument('customer', type=int, required=False, help='List Promotions by associated customer ID')
 promotion_args.add_argument('start_date', type=str, required=False, help='List Promotions by start date')
 promotion_args.add_argument('end_date', type=str, required=False, help='List Promotions by end date')
+promotion_args.add_argument('active_on', type=str, required=False, help='List Promotions in effect on a date')
+promotion_args.add_argument('starts_after', type=str, required=False, help='List Promotions starting after a date')
+promotion_args.add_argument('starts_before', type=str, required=False, help='List Promotions starting before a date')
+promotion_args.add_argument('ends_after', type=str, required=False, help='List Promotions ending after a date')
+promotion_args.add_argument('ends_before', type=str, required=False, help='List Promotions ending before a date')
+promotion_args.add_argument('overlaps', type=str, required=False,
+                            help='List Promotions overlapping a from,to date range')
+promotion_args.add_argument('q', type=str, required=False,
+                            help='Rank Promotions by the similarity of their name to this text')
+promotion_args.add_argument('limit', type=int, required=False,
+                            help='Page size of the listing (1-1000), or number of q= search results (1-100, default 10)')
+promotion_args.add_argument('sort', type=str, required=False,
+                            help='Sort by id, name, start_date, end_date or discount; - prefix for descending')
+promotion_args.add_argument('cursor', type=str, required=False,
+                            help='Continue a sorted listing after the page that returned this cursor')
+
+# single-date bounds accepted by Promotion.find_by_date_range
+DATE_RANGE_ARGS = ['active_on', 'starts_after', 'starts_before', 'ends_after', 'ends_before']
+
+
+suggest_args = reqparse.RequestParser()
+suggest_args.add_argument('prefix', type=str, required=True, help='Start of the Promotion names to suggest')
+suggest_args.add_argument('limit', type=inputs.int_range(1, 50), required=False, default=10,
+                          help='Maximum number of suggestions (1-50)')
+
+# query args that shape a listing rather than filter it
+LISTING_OPTION_ARGS = {'fields', 'count', 'limit', 'sort', 'cursor'}
+
+# the largest page of a listing
+LISTING_MAX_LIMIT = 1000
+
+# endpoints that only read although their method is POST
+READ_ONLY_ENDPOINTS = ('promotion_lookup',)
+
+# number of ranked results of a q= search, by default and at most
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 100
+
+
+######################################################################
+# OPTIMISTIC CONCURRENCY
+######################################################################
+
+# documents the If-Match header required by the writes of a single Promotion
+IF_MATCH_PARAM = {'If-Match': {
+    'in': 'header', 'description': 'ETag (version) of the Promotion being changed, or *'}}
+
+
+def etag_header(promo):
+    """ Returns the ETag header for a Promotion's version """
+    return {'ETag': f'"{promo.version}"'}
+
+
+def if_match_versions():
+    """
+    Returns the versions accepted by the If-Match header, None for *;
+    aborts with 428 when the header is missing
+    """
+    if 'If-Match' not in request.headers:
+        api.abort(status.HTTP_428_PRECONDITION_REQUIRED,
+                  "This request requires an If-Match header with the ETag of the Promotion")
+    if request.if_match.star_tag:
+        return None
+    # a compressed response's ETag carries its encoding: "3-gzip"
+    versions = (tag.split("-", 1)[0] for tag in request.if_match.as_set())
+    return [int(version) for version in versions if version.isdigit()]
+
+
+######################################################################
+# SPARSE FIELDSETS
+######################################################################
+
+
+def parse_fields_arg(args):
+    """
+    Parses the ?fields= sparse fieldset into a list of field names,
+    None when all fields are wanted; aborts with 400 on unknown fields
+    """
+    if not args.get('fields'):
+        return None
+    model = search_result_model if args.get('q') else promotion_model
+    fieldset = [field.strip() for field in args['fields'].split(',') if field.strip()]
+    unknown = [field for field in fieldset if field not in model.resolved]
+    if unknown:
+        api.abort(status.HTTP_400_BAD_REQUEST, "Unknown fields: {}".format(", ".join(unknown)))
+    return fieldset
+
+
+def marshal_fieldset(model, as_list=False, search_model=None):
+    """
+    Marshals a response like api.marshal_with, limited to the keys named
+    in the ?fields= query argument; q= searches use search_model if given
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            data, code, headers = unpack(func(*args, **kwargs))
+            fieldset = parse_fields_arg(request.args)
+            mask = ",".join(fieldset) if fieldset else None
+            if search_model is not None and request.args.get('q'):
+                return marshal(data, search_model, mask=mask), code, headers
+            return marshal(data, model, mask=mask), code, headers
+        documented = api.doc(params={
+            'fields': 'Comma separated list of the fields to return, e.g. id,type,discount'
+        })(wrapper)
+        return api.response(status.HTTP_200_OK, 'Success', [model] if as_list else model)(documented)
+    return decorator
 
 
 ######################################################################
@@ -99,15 +302,17 @@ class PromotionResource(Resource):
     Allows the manipulation of a single Promotion
     GET /promotion/{id} - Returns a Promotion with the id
     PUT /promotion/{id} - Update a Promotion with the id
+    PATCH /promotion/{id} - Update some fields of a Promotion with the id
     DELETE /promotion/{id} -  Deletes a Promotion with the id
     """
 
-    #------------------------------------------------------------------
+    # ------------------------------------------------------------------
     # RETRIEVE A PROMOTION
-    #------------------------------------------------------------------
+    # ------------------------------------------------------------------
     @api.doc('get_promotions')
     @api.response(404, 'Promotion not found')
-    @api.marshal_with(promotion_model)
+    @stale_cache.stale_while_revalidate
+    @marshal_fieldset(promotion_model)
     def get(self, promo_id):
         """
         Retrieve a single Promotion
@@ -115,17 +320,19 @@ class PromotionResource(Resource):
         This endpoint will return a Promotion based on its ID
         """
         app.logger.info("Request to Retrieve a promotion with ID [%s]", promo_id)
-        promo = Promotion.find(promo_id)
+        promo = Promotion.find_record(promo_id, parse_fields_arg(request.args))
         if not promo:
             api.abort(status.HTTP_404_NOT_FOUND, "Promotion with ID [%s] not found.".format(promo_id))
-        return promo.serialize(), status.HTTP_200_OK
+        return promo.serialize(), status.HTTP_200_OK, etag_header(promo)
 
-    #------------------------------------------------------------------
+    # ------------------------------------------------------------------
     # UPDATE AN EXISTING PROMOTION
-    #------------------------------------------------------------------
-    @api.doc('update_promotions')
+    # ------------------------------------------------------------------
+    @api.doc('update_promotions', params=IF_MATCH_PARAM)
     @api.response(404, 'Promotion not found')
     @api.response(400, 'The posted Promotion data was not valid')
+    @api.response(412, 'The Promotion was changed since the If-Match version')
+    @api.response(428, 'The If-Match header is missing')
     @api.expect(promotion_model)
     @api.marshal_with(promotion_model)
     def put(self, promo_id):
@@ -135,20 +342,45 @@ class PromotionResource(Resource):
         This endpoint will update a Promotion based the body that is posted
         """
         app.logger.info('Request to Update a promotion with ID [%s]', promo_id)
-        promo = Promotion.find(promo_id)
+        app.logger.debug('Payload = %s', api.payload)
+        versions = if_match_versions()
+        changes = Promotion.deserialize_changes(api.payload)
+        # a single conditional UPDATE: no row locks between reading and writing
+        promo = Promotion.update_by_id(promo_id, changes, versions)
         if not promo:
             api.abort(status.HTTP_404_NOT_FOUND, "Promotion with ID '{}' was not found.".format(promo_id))
-        app.logger.debug('Payload = %s', api.payload)
-        data = api.payload
-        promo.deserialize(data)
-        promo.id = promo_id
-        promo.update()
         app.logger.info("Promotion with ID [%s] updated.", promo.id)
-        return promo.serialize(), status.HTTP_200_OK
+        return promo.serialize(), status.HTTP_200_OK, etag_header(promo)
+
+    # ------------------------------------------------------------------
+    # PARTIALLY UPDATE AN EXISTING PROMOTION
+    # ------------------------------------------------------------------
+    @api.doc('patch_promotions', params=IF_MATCH_PARAM)
+    @api.response(404, 'Promotion not found')
+    @api.response(400, 'The posted Promotion data was not valid')
+    @api.response(412, 'The Promotion was changed since the If-Match version')
+    @api.response(428, 'The If-Match header is missing')
+    @api.expect(patch_model)
+    @api.marshal_with(promotion_model)
+    def patch(self, promo_id):
+        """
+        Partially update a Promotion
+
+        This endpoint will update only the fields of a Promotion present in the body that is posted
+        """
+        app.logger.info('Request to Patch a promotion with ID [%s]', promo_id)
+        app.logger.debug('Payload = %s', api.payload)
+        versions = if_match_versions()
+        changes = Promotion.deserialize_changes(api.payload, partial=True)
+        promo = Promotion.update_by_id(promo_id, changes, versions)
+        if not promo:
+            api.abort(status.HTTP_404_NOT_FOUND, "Promotion with ID '{}' was not found.".format(promo_id))
+        app.logger.info("Promotion with ID [%s] patched.", promo.id)
+        return promo.serialize(), status.HTTP_200_OK, etag_header(promo)
 
-    #------------------------------------------------------------------
+    # ------------------------------------------------------------------
     # DELETE A PROMOTION
-    #------------------------------------------------------------------
+    # ------------------------------------------------------------------
     @api.doc('delete_promotions')
     @api.response(204, 'Promotion deleted')
     def delete(self, promo_id):
@@ -158,9 +390,7 @@ class PromotionResource(Resource):
         This endpoint will delete a Promotion based the ID specified in the path
         """
         app.logger.info('Request to Delete a promotion with ID [%s]', promo_id)
-        promo = Promotion.find(promo_id)
-        if promo:
-            promo.delete()
+        if Promotion.delete_by_id(promo_id):
             app.logger.info('Promotion with ID [%s] was deleted', promo_id)
 
         return '', status.HTTP_204_NO_CONTENT
@@ -172,100 +402,98 @@ class PromotionResource(Resource):
 @api.route('/promotions', strict_slashes=False)
 class PromotionCollection(Resource):
     """ Handles all interactions with collections of Promotions """
-    #------------------------------------------------------------------
+    # ------------------------------------------------------------------
     # LIST ALL PROMOTIONS
-    #------------------------------------------------------------------
-    @api.doc('list_promotions')
+    # ------------------------------------------------------------------
+    @api.doc('list_promotions', params={
+        'q': 'Rank Promotions by the similarity of their name to this text; results include a score',
+        'limit': 'Page size of the listing (1-1000), or number of q= search results (1-100, default 10)',
+        'sort': 'Sort by id (default), name, start_date, end_date or discount; - prefix for descending',
+        'cursor': 'Continue after the page whose Link header returned this cursor'
+    })
     # @api.expect(promotion_args, validate=True)
-    @api.marshal_list_with(promotion_model)
+    @stale_cache.stale_while_revalidate
+    @result_cache.cached
+    @marshal_fieldset(promotion_model, as_list=True, search_model=search_result_model)
     def get(self):
         """ Returns all of the Promotions """
         app.logger.info('Request to list Promotions...')
-        promotions = []
-        app.logger.info('About to parse arguments')
-        # args = promotion_args.parse_args()
-        args = {}
-        args["name"] = request.args.get("name")
-        args["type"] = request.args.get("type")
-        args["discount"] = request.args.get("discount")
-        args["customer"] = request.args.get("customer")
-        args["start_date"] = request.args.get("start_date")
-        args["end_date"] = request.args.get("end_date")
-        app.logger.info('Parsed args successfully')
-        app.logger.info("args = %s", args)
-        # promotions = Promotion.all()
-        promotions = []
-        filtered = False
-
-        if args['type']:
-            filtered = True
-            query_type = args['type']
-            # flask-restx request parsing is not working, so manually check this enum for bad argument
-            if query_type not in ['BUY_ONE_GET_ONE', 'PERCENT_DISCOUNT', 'FREE_SHIPPING', 'VIP', 'UNKNOWN']:
-                return "Bad query argument for type", status.HTTP_400_BAD_REQUEST
-            app.logger.info("type = %s", query_type)
-            promotions += Promotion.find_by_type(query_type)
-
-        if args['name']:
-            filtered = True
-            query_name = args['name']
-            app.logger.info("name contains %s", query_name)
-            promotions += Promotion.find_by_name(query_name)
-
-        if args['discount']:
-            filtered = True
-            query_discount = args['discount']
-            app.logger.info("discount = %s", query_discount)
-            promotions += Promotion.find_by_discount(query_discount)
-
-        if args['customer']:
-            filtered = True
-            query_customer = args['customer']
-            app.logger.info("customer = %s", query_customer)
-            promotions += Promotion.find_by_customer(query_customer)
-
-        if args['start_date']:
-            filtered = True
-            query_start_date = args['start_date']
-            app.logger.info("start_date = %s", query_start_date)
-            promotions += Promotion.find_by_start_date(query_start_date)
-
-        if args['end_date']:
-            filtered = True
-            query_end_date = args['end_date']
-            app.logger.info("end_date = %s", query_end_date)
-            promotions += Promotion.find_by_end_date(query_end_date)
-
-        app.logger.info(f"promotions: \n{promotions}")
-
-        # kludgy check for no match on query
-        # if len(promotions) == 1 and filtered:
-        #     test_serialize = promotions[0].serialize()
-        #     if all([True for item in list(test_serialize.values()) if item is None]):
-        #         return "No results found for query string", status.HTTP_404_NOT_FOUND
-
-        if promotions == []:
-            if filtered:
+        queries = listing_queries(request.args)
+        fieldset = parse_fields_arg(request.args)
+
+        if request.args.get('q'):
+            if request.args.get('sort') or request.args.get('cursor'):
+                api.abort(status.HTTP_400_BAD_REQUEST, "q= search results are ranked: sort and cursor do not apply")
+            # top-k by name similarity, narrowed by any other filters
+            limit = parse_limit_arg(request.args)
+            ranked = name_search.search(request.args['q'], limit, queries, fieldset)
+            if not ranked:
                 return "No results found for query string", status.HTTP_404_NOT_FOUND
-            else:
-                # if we didn't have any filters, just return all promotions in the database
-                promotions = Promotion.all()
-        else:
-            # remove dupes if multiple filters found the same promotions in the database
-            promotions = list(set(promotions))
+            results = [dict(promo.serialize(), score=score) for promo, score in ranked]
+            app.logger.info("Returning %d ranked promotions", len(results))
+            # the total number of matches, of which only the top limit are returned
+            total = len(results) if len(results) < limit else name_search.count(request.args['q'], queries)
+            return results, status.HTTP_200_OK, {'X-Total-Count': total}
+        filtered = bool(queries)
+        sort, descending = parse_sort_arg(request.args)
+        after = parse_cursor_arg(request.args, sort, descending)
+        limit = parse_limit_arg(request.args, None, LISTING_MAX_LIMIT)
+
+        # one SELECT for the union of all filters, limited to the requested columns,
+        # in the order of the (sort field, id) index
+        promotions = Promotion.find_matching_any(queries, fieldset, sort, descending, after, limit)
+
+        if promotions == [] and filtered and after is None:
+            return "No results found for query string", status.HTTP_404_NOT_FOUND
 
         results = [promo.serialize() for promo in promotions]
-        if not isinstance(results, list):
-            results = [results]
         app.logger.info("Returning %d promotions", len(results))
-        return results, status.HTTP_200_OK
+        if limit is None and after is None:
+            return results, status.HTTP_200_OK, {'X-Total-Count': len(results)}
+        headers = {}
+        if limit is not None and len(promotions) == limit:
+            headers['Link'] = next_page_link(encode_cursor(promotions[-1], sort, descending))
+        return results, status.HTTP_200_OK, headers
+
+    # ------------------------------------------------------------------
+    # COUNT PROMOTIONS
+    # ------------------------------------------------------------------
+    @api.doc('count_promotions', params={
+        'count': 'exact (default) or estimate, which may use planner statistics for large counts'
+    })
+    @api.response(200, 'The count is in the X-Total-Count header')
+    @api.response(404, 'No Promotions match the query')
+    def head(self):
+        """
+        Counts the Promotions
 
+        This endpoint returns the number of Promotions matching the same filters
+        as the listing in the X-Total-Count header, without transferring any rows
+        """
+        app.logger.info('Request to count Promotions...')
+        count_mode = request.args.get('count', 'exact')
+        if count_mode not in ('exact', 'estimate'):
+            api.abort(status.HTTP_400_BAD_REQUEST, "Bad query argument for count")
+        queries = listing_queries(request.args)
+        if request.args.get('q'):
+            count = name_search.count(request.args['q'], queries)
+        else:
+            count = Promotion.count_matching_any(queries, estimate=count_mode == 'estimate')
+        app.logger.info("Counted %d promotions", count)
+        if count == 0 and (queries or request.args.get('q')):
+            return '', status.HTTP_404_NOT_FOUND, {'X-Total-Count': 0}
+        return '', status.HTTP_200_OK, {'X-Total-Count': count}
 
-    #------------------------------------------------------------------
+
+    # ------------------------------------------------------------------
     # ADD A NEW PROMOTION
-    #------------------------------------------------------------------
-    @api.doc('create_promotion')
+    # ------------------------------------------------------------------
+    @idempotent
+    @api.doc('create_promotion', params={'Idempotency-Key': {
+        'in': 'header', 'description': 'Unique key that makes retries of this request safe'}})
     @api.response(400, 'The posted data was not valid')
+    @api.response(409, 'Duplicate Promotion, or a request with the same Idempotency-Key is in progress')
+    @api.response(422, 'The Idempotency-Key was already used for a different request')
     @api.expect(create_model)
     @api.marshal_with(promotion_model, code=201)
     def post(self):
@@ -274,39 +502,125 @@ class PromotionCollection(Resource):
         This endpoint will create a Promotion based the data in the body that is posted
         """
         app.logger.info("Request to create a Promotion")
-        promo = Promotion()
         app.logger.debug('Payload = %s', api.payload)
-        promo.deserialize(api.payload)
-        # check for empty string fields and convert to null type
-        if promo.customer == "":
-            promo.customer = None
-        if promo.discount == "":
-            promo.discount = None
+        promo = Promotion.deserialize_new(api.payload)
         # check to see if this is a duplicate
-        named_promos = Promotion.find_by_name(promo.name)
-        if (named_promos != []):
-            for other_promo in named_promos:
-                if check_duplicate(promo, other_promo):
-                    api.abort(status.HTTP_409_CONFLICT,
-                        "Attempt to create duplicate Promotion")
+        if Promotion.find_duplicates([promo]):
+            api.abort(status.HTTP_409_CONFLICT, "Attempt to create duplicate Promotion")
         promo.create()
-        message = promo.serialize()
         location_url = api.url_for(PromotionResource, promo_id=promo.id, _external=True)
 
         app.logger.info("Promotion with ID [%s] created.", promo.id)
-        return promo.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+        return promo.serialize(), status.HTTP_201_CREATED, dict(etag_header(promo), Location=location_url)
+
+
+######################################################################
+#  PATH: /promotions/lookup
+######################################################################
+@api.route('/promotions/lookup', endpoint='promotion_lookup')
+class LookupResource(Resource):
+    """ Batch lookup of Promotions by ID """
+    @api.doc('lookup_promotions')
+    @api.expect(lookup_model)
+    @api.response(400, 'The ids are not a list of integers')
+    @api.marshal_list_with(lookup_result_model)
+    def post(self):
+        """
+        Look up Promotions by ID
+
+        This endpoint returns one result per requested ID, in the requested order, with
+        `found` false and a null `promotion` for IDs without a Promotion. All of the IDs
+        are loaded with a single query (after the shared record cache, when it is on)
+        """
+        ids = api.payload.get('ids') if isinstance(api.payload, dict) else None
+        max_ids = app.config["LOOKUP_MAX_IDS"]
+        if (not isinstance(ids, list) or not 0 < len(ids) <= max_ids
+                or not all(isinstance(promo_id, int) and not isinstance(promo_id, bool) for promo_id in ids)):
+            raise DataValidationError(f"Invalid lookup: ids must be a list of 1 to {max_ids} integers")
+        app.logger.info("Request to look up %d Promotions", len(ids))
+        records = Promotion.find_records(ids)
+        return [{'id': promo_id,
+                 'found': promo_id in records,
+                 'promotion': records[promo_id].serialize() if promo_id in records else None}
+                for promo_id in ids], status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/stats
+######################################################################
+@api.route('/promotions/stats')
+class StatsResource(Resource):
+    """ Aggregate statistics of the Promotions """
+    @api.doc('promotion_stats')
+    @api.marshal_with(stats_model)
+    def get(self):
+        """
+        Promotion statistics
+
+        This endpoint returns the number of Promotions by type, by status today (a Promotion
+        ending on its start date counts as cancelled, so one-day Promotions created with
+        start_date == end_date are cancelled too) and by discount, computed by the
+        database in one grouped query or, with STATS_SUMMARY on, by an in-memory summary
+        """
+        app.logger.info("Request for Promotion statistics")
+        return stats.statistics(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/suggest
+######################################################################
+@api.route('/promotions/suggest')
+class SuggestResource(Resource):
+    """ Name typeahead for Promotions """
+    @api.doc('suggest_promotions')
+    @api.expect(suggest_args)
+    @api.marshal_list_with(suggestion_model)
+    def get(self):
+        """
+        Suggest Promotion names
+
+        This endpoint returns the Promotions whose name starts with `prefix`, ignoring case,
+        from an in-memory index rather than the database
+        """
+        args = suggest_args.parse_args()
+        app.logger.debug("Request to suggest names starting with %s", args['prefix'])
+        matches = suggest.suggest(args['prefix'], args['limit'])
+        return [{'id': promo_id, 'name': name} for promo_id, name in matches], status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/vip/{customer_id}
+######################################################################
+@api.route('/promotions/vip/<int:customer_id>')
+@api.param('customer_id', 'The customer identifier')
+class VipResource(Resource):
+    """ VIP check for a customer """
+    @api.doc('vip_promotions')
+    @marshal_fieldset(promotion_model, as_list=True)
+    def get(self, customer_id):
+        """
+        List the VIP Promotions of a customer
+
+        This endpoint returns the VIP Promotions of the customer, usually none. Customers
+        without VIP Promotions are answered from an in-memory Bloom filter without a query
+        """
+        app.logger.debug("Request for the VIP promotions of customer %s", customer_id)
+        promotions = vip_index.vip_promotions(customer_id, parse_fields_arg(request.args))
+        return [promo.serialize() for promo in promotions], status.HTTP_200_OK
 
 
 ######################################################################
 #  PATH: /promotions/{id}/cancel
 ######################################################################
-@api.route('/promotions/<promo_id>/cancel')
+@api.route('/promotions/<int:promo_id>/cancel')
 @api.param('promo_id', 'The Promotion identifier')
 class CancelResource(Resource):
     """ Cancel action on a Promotion """
-    @api.doc('cancel_promotion')
+    @api.doc('cancel_promotion', params=IF_MATCH_PARAM)
     @api.response(404, 'Promotion not found')
     @api.response(409, 'The Promotion is not available to be cancelled')
+    @api.response(412, 'The Promotion was changed since the If-Match version')
+    @api.response(428, 'The If-Match header is missing')
     def put(self, promo_id):
         """
         Cancel a Promotion early
@@ -315,16 +629,100 @@ class CancelResource(Resource):
         A Promotion with equal start and end dates is semantically considered canceled.
         """
         app.logger.info("Request to cancel a Promotion with id: %s", promo_id)
-        # attempt to locate Promotion for early cancellation
-        promotion = Promotion.find(promo_id)
+        # end the Promotion on its start date in a single statement
+        promotion = Promotion.cancel(promo_id, if_match_versions())
         if not promotion:
             api.abort(status.HTTP_404_NOT_FOUND,
                 f"Promotion with id '{promo_id}' was not found.")
-        # set the information
-        promotion.end_date = promotion.start_date
-        promotion.update()
         app.logger.info("Promotion with ID [%s] has been canceled.", promotion.id)
-        return promotion.serialize(), status.HTTP_200_OK
+        return promotion.serialize(), status.HTTP_200_OK, etag_header(promotion)
+
+
+######################################################################
+#  PATH: /jobs
+######################################################################
+@api.route('/jobs', strict_slashes=False)
+class JobCollection(Resource):
+    """ Submits long-running bulk operations """
+    @api.doc('create_job')
+    @api.expect(job_create_model)
+    @api.response(400, 'The job request is not valid')
+    @api.response(503, 'Too many jobs are pending, retry later')
+    @api.marshal_with(job_model, code=202)
+    def post(self):
+        """
+        Submit a job
+
+        This endpoint queues a bulk import, cancel or export and returns the queued job at
+        once; poll its Location for progress and, once it succeeded, its result
+        """
+        app.logger.info("Request to submit a job")
+        job = jobs.submit(api.payload)
+        location_url = api.url_for(JobResource, job_id=job.id, _external=True)
+        return job.serialize(), status.HTTP_202_ACCEPTED, {'Location': location_url}
+
+
+######################################################################
+#  PATH: /jobs/{id}
+######################################################################
+@api.route('/jobs/<int:job_id>')
+@api.param('job_id', 'The job identifier')
+class JobResource(Resource):
+    """ Progress and result of a job """
+    @api.doc('get_job')
+    @api.response(404, 'Job not found')
+    @api.marshal_with(job_model)
+    def get(self, job_id):
+        """
+        Retrieve a job
+
+        This endpoint returns the state and progress of a job and, once it succeeded, its result
+        """
+        job = Job.find(job_id)
+        if not job:
+            api.abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' was not found.")
+        return job.serialize(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /jobs/{id}/result
+######################################################################
+@api.route('/jobs/<int:job_id>/result')
+@api.param('job_id', 'The job identifier')
+class JobResultResource(Resource):
+    """ The output of an export job, a page at a time """
+    @api.doc('get_job_result', params={
+        'cursor': 'The page to return (default 0); the Link header of each page names the next'
+    })
+    @api.response(400, 'Bad cursor')
+    @api.response(404, 'Job or page not found')
+    @api.response(409, 'The job is not an export that succeeded')
+    @api.marshal_list_with(promotion_model)
+    def get(self, job_id):
+        """
+        Retrieve the Promotions an export job read
+
+        This endpoint returns one page (JOB_BATCH_SIZE Promotions) of the output of an
+        export job at a time, with a Link header to the next page
+        """
+        job = Job.find(job_id)
+        if not job:
+            api.abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' was not found.")
+        if job.kind != 'export' or job.state != 'succeeded':
+            api.abort(status.HTTP_409_CONFLICT, f"Job with id '{job_id}' is not an export that succeeded.")
+        try:
+            number = int(request.args.get('cursor', 0))
+            if number < 0:
+                raise ValueError
+        except ValueError:
+            api.abort(status.HTTP_400_BAD_REQUEST, "Bad query argument for cursor")
+        promotions = Job.page(job_id, number)
+        if promotions is None:
+            api.abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' has no page {number}.")
+        headers = {}
+        if number + 1 < job.serialize()['result']['pages']:
+            headers['Link'] = next_page_link(number + 1)
+        return promotions, status.HTTP_200_OK, headers
 
 
 ######################################################################
@@ -337,12 +735,158 @@ def init_db():
     global app
     Promotion.init_db(app)
 
-def check_duplicate(p1, p2):
+
+def route_class(req):
+    """
+    Returns the admission control budget for a request:
+    "bulk" for full downloads of the collection, "reads" for other safe
+    methods and READ_ONLY_ENDPOINTS, "writes" for everything else, and
+    None outside of the API
+    """
+    if not req.path.startswith("/api/"):
+        return None
+    if req.method in ("GET", "HEAD", "OPTIONS") or req.endpoint in READ_ONLY_ENDPOINTS:
+        if (req.method == "GET" and req.url_rule is not None and req.url_rule.rule == "/api/promotions"
+                and not set(req.args) - LISTING_OPTION_ARGS and 'limit' not in req.args):
+            return "bulk"
+        return "reads"
+    return "writes"
+
+
+def listing_queries(req_args):
+    """
+    Returns the finder queries for the filters in the listing query
+    arguments; an empty list means no filtering
+    """
+    app.logger.info('About to parse arguments')
+    # args = promotion_args.parse_args()
+    args = {}
+    args["name"] = req_args.get("name")
+    args["type"] = req_args.get("type")
+    args["discount"] = req_args.get("discount")
+    args["customer"] = req_args.get("customer")
+    args["start_date"] = req_args.get("start_date")
+    args["end_date"] = req_args.get("end_date")
+    app.logger.info('Parsed args successfully')
+    app.logger.info("args = %s", args)
+    queries = []
+
+    if args['type']:
+        query_type = args['type']
+        # flask-restx request parsing is not working, so manually check this enum for bad argument
+        if query_type not in ['BUY_ONE_GET_ONE', 'PERCENT_DISCOUNT', 'FREE_SHIPPING', 'VIP', 'UNKNOWN']:
+            api.abort(status.HTTP_400_BAD_REQUEST, "Bad query argument for type")
+        app.logger.info("type = %s", query_type)
+        queries.append(Promotion.find_by_type(query_type))
+
+    if args['name']:
+        query_name = args['name']
+        app.logger.info("name contains %s", query_name)
+        queries.append(Promotion.find_by_name(query_name))
+
+    if args['discount']:
+        query_discount = args['discount']
+        app.logger.info("discount = %s", query_discount)
+        queries.append(Promotion.find_by_discount(query_discount))
+
+    if args['customer']:
+        query_customer = args['customer']
+        app.logger.info("customer = %s", query_customer)
+        queries.append(Promotion.find_by_customer(query_customer))
+
+    if args['start_date']:
+        query_start_date = args['start_date']
+        app.logger.info("start_date = %s", query_start_date)
+        queries.append(Promotion.find_by_start_date(query_start_date))
+
+    if args['end_date']:
+        query_end_date = args['end_date']
+        app.logger.info("end_date = %s", query_end_date)
+        queries.append(Promotion.find_by_end_date(query_end_date))
+
+    date_range = parse_date_range_args(req_args)
+    if date_range:
+        app.logger.info("date range = %s", date_range)
+        queries.append(Promotion.find_by_date_range(**date_range))
+    return queries
+
+
+def parse_limit_arg(args, default=SEARCH_DEFAULT_LIMIT, maximum=SEARCH_MAX_LIMIT):
+    """ Parses the limit of a q= search or listing page, aborting with 400 when out of range """
+    if not args.get('limit'):
+        return default
+    try:
+        limit = int(args['limit'])
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= maximum:
+        api.abort(status.HTTP_400_BAD_REQUEST, f"Bad query argument for limit (1-{maximum})")
+    return limit
+
+
+def parse_sort_arg(args):
+    """ Parses ?sort= into (field, descending), aborting with 400 on unknown fields """
+    sort = args.get('sort') or 'id'
+    descending = sort.startswith('-')
+    field = sort[1:] if descending else sort
+    if field not in SORT_FIELDS:
+        api.abort(status.HTTP_400_BAD_REQUEST,
+                  "Bad query argument for sort ({}, - prefix for descending)".format(", ".join(SORT_FIELDS)))
+    return field, descending
+
+
+def encode_cursor(promo, sort, descending):
+    """ Returns the opaque cursor continuing a sorted listing after a PromotionRecord """
+    value = getattr(promo, sort)
+    if isinstance(value, date):
+        value = value.isoformat()
+    keyset = json.dumps(["-" + sort if descending else sort, value, promo.id])
+    return base64.urlsafe_b64encode(keyset.encode()).decode().rstrip("=")
+
+
+def parse_cursor_arg(args, sort, descending):
+    """
+    Decodes ?cursor= into the (sort field value, id) keyset to continue
+    after, aborting with 400 when it is invalid or from another sort
+    """
+    cursor = args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        key, value, last_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if key != ("-" + sort if descending else sort) or not isinstance(last_id, int):
+            raise ValueError("cursor of another sort")
+        if value is not None and sort in ('start_date', 'end_date'):
+            value = date.fromisoformat(value)
+        elif value is not None and not isinstance(value, str if sort == 'name' else int):
+            raise ValueError("bad keyset value")
+    except (ValueError, TypeError):
+        api.abort(status.HTTP_400_BAD_REQUEST, "Bad query argument for cursor")
+    return value, last_id
+
+
+def next_page_link(cursor):
+    """ Returns the Link header value of the next page of the current listing """
+    args = request.args.to_dict(flat=False)
+    args['cursor'] = [cursor]
+    return f'<{request.base_url}?{urlencode(args, doseq=True)}>; rel="next"'
+
+
+def parse_date_range_args(args):
     """
-    Checks to see if two Promotions are duplicates.
-    Promotions are defined to be duplicates if they have the same
-    name and type.
+    Parses the date range query arguments into keyword arguments
+    for Promotion.find_by_date_range, aborting with 400 on bad dates
     """
-    if (p1.name == p2.name) and (p1.type == p2.type):
-        return True
-    return False
+    date_range = {}
+    try:
+        for key in DATE_RANGE_ARGS:
+            if args.get(key):
+                date_range[key] = date.fromisoformat(args[key])
+        if args.get('overlaps'):
+            from_date, to_date = args['overlaps'].split(',')
+            date_range['overlaps'] = (date.fromisoformat(from_date), date.fromisoformat(to_date))
+            if date_range['overlaps'][0] > date_range['overlaps'][1]:
+                raise ValueError
+    except ValueError:
+        api.abort(status.HTTP_400_BAD_REQUEST, "Bad query argument for date range")
+    return date_range
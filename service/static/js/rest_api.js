@@ -13,6 +13,7 @@ $(function () {
         $("#promotion_customer").val(res.customer);
         $("#promotion_start_date").val(res.start_date);
         $("#promotion_end_date").val(res.end_date);
+        $("#promotion_version").val(res.version);
     }
 
     /// Clears all form fields
@@ -23,6 +24,71 @@ $(function () {
         $("#promotion_customer").val("");
         $("#promotion_start_date").val("");
         $("#promotion_end_date").val("");
+        $("#promotion_version").val("");
+    }
+
+    // Returns the If-Match header for the version of the Promotion in the form
+    function if_match_header() {
+        let version = $("#promotion_version").val();
+        return version ? {"If-Match": `"${version}"`} : {};
+    }
+
+    // Builds the listing query string from the form fields
+    function build_query_string() {
+        let name = $("#promotion_name").val();
+        let type = $("#promotion_type").val();
+        let discount = $("#promotion_discount").val();
+        let customer = $("#promotion_customer").val();
+        let start_date = $("#promotion_start_date").val();
+        let end_date = $("#promotion_end_date").val();
+
+        let queryString = ""
+
+        if (name) {
+            queryString += 'name=' + name
+        }
+
+        if (type) {
+            if (queryString.length > 0) {
+                queryString += '&type=' + type
+            } else {
+                queryString += 'type=' + type
+            }
+        }
+
+        if (discount) {
+            if (queryString.length > 0) {
+                queryString += '&discount=' + discount
+            } else {
+                queryString += 'discount=' + discount
+            }
+        }
+
+        if (customer) {
+            if (queryString.length > 0) {
+                queryString += '&customer=' + customer
+            } else {
+                queryString += 'customer=' + customer
+            }
+        }
+
+        if (start_date) {
+            if (queryString.length > 0) {
+                queryString += '&start_date=' + start_date
+            } else {
+                queryString += 'start_date=' + start_date
+            }
+        }
+
+        if (end_date) {
+            if (queryString.length > 0) {
+                queryString += '&end_date=' + end_date
+            } else {
+                queryString += 'end_date=' + end_date
+            }
+        }
+
+        return queryString
     }
 
     // Updates the flash message area
@@ -102,6 +168,7 @@ $(function () {
             type: "PUT",
             url: `/api/promotions/${promotion_id}`,
             contentType: "application/json",
+            headers: if_match_header(),
             data: JSON.stringify(data)
         })
 
@@ -158,6 +225,7 @@ $(function () {
             type: "PUT",
             url: `/api/promotions/${promotion_id}/cancel`,
             contentType: "application/json",
+            headers: if_match_header(),
             data: ''
         })
 
@@ -215,58 +283,7 @@ $(function () {
 
     $("#search-btn").click(function () {
 
-        let name = $("#promotion_name").val();
-        let type = $("#promotion_type").val();
-        let discount = $("#promotion_discount").val();
-        let customer = $("#promotion_customer").val();
-        let start_date = $("#promotion_start_date").val();
-        let end_date = $("#promotion_end_date").val();
-
-        let queryString = ""
-
-        if (name) {
-            queryString += 'name=' + name
-        }
-
-        if (type) {
-            if (queryString.length > 0) {
-                queryString += '&type=' + type
-            } else {
-                queryString += 'type=' + type
-            }
-        }
-
-        if (discount) {
-            if (queryString.length > 0) {
-                queryString += '&discount=' + discount
-            } else {
-                queryString += 'discount=' + discount
-            }
-        }
-
-        if (customer) {
-            if (queryString.length > 0) {
-                queryString += '&customer=' + customer
-            } else {
-                queryString += 'customer=' + customer
-            }
-        }
-
-        if (start_date) {
-            if (queryString.length > 0) {
-                queryString += '&start_date=' + start_date
-            } else {
-                queryString += 'start_date=' + start_date
-            }
-        }
-
-        if (end_date) {
-            if (queryString.length > 0) {
-                queryString += '&end_date=' + end_date
-            } else {
-                queryString += 'end_date=' + end_date
-            }
-        }
+        let queryString = build_query_string()
 
         $("#flash_message").empty();
 
@@ -315,6 +332,60 @@ $(function () {
 
     });
 
+    // ****************************************
+    // Count matching Promotions
+    // ****************************************
+
+    $("#count-btn").click(function () {
+
+        let queryString = build_query_string()
+
+        $("#flash_message").empty();
+
+        // HEAD only returns the X-Total-Count header, not the promotions
+        let ajax = $.ajax({
+            type: "HEAD",
+            url: `/api/promotions?${queryString}`,
+        })
+
+        ajax.done(function (res, textStatus, xhr) {
+            flash_message(`${xhr.getResponseHeader("X-Total-Count")} promotions found`)
+        });
+
+        ajax.fail(function (res) {
+            flash_message("0 promotions found")
+        });
+
+    });
+
+    // ****************************************
+    // Suggest Promotion names while typing
+    // ****************************************
+
+    $("#promotion_name").on("input", function () {
+
+        let prefix = $("#promotion_name").val();
+        let suggestions = $("#promotion_name_suggestions");
+        if (!prefix) {
+            suggestions.empty();
+            return;
+        }
+
+        let ajax = $.ajax({
+            type: "GET",
+            url: `/api/promotions/suggest?prefix=${encodeURIComponent(prefix)}&limit=10`,
+            contentType: "application/json",
+        })
+
+        ajax.done(function (res) {
+            suggestions.empty();
+            for (let promo of res) {
+                suggestions.append($("<option>").val(promo.name));
+            }
+        });
+
+    });
+
     // clear the selected type so that search can return all promotions
     clear_form_data();
 
@@ -0,0 +1,136 @@
+"""
+Admission Control
+
+Limits how many requests of each route class (reads, writes, bulk) a
+worker runs at once, with a bounded wait queue in front of each limit.
+Requests that cannot get a slot fail fast with 429 or 503 and a
+Retry-After header instead of piling up behind the database pool.
+"""
+import threading
+from flask import g, jsonify, request
+from . import metrics, status
+
+ROUTE_CLASSES = ("reads", "writes", "bulk")
+
+metrics.describe("promotions_admission_in_flight", "gauge",
+                 "Requests currently holding an admission slot")
+metrics.describe("promotions_admission_queue_depth", "gauge",
+                 "Requests waiting for an admission slot")
+metrics.describe("promotions_admission_rejected_total", "counter",
+                 "Requests rejected by admission control")
+
+
+class AdmissionRejected(Exception):
+    """ Raised when a request cannot be admitted """
+
+    def __init__(self, status_code, reason):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
+class AdmissionLimiter:
+    """
+    Concurrency limit with a bounded wait queue for one route class
+
+    Args:
+        name (str): the route class, used as the metrics label
+        limit (int): how many requests may run at once
+        max_queue (int): how many requests may wait for a slot
+        timeout (float): how many seconds a request may wait for a slot
+    """
+
+    def __init__(self, name, limit, max_queue, timeout):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """ Takes a slot, waiting in the queue if needed; raises AdmissionRejected """
+        with self._condition:
+            if self.active >= self.limit:
+                if self.waiting >= self.max_queue:
+                    self._reject(status.HTTP_429_TOO_MANY_REQUESTS, "queue_full")
+                self.waiting += 1
+                self._publish()
+                try:
+                    admitted = self._condition.wait_for(lambda: self.active < self.limit, self.timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    self._publish()
+                    self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, "queue_timeout")
+            self.active += 1
+            self._publish()
+
+    def release(self):
+        """ Gives a slot back and wakes the next waiting request """
+        with self._condition:
+            self.active -= 1
+            self._publish()
+            self._condition.notify()
+
+    def _reject(self, status_code, reason):
+        metrics.inc("promotions_admission_rejected_total", route_class=self.name, reason=reason)
+        raise AdmissionRejected(status_code, reason)
+
+    def _publish(self):
+        metrics.set_gauge("promotions_admission_in_flight", self.active, route_class=self.name)
+        metrics.set_gauge("promotions_admission_queue_depth", self.waiting, route_class=self.name)
+
+
+def init_admission(app, classify):
+    """
+    Installs admission control on the Flask app
+
+    Args:
+        app (Flask): the application
+        classify (callable): maps a request to "reads", "writes", "bulk",
+            or None for requests that are never limited (probes, static files)
+    """
+    if not app.config.get("ADMISSION_CONTROL"):
+        app.logger.info("Admission control disabled")
+        return
+    limiters = {
+        name: AdmissionLimiter(
+            name,
+            app.config[f"ADMISSION_{name.upper()}_LIMIT"],
+            app.config[f"ADMISSION_{name.upper()}_QUEUE"],
+            app.config["ADMISSION_QUEUE_TIMEOUT"],
+        )
+        for name in ROUTE_CLASSES
+    }
+    app.extensions["admission"] = limiters
+
+    @app.before_request
+    def admit_request():  # pylint: disable=unused-variable
+        route_class = classify(request)
+        if route_class is None:
+            return None
+        limiter = limiters[route_class]
+        try:
+            limiter.acquire()
+        except AdmissionRejected as error:
+            app.logger.warning("Rejected %s %s: %s", request.method, request.path, error.reason)
+            response = jsonify(
+                status_code=error.status_code,
+                error="Too Many Requests" if error.status_code == 429 else "Service Unavailable",
+                message=f"Server is busy ({route_class}: {error.reason}), retry later",
+            )
+            response.status_code = error.status_code
+            response.headers["Retry-After"] = str(app.config["ADMISSION_RETRY_AFTER"])
+            return response
+        g.admission_limiter = limiter
+        return None
+
+    @app.teardown_request
+    def release_request(_exc):  # pylint: disable=unused-variable
+        limiter = g.pop("admission_limiter", None)
+        if limiter is not None:
+            limiter.release()
+
+    app.logger.info("Admission control enabled")
@@ -0,0 +1,51 @@
+"""
+Bloom Filter
+
+A compact set membership filter: `key in bloom` is never False for an
+added key, and True for a key that was not added only with about the
+error rate it was sized for. Keys cannot be removed; rebuild the filter
+to forget them.
+"""
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Bloom filter over a bit array
+
+    Args:
+        capacity (int): the number of keys it is sized for
+        error_rate (float): the false positive rate wanted at capacity
+    """
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(1, capacity)
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing: two 64-bit halves of one digest give every position
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, key):
+        """ Adds a key """
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    @property
+    def size_bytes(self) -> int:
+        """ Size of the bit array """
+        return len(self._bits)
+
+    def expected_error_rate(self) -> float:
+        """ The false positive rate expected for the keys added so far """
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
@@ -0,0 +1,62 @@
+"""
+Response Compression
+
+Compresses response bodies above a size threshold with brotli or gzip,
+whichever the client accepts (brotli preferred when it is installed).
+A strong ETag gets the encoding as a suffix (``"3-gzip"``), so that each
+byte representation has its own validator.
+"""
+import gzip
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# content types that are already compressed
+SKIP_CONTENT_TYPES = ("image/", "application/gzip", "application/zip")
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """Compresses data with the named content encoding"""
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+
+def negotiate_encoding(accept_encodings):
+    """Returns the preferred content encoding the client accepts, or None"""
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return accept_encodings.best_match(offered)
+
+
+def init_compression(app):
+    """Registers the response compression hook on the Flask app"""
+    if not app.config.get("COMPRESSION"):
+        app.logger.info("Response compression disabled")
+        return
+
+    @app.after_request
+    def compress_response(response):  # pylint: disable=unused-variable
+        if (response.direct_passthrough
+                or not 200 <= response.status_code < 300
+                or response.status_code == 204
+                or "Content-Encoding" in response.headers
+                or (response.mimetype or "").startswith(SKIP_CONTENT_TYPES)):
+            return response
+        response.vary.add("Accept-Encoding")
+        if response.content_length is not None and response.content_length < app.config["COMPRESSION_MIN_SIZE"]:
+            return response
+        encoding = negotiate_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+        level = app.config["COMPRESSION_BROTLI_QUALITY" if encoding == "br" else "COMPRESSION_GZIP_LEVEL"]
+        response.set_data(compress(response.get_data(), encoding, level))
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(f"{etag}-{encoding}")
+        return response
+
+    app.logger.info("Response compression enabled")
@@ -0,0 +1,87 @@
+"""
+Read Replica Routing
+
+Sends the SELECTs of read-only requests to the read replicas configured
+in SQLALCHEMY_BINDS (keys starting with "replica"), round robin, while
+writes, flushes and read-your-writes follow-ups go to the primary.
+
+A successful write sets a short-lived cookie; requests that carry it
+keep reading from the primary for REPLICA_STICKINESS seconds so that
+clients see their own changes despite replication lag. Caches of
+query results must not serve a replica's results to those clients:
+they key them by read_bind() or keep replica reads out.
+"""
+import itertools
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+REPLICA_PREFIX = "replica"
+STICKY_COOKIE = "promotions_read_primary"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def read_bind():
+    """ Returns the replica bind key the SELECTs of this request go to, None for the primary """
+    return g.get("read_replica") if has_request_context() else None
+
+
+class RoutingSession(SignallingSession):
+    """ Session that binds the SELECTs of read-only requests to a replica """
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing
+                and getattr(clause, "is_select", False)
+                and has_request_context()
+                and g.get("read_replica")):
+            state = get_state(self.app)
+            return state.db.get_engine(self.app, bind=g.read_replica)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with read replica routing """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_binds(app) -> list:
+    """ Returns the bind keys of the configured read replicas """
+    binds = app.config.get("SQLALCHEMY_BINDS") or {}
+    return sorted(key for key in binds if key.startswith(REPLICA_PREFIX))
+
+
+def init_replica_routing(app, read_only_endpoints=()):
+    """
+    Installs read replica routing on the Flask app
+
+    Args:
+        app (Flask): the application
+        read_only_endpoints (iterable): endpoints that only read even
+            though their method is not a safe one (e.g. POST lookups)
+    """
+    rotations = {}
+
+    @app.before_request
+    def route_reads():  # pylint: disable=unused-variable
+        # g outlives the request when the app context was pushed up front
+        g.pop("read_replica", None)
+        binds = replica_binds(app)
+        if not binds or request.cookies.get(STICKY_COOKIE):
+            return
+        if request.method in SAFE_METHODS or request.endpoint in read_only_endpoints:
+            key = tuple(binds)
+            if key not in rotations:
+                rotations[key] = itertools.cycle(binds)
+            g.read_replica = next(rotations[key])
+
+    @app.after_request
+    def stick_to_primary(response):  # pylint: disable=unused-variable
+        if (replica_binds(app)
+                and request.method not in SAFE_METHODS
+                and request.endpoint not in read_only_endpoints
+                and response.status_code < 400):
+            response.set_cookie(STICKY_COOKIE, "1", max_age=app.config["REPLICA_STICKINESS"],
+                                httponly=True)
+        return response
@@ -21,8 +21,10 @@ Handles all of the HTTP Error Codes returning JSON messages
 """
 
 from service import app, api
-from service.models import DataValidationError
+from service.models import DataValidationError, VersionMismatchError
 from . import status
+from .jobs import JobQueueFull
+from .single_flight import SingleFlightTimeout
 
 ######################################################################
 # Special Error Handlers
@@ -37,3 +39,39 @@ def request_validation_error(error):
         'error': 'Bad Request',
         'message': message
     }, status.HTTP_400_BAD_REQUEST
+
+
+@api.errorhandler(VersionMismatchError)
+def version_mismatch_error(error):
+    """ Handles writes whose If-Match version is no longer current """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_412_PRECONDITION_FAILED,
+        'error': 'Precondition Failed',
+        'message': message
+    }, status.HTTP_412_PRECONDITION_FAILED
+
+
+@api.errorhandler(SingleFlightTimeout)
+def single_flight_timeout(error):
+    """ Handles reads that waited too long on a concurrent fetch """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': message
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': str(app.config["ADMISSION_RETRY_AFTER"])}
+
+
+@api.errorhandler(JobQueueFull)
+def job_queue_full(error):
+    """ Handles jobs submitted while the job queue is full """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': f"Too many jobs are pending ({message}), retry later"
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': str(app.config["ADMISSION_RETRY_AFTER"])}
@@ -0,0 +1,94 @@
+"""
+Group Commit
+
+Coalesces concurrent single-row writes into one transaction. The first
+writer to arrive becomes the leader of a batch: it waits up to the
+commit window (or until the batch is full) for other writers to join,
+then runs the whole batch through one call of the flush function and
+hands every writer its own result. Writers that arrive while a batch is
+being flushed, or once it is full, start the next one, so flushes
+pipeline and no batch exceeds its maximum size.
+
+If a batch fails, its rows are retried one transaction each so that a
+bad row only fails its own writer. Every writer returns only after its
+row is committed, so durability is the same as committing alone.
+"""
+import threading
+
+
+class _Pending:
+    """ A writer waiting for its batch """
+
+    __slots__ = ("values", "result", "error", "done")
+
+    def __init__(self, values):
+        self.values = values
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """
+    Batches concurrent writes
+
+    Args:
+        flush (callable): writes and commits a list of values in one
+            transaction, returning one result per value in order
+        window (float): seconds the leader waits for a batch to fill
+        max_batch (int): the most writes in one batch
+    """
+
+    def __init__(self, flush, window, max_batch):
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0  # flushed batches, for benchmarks and tests
+        self._batch = None  # the batch writers join, until it is full or being flushed
+        self._lock = threading.Lock()
+        self._full = threading.Condition(self._lock)
+
+    def submit(self, values):
+        """ Writes values as part of a batch; returns its result or raises its error """
+        pending = _Pending(values)
+        with self._lock:
+            leader = self._batch is None or len(self._batch) >= self.max_batch
+            if leader:
+                self._batch = []  # a full batch stays with its leader; start the next one
+            batch = self._batch
+            batch.append(pending)
+            if len(batch) >= self.max_batch:
+                self._full.notify_all()
+        if leader:
+            with self._lock:
+                self._full.wait_for(lambda: len(batch) >= self.max_batch, timeout=self.window)
+                if self._batch is batch:
+                    self._batch = None
+            self._flush(batch)
+        else:
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _flush(self, batch):
+        """ Flushes a batch, falling back to one transaction per write on failure """
+        try:
+            self.batches += 1
+            try:
+                results = self.flush([pending.values for pending in batch])
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception:  # pylint: disable=broad-except
+                if len(batch) == 1:
+                    raise
+                for pending in batch:
+                    try:
+                        pending.result = self.flush([pending.values])[0]
+                    except Exception as error:  # pylint: disable=broad-except
+                        pending.error = error
+        except Exception as error:  # pylint: disable=broad-except
+            batch[0].error = error
+        finally:
+            for pending in batch:
+                pending.done.set()
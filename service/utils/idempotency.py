@@ -0,0 +1,122 @@
+"""
+Idempotency Keys
+
+Lets clients safely retry a POST by sending an Idempotency-Key header.
+The first request with a key runs and its response is stored; any replay
+of the same key and body gets the stored response back without redoing
+the work. Replays that arrive while the first request is still running
+wait for it (coalesced on an in-process event, or by polling the table
+across workers) instead of racing it.
+"""
+import hashlib
+import itertools
+import json
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from flask_restx.utils import unpack
+from service.models import IdempotencyKey, db
+from . import status
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+POLL_INTERVAL = 0.05  # seconds between table polls for a key owned by another worker
+PRUNE_EVERY = 100  # claims between prunes of the key table
+
+_in_flight = {}  # key -> threading.Event set when this worker finishes the request
+_claims = itertools.count(1)
+
+
+def _error(status_code, error, message, headers=None):
+    return {"status_code": status_code, "error": error, "message": message}, status_code, headers or {}
+
+
+def _replay(stored):
+    headers = {REPLAYED_HEADER: "true"}
+    if stored.location:
+        headers["Location"] = stored.location
+    return json.loads(stored.body), stored.status_code, headers
+
+
+def _run(func, key, args, kwargs):
+    """Runs the request that owns key and stores its response"""
+    event = threading.Event()
+    _in_flight[key] = event
+    try:
+        data, code, headers = unpack(func(*args, **kwargs))
+        if code >= 500:
+            IdempotencyKey.release(key)
+        else:
+            IdempotencyKey.complete(key, code, json.dumps(data), headers.get("Location"))
+        return data, code, headers
+    except Exception:
+        db.session.rollback()
+        IdempotencyKey.release(key)
+        raise
+    finally:
+        _in_flight.pop(key, None)
+        event.set()
+
+
+def _stored_response(key, fingerprint):
+    """Returns the response stored for key, an error if it was used for another body, or None"""
+    stored = IdempotencyKey.lookup(key)
+    if stored is None:
+        return None
+    if stored.fingerprint != fingerprint:
+        return _error(status.HTTP_422_UNPROCESSABLE_ENTITY, "Unprocessable Entity",
+                      f"{HEADER} was already used for a different request")
+    if stored.status_code is None:
+        return None
+    current_app.logger.info("Replaying response for idempotency key %s", key)
+    return _replay(stored)
+
+
+def _claim(func, key, fingerprint, args, kwargs):
+    """Runs the request if it claims key, else waits for the owner's response"""
+    config = current_app.config
+    deadline = time.monotonic() + config["IDEMPOTENCY_WAIT"]
+    while True:
+        if IdempotencyKey.claim(key, fingerprint, config["IDEMPOTENCY_TTL"],
+                                config["IDEMPOTENCY_LOCK_TIMEOUT"]):
+            return _run(func, key, args, kwargs)
+        response = _stored_response(key, fingerprint)
+        if response is not None:
+            return response
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return _error(status.HTTP_409_CONFLICT, "Conflict",
+                          f"A request with this {HEADER} is still in progress",
+                          {"Retry-After": "1"})
+        # wait for the owner: on its event if it runs in this worker, else poll
+        event = _in_flight.get(key)
+        if event is not None:
+            event.wait(remaining)
+        else:
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+
+def idempotent(func):
+    """
+    Honours the Idempotency-Key header on a resource method
+
+    Must be the outermost decorator so that stored responses are replayed
+    exactly as they were sent. Failed requests (exceptions and 5xx) are
+    not stored, so they can be retried with the same key.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return func(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return _error(status.HTTP_400_BAD_REQUEST, "Bad Request",
+                          f"{HEADER} must be at most {MAX_KEY_LENGTH} characters")
+        config = current_app.config
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        if next(_claims) % PRUNE_EVERY == 0:
+            IdempotencyKey.prune(config["IDEMPOTENCY_TTL"], config["IDEMPOTENCY_MAX_KEYS"])
+        return _claim(func, key, fingerprint, args, kwargs)
+    return wrapper
@@ -0,0 +1,288 @@
+"""
+Background Jobs
+
+Runs bulk operations that outlast a request (imports, cancels and
+exports) on a bounded pool of JOB_WORKERS threads per worker process.
+Their state, progress and results live in the job table, so any worker
+can report on a job. At most JOB_QUEUE jobs wait for a thread; beyond
+that submissions are refused rather than queued without bound.
+
+Each job thread uses one database connection at a time and commits
+every JOB_BATCH_SIZE items, so the job threads hold at most JOB_WORKERS
+connections of the pool and never for long: keep JOB_WORKERS below
+SQLALCHEMY_POOL_SIZE so that interactive requests always find one.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from service.models import DataValidationError, Job, Promotion, db
+from . import metrics
+
+metrics.describe("promotions_jobs_total", "counter", "Finished jobs by kind and state")
+metrics.describe("promotions_jobs_pending", "gauge", "Jobs queued or running in this worker")
+
+# the items (promotions or ids) of one job, at most
+MAX_ITEMS = 10000
+
+# the range of an INTEGER column
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+class JobQueueFull(Exception):
+    """ Used when a job is submitted while JOB_QUEUE jobs are already waiting """
+
+
+def _batches(items, size):
+    for start in range(0, len(items), size):
+        yield start, items[start:start + size]
+
+
+class JobProgress:
+    """
+    What a job handler reports through: its progress, and its result as
+    it builds up, which is kept even if the job fails part way
+
+    Args:
+        job_id (int): the job being run
+        heartbeat (callable): called after each step of progress
+    """
+
+    def __init__(self, job_id, heartbeat=None):
+        self.job_id = job_id
+        self.result = {}
+        self.heartbeat = heartbeat
+
+    def advance(self, done, total=None):
+        """ Records that done items (of total, if it changed) are done """
+        values = {"done": done} if total is None else {"done": done, "total": total}
+        Job.mark(self.job_id, **values)
+        if self.heartbeat:
+            self.heartbeat()
+
+
+def check_promotion(promo):
+    """ Raises DataValidationError for the values of a Promotion its INSERT would reject """
+    length = Promotion.name.type.length
+    if not isinstance(promo.name, str) or not 0 < len(promo.name) <= length:
+        raise DataValidationError(f"Invalid Promotion: name must be 1 to {length} characters")
+    for field in ("discount", "customer"):
+        value = getattr(promo, field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int)
+                                  or not INT_MIN <= value <= INT_MAX):
+            raise DataValidationError(f"Invalid Promotion: {field} must be an integer")
+
+
+def _validate_rows(batch, start, seen, rejected) -> list:
+    """
+    Returns the (index, Promotion) pairs of the rows of a batch that the
+    create endpoint would accept, adding the others to rejected
+
+    Args:
+        seen (set): the (name, type) pairs of the rows of the job so far
+    """
+    valid = []
+    for index, data in enumerate(batch, start):
+        try:
+            promo = Promotion.deserialize_new(data)
+            check_promotion(promo)
+            if (promo.name, promo.type) in seen:
+                raise DataValidationError("Attempt to create duplicate Promotion")
+            seen.add((promo.name, promo.type))
+            valid.append((index, promo))
+        except (DataValidationError, ValueError) as error:
+            rejected.append({"index": index, "message": str(error)})
+    duplicates = Promotion.find_duplicates([promo for _, promo in valid])
+    for index, promo in valid:
+        if (promo.name, promo.type) in duplicates:
+            rejected.append({"index": index, "message": "Attempt to create duplicate Promotion"})
+    return [(index, promo) for index, promo in valid if (promo.name, promo.type) not in duplicates]
+
+
+def _insert_rows(valid, created, rejected):
+    """ Inserts the rows in one transaction, or one at a time if the database refuses that """
+    try:
+        created.extend(Promotion.create_many([promo for _, promo in valid]))
+    except SQLAlchemyError:
+        for index, promo in valid:
+            try:
+                created.extend(Promotion.create_many([promo]))
+            except SQLAlchemyError as error:
+                rejected.append({"index": index, "message": str(error.orig or error).strip()})
+
+
+def import_promotions(job, promotions, batch_size) -> dict:
+    """
+    Creates Promotions from their dictionaries, one transaction per batch,
+    rejecting the rows the create endpoint would refuse (invalid or
+    duplicate); a batch the database refuses is retried row by row
+    """
+    created, rejected = job.result.setdefault("created", []), job.result.setdefault("rejected", [])
+    seen = set()
+    for start, batch in _batches(promotions, batch_size):
+        valid = _validate_rows(batch, start, seen, rejected)
+        if valid:
+            _insert_rows(valid, created, rejected)
+        rejected.sort(key=lambda row: row["index"])
+        job.advance(start + len(batch))
+    return job.result
+
+
+def cancel_promotions(job, ids, batch_size) -> dict:
+    """ Cancels Promotions by id, whatever their version, one UPDATE per batch """
+    cancelled, not_found = job.result.setdefault("cancelled", []), job.result.setdefault("not_found", [])
+    for start, batch in _batches(ids, batch_size):
+        found = {record.id for record in Promotion.cancel_many(batch)}
+        for promo_id in batch:
+            (cancelled if promo_id in found else not_found).append(promo_id)
+        job.advance(start + len(batch))
+    return job.result
+
+
+def export_promotions(job, items, batch_size) -> dict:  # pylint: disable=unused-argument
+    """
+    Reads every Promotion, a keyset page at a time, storing each page with
+    the job rather than holding them all; GET /jobs/{id}/result pages them
+    """
+    exported = job.result.setdefault("exported", 0)
+    pages = job.result.setdefault("pages", 0)
+    after = None
+    while True:
+        page = Promotion.find_matching_any([], after=after, limit=batch_size)
+        if page or not pages:  # an empty export still has its (empty) first page
+            Job.add_page(job.job_id, pages, [promo.serialize() for promo in page])
+            pages += 1
+            exported += len(page)
+            job.result.update(pages=pages, exported=exported)
+        if len(page) < batch_size:
+            # Promotions may have come and gone since the job was counted
+            job.advance(exported, total=exported)
+            return job.result
+        job.advance(exported)
+        after = (page[-1].id, page[-1].id)  # the (sort value, id) keyset of the id order
+
+
+# kind -> (handler, the request body key holding its items or None)
+KINDS = {
+    "import": (import_promotions, "promotions"),
+    "cancel": (cancel_promotions, "ids"),
+    "export": (export_promotions, None),
+}
+
+
+def parse_job(data):
+    """
+    Validates a job request into (kind, items), raising DataValidationError
+    unless it names a known kind with its list of up to MAX_ITEMS items
+    """
+    if not isinstance(data, dict) or data.get("kind") not in KINDS:
+        raise DataValidationError("Invalid job: kind must be one of {}".format(", ".join(KINDS)))
+    kind = data["kind"]
+    key = KINDS[kind][1]
+    if key is None:
+        return kind, []
+    items = data.get(key)
+    if not isinstance(items, list) or not 0 < len(items) <= MAX_ITEMS:
+        raise DataValidationError(f"Invalid {kind} job: {key} must be a list of 1 to {MAX_ITEMS} items")
+    if kind == "cancel" and not all(isinstance(item, int) and not isinstance(item, bool) for item in items):
+        raise DataValidationError("Invalid cancel job: ids must be integers")
+    return kind, items
+
+
+class JobRunner:
+    """
+    Bounded pool of job threads
+
+    Args:
+        app (Flask): the application the jobs run in
+        workers (int): the most jobs running at once
+        queue (int): the most jobs waiting for a thread
+    """
+
+    def __init__(self, app, workers, queue):
+        self.app = app
+        self.capacity = workers + queue
+        self.pending = 0
+        self._queued = set()  # ids of the jobs waiting for a thread
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+
+    def submit(self, kind, items) -> Job:
+        """ Records a job and queues it; raises JobQueueFull when the queue is full """
+        with self._lock:
+            if self.pending >= self.capacity:
+                raise JobQueueFull(f"{self.pending} jobs are already pending")
+            self.pending += 1
+            metrics.set_gauge("promotions_jobs_pending", self.pending)
+        try:
+            total = len(items) if kind != "export" else Promotion.count_matching_any([])
+            job = Job.submit(kind, total)
+            with self._lock:
+                self._queued.add(job.id)
+            self._executor.submit(self._run, job.id, kind, items)
+        except Exception:
+            self._finished()
+            raise
+        return job
+
+    def _finished(self):
+        with self._lock:
+            self.pending -= 1
+            metrics.set_gauge("promotions_jobs_pending", self.pending)
+
+    def _heartbeat(self):
+        """ Keeps the jobs queued behind a running one from looking abandoned """
+        with self._lock:
+            queued = list(self._queued)
+        if queued:
+            Job.touch(queued)
+
+    def _run(self, job_id, kind, items):
+        """ Runs a job in a thread of the pool and records its outcome """
+        handler = KINDS[kind][0]
+        progress = JobProgress(job_id, self._heartbeat)
+        with self._lock:
+            self._queued.discard(job_id)
+        with self.app.app_context():
+            try:
+                if not Job.start(job_id):
+                    self.app.logger.warning("Job %s is no longer queued, skipping it", job_id)
+                    return
+                result = handler(progress, items, self.app.config["JOB_BATCH_SIZE"])
+                Job.mark(job_id, state="succeeded", result=result)
+                metrics.inc("promotions_jobs_total", kind=kind, state="succeeded")
+            except Exception as error:  # pylint: disable=broad-except
+                self.app.logger.exception("Job %s failed", job_id)
+                db.session.rollback()
+                # what was done before the failure is committed: report it
+                Job.mark(job_id, state="failed", error=str(error), result=progress.result or None)
+                metrics.inc("promotions_jobs_total", kind=kind, state="failed")
+            finally:
+                db.session.remove()
+                self._finished()
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner() -> JobRunner:
+    """ Returns this worker's job runner, made on first use """
+    global _runner  # pylint: disable=global-statement
+    with _runner_lock:
+        if _runner is None:
+            config = current_app.config
+            if config["JOB_WORKERS"] >= config["SQLALCHEMY_POOL_SIZE"]:
+                current_app.logger.warning("JOB_WORKERS (%d) leaves no pooled connection for requests",
+                                           config["JOB_WORKERS"])
+            Job.fail_abandoned(config["JOB_ABANDONED_AFTER"])
+            _runner = JobRunner(current_app._get_current_object(),  # pylint: disable=protected-access
+                                config["JOB_WORKERS"], config["JOB_QUEUE"])
+    return _runner
+
+
+def submit(data) -> Job:
+    """ Validates a job request and queues the job """
+    kind, items = parse_job(data)
+    Job.prune(current_app.config["JOB_TTL"])
+    return get_runner().submit(kind, items)
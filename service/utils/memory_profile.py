@@ -0,0 +1,67 @@
+"""
+Per-Request Memory Profiling
+
+With MEMORY_PROFILE on, traces the Python allocations of the worker with
+tracemalloc and measures, for every request, the peak memory allocated
+above what was in use when the request started. Each worker reports:
+
+* the promotions_request_peak_bytes gauge: the largest peak per endpoint
+* the promotions_request_over_budget_total counter, and a warning log
+  line, for each request whose peak exceeds MEMORY_PROFILE_BUDGET bytes
+* every peak in a debug log line
+
+tracemalloc slows allocations down and its peak is per process, so with
+several threads per worker a request's peak includes what concurrent
+requests allocated. Turn it on for one worker (or pod) at a time while
+chasing memory growth, rather than everywhere; ``python -m
+benchmarks.endpoint_memory`` measures the same peaks offline.
+"""
+import tracemalloc
+from flask import g, request
+from . import metrics
+
+metrics.describe("promotions_request_peak_bytes", "gauge",
+                 "Largest Python memory allocated by one request, per endpoint (MEMORY_PROFILE)")
+metrics.describe("promotions_request_over_budget_total", "counter",
+                 "Requests that allocated more than MEMORY_PROFILE_BUDGET bytes, per endpoint")
+
+
+def request_peak(start) -> int:
+    """ Returns the peak traced memory above start bytes since the peak was last reset """
+    return max(tracemalloc.get_traced_memory()[1] - start, 0)
+
+
+def init_memory_profiling(app):
+    """Registers the per-request memory profiling hooks on the Flask app"""
+
+    @app.before_request
+    def start_profile():  # pylint: disable=unused-variable
+        if not app.config["MEMORY_PROFILE"]:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        g.memory_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    @app.teardown_request
+    def record_profile(_exc):  # pylint: disable=unused-variable
+        start = g.pop("memory_start", None)
+        if start is None or not tracemalloc.is_tracing():
+            return
+        peak = request_peak(start)
+        endpoint = request.endpoint or "unmatched"
+        if peak > metrics.get("promotions_request_peak_bytes", endpoint=endpoint):
+            metrics.set_gauge("promotions_request_peak_bytes", peak, endpoint=endpoint)
+        budget = app.config["MEMORY_PROFILE_BUDGET"]
+        if budget and peak > budget:
+            metrics.inc("promotions_request_over_budget_total", endpoint=endpoint)
+            app.logger.warning("%s %s allocated %d KiB at its peak, over the %d KiB budget",
+                               request.method, request.full_path.rstrip("?"), peak // 1024, budget // 1024)
+        else:
+            app.logger.debug("%s %s allocated %d KiB at its peak",
+                             request.method, request.full_path.rstrip("?"), peak // 1024)
+
+    if app.config["MEMORY_PROFILE"]:
+        tracemalloc.start()
+        app.logger.info("Per-request memory profiling enabled (budget %d KiB)",
+                        app.config["MEMORY_PROFILE_BUDGET"] // 1024)
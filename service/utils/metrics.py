@@ -0,0 +1,53 @@
+"""
+Metrics
+
+A minimal in-process registry of counters and gauges that the /metrics
+route exposes in the Prometheus text format. Values are per worker
+process; Prometheus aggregates them across the pods and workers it scrapes.
+"""
+import threading
+
+_lock = threading.Lock()
+_metrics = {}  # name -> (type, help)
+_values = {}  # (name, labels) -> value
+
+
+def describe(name: str, metric_type: str, help_text: str):
+    """Registers the type ("counter" or "gauge") and help text of a metric"""
+    _metrics[name] = (metric_type, help_text)
+
+
+def inc(name: str, amount=1, **labels):
+    """Increments a counter (or gauge) by amount"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+def set_gauge(name: str, value, **labels):
+    """Sets a gauge to value"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = value
+
+
+def get(name: str, **labels):
+    """Returns the current value of a metric, 0 if it was never set"""
+    return _values.get((name, tuple(sorted(labels.items()))), 0)
+
+
+def render() -> str:
+    """Renders every metric in the Prometheus text exposition format"""
+    with _lock:
+        values = sorted(_values.items())
+    lines = []
+    described = set()
+    for (name, labels), value in values:
+        if name not in described and name in _metrics:
+            metric_type, help_text = _metrics[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            described.add(name)
+        label_text = ",".join(f'{key}="{val}"' for key, val in labels)
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,98 @@
+"""
+Fuzzy Name Search
+
+Ranks Promotions by the trigram similarity of their name to a search
+text. Databases with pg_trgm answer the search themselves from a GIN
+trigram index; anywhere else (SQLite, Postgres without the extension)
+a per-worker TrigramIndex finds the candidates, built lazily, kept
+current by the model's write notifications and rebuilt every
+SEARCH_INDEX_REFRESH seconds to pick up writes made by other workers.
+"""
+import threading
+import time
+from flask import current_app
+from service.models import Promotion, on_write
+from . import metrics
+from .trigram_index import TrigramIndex
+
+metrics.describe("promotions_search_queries_total", "counter",
+                 "Fuzzy name searches by the backend that served them")
+
+_index = None
+_built_at = 0.0
+_build_lock = threading.Lock()
+
+
+def reset():
+    """ Drops the index so that the next search rebuilds it """
+    global _index  # pylint: disable=global-statement
+    with _build_lock:
+        _index = None
+
+
+def _current_index():
+    """ Returns the index, (re)building it when missing or stale """
+    global _index, _built_at  # pylint: disable=global-statement
+    refresh = current_app.config["SEARCH_INDEX_REFRESH"]
+    if _index is not None and time.monotonic() - _built_at < refresh:
+        return _index
+    with _build_lock:
+        if _index is None or time.monotonic() - _built_at >= refresh:
+            index = TrigramIndex()
+            index.build(Promotion.all_names())
+            _index, _built_at = index, time.monotonic()
+    return _index
+
+
+def warm():
+    """ Builds the index ahead of the first search, unless pg_trgm serves searches """
+    if not Promotion.has_trigram_search():
+        _current_index()
+
+
+def search(text, limit, queries=(), fields=None) -> list:
+    """
+    Returns up to limit (PromotionRecord, score) pairs for the Promotions
+    whose name is most similar to text, best first
+
+    Args:
+        text (string): the search text
+        limit (int): the maximum number of results
+        queries (list): finder queries to OR together to narrow the search
+        fields (list): only select these columns (the id is always selected)
+    """
+    threshold = current_app.config["SEARCH_SIMILARITY_THRESHOLD"]
+    if Promotion.has_trigram_search():
+        metrics.inc("promotions_search_queries_total", backend="pg_trgm")
+        return Promotion.search_by_similarity(text, limit, threshold, queries, fields)
+    metrics.inc("promotions_search_queries_total", backend="index")
+    # with filters every candidate is loaded, as any of them may be filtered out
+    scored = _current_index().search(text, threshold, None if queries else limit)
+    if not scored:
+        return []
+    records = {record.id: record
+               for record in Promotion.find_records_by_ids([promo_id for promo_id, _ in scored],
+                                                           queries, fields)}
+    return [(records[promo_id], score) for promo_id, score in scored if promo_id in records][:limit]
+
+
+def count(text, queries=()) -> int:
+    """ Returns the number of Promotions whose name is similar enough to text, narrowed by queries """
+    threshold = current_app.config["SEARCH_SIMILARITY_THRESHOLD"]
+    if Promotion.has_trigram_search():
+        return Promotion.count_by_similarity(text, threshold, queries)
+    scored = _current_index().search(text, threshold)
+    if not scored or not queries:
+        return len(scored)
+    return len(Promotion.find_records_by_ids([promo_id for promo_id, _ in scored], queries, ["id"]))
+
+
+@on_write
+def _track_write(promo_id, record):
+    index = _index
+    if index is None:
+        return
+    if record is None or record.name is None:
+        index.remove(promo_id)
+    else:
+        index.add(promo_id, record.name)
@@ -0,0 +1,110 @@
+"""
+Prefix Index
+
+An in-memory, case-insensitive prefix index over names, kept as a sorted
+array of (folded name, id) pairs searched with bisect. Lookups cost
+O(log n + limit); inserts and removals shift the array, which is cheap
+at the size of a promotion catalog.
+"""
+import sys
+import threading
+from bisect import bisect_left, insort
+
+# approximate per-entry overhead besides the strings themselves:
+# the key tuple, its list slot and the id -> name dict entry
+ENTRY_OVERHEAD = sys.getsizeof((None, None)) + 8 + 104
+
+
+class PrefixIndex:
+    """
+    Sorted array prefix index with a memory budget
+
+    Args:
+        max_bytes (int): approximate memory budget; an index that would
+            exceed it disables itself (enabled becomes False) so callers
+            can fall back to the database
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.enabled = False
+        self.size_bytes = 0
+        self._keys = []  # sorted (folded name, id)
+        self._names = {}  # id -> name
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _cost(name, folded):
+        cost = ENTRY_OVERHEAD + sys.getsizeof(name)
+        return cost if folded is name else cost + sys.getsizeof(folded)
+
+    def build(self, items):
+        """ Replaces the contents with an iterable of (id, name) pairs """
+        keys, names, size = [], {}, 0
+        for item_id, name in items:
+            if name is None:
+                continue
+            folded = name.casefold()
+            keys.append((folded, item_id))
+            names[item_id] = name
+            size += self._cost(name, folded)
+            if size > self.max_bytes:
+                with self._lock:
+                    self._keys, self._names, self.size_bytes = [], {}, 0
+                    self.enabled = False
+                return False
+        keys.sort()
+        with self._lock:
+            self._keys, self._names, self.size_bytes = keys, names, size
+            self.enabled = True
+        return True
+
+    def add(self, item_id, name):
+        """ Adds or renames an item """
+        with self._lock:
+            if not self.enabled:
+                return
+            self._remove(item_id)
+            if name is None:
+                return
+            folded = name.casefold()
+            self.size_bytes += self._cost(name, folded)
+            if self.size_bytes > self.max_bytes:
+                self._keys, self._names, self.size_bytes = [], {}, 0
+                self.enabled = False
+                return
+            insort(self._keys, (folded, item_id))
+            self._names[item_id] = name
+
+    def remove(self, item_id):
+        """ Removes an item if it is indexed """
+        with self._lock:
+            self._remove(item_id)
+
+    def _remove(self, item_id):
+        name = self._names.pop(item_id, None)
+        if name is None:
+            return
+        folded = name.casefold()
+        position = bisect_left(self._keys, (folded, item_id))
+        if position < len(self._keys) and self._keys[position] == (folded, item_id):
+            del self._keys[position]
+            self.size_bytes -= self._cost(name, folded)
+
+    def search(self, prefix, limit):
+        """ Returns up to limit (id, name) pairs whose name starts with prefix """
+        folded = prefix.casefold()
+        results = []
+        with self._lock:
+            keys = self._keys
+            position = bisect_left(keys, (folded,))
+            while position < len(keys) and len(results) < limit:
+                key, item_id = keys[position]
+                if not key.startswith(folded):
+                    break
+                results.append((item_id, self._names[item_id]))
+                position += 1
+        return results
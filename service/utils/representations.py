@@ -0,0 +1,60 @@
+"""
+Representations
+
+Compact alternatives to JSON for the API, negotiated through the Accept
+header: MessagePack (application/msgpack) and CSV (text/csv). Both are
+encoded straight from the marshalled resource data without going through
+an intermediate JSON string.
+"""
+import csv
+import io
+from flask import make_response
+from service import api
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+MSGPACK_MEDIATYPE = "application/msgpack"
+CSV_MEDIATYPE = "text/csv"
+
+
+def encode_msgpack(data) -> bytes:
+    """Encodes marshalled resource data as MessagePack"""
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def encode_csv(data) -> str:
+    """
+    Encodes marshalled resource data as CSV with a header row
+
+    A single resource becomes a one row table
+    """
+    rows = data if isinstance(data, list) else [data]
+    buffer = io.StringIO()
+    if rows and isinstance(rows[0], dict):
+        writer = csv.DictWriter(buffer, fieldnames=list(rows[0].keys()), lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerows([row] for row in rows)
+    return buffer.getvalue()
+
+
+if msgpack is not None:
+    @api.representation(MSGPACK_MEDIATYPE)
+    def output_msgpack(data, code, headers=None):
+        """Makes a MessagePack response"""
+        resp = make_response(encode_msgpack(data), code)
+        resp.headers.extend(headers or {})
+        return resp
+
+
+@api.representation(CSV_MEDIATYPE)
+def output_csv(data, code, headers=None):
+    """Makes a CSV response"""
+    resp = make_response(encode_csv(data), code)
+    resp.headers.extend(headers or {})
+    return resp
@@ -0,0 +1,209 @@
+"""
+Listing Result Cache
+
+Caches the marshalled responses of filtered listings, keyed by the
+normalized query arguments and the database (primary or replica) they
+were read from, in a per-worker LRU bounded by RESULT_CACHE_MAX_BYTES,
+so that a lagging replica's results never reach the requests that read
+their own writes from the primary.
+
+Entries are stamped with the write generation, a database sequence
+that every worker of every pod bumps once after each transaction that
+writes promotions, so a write anywhere invalidates every entry at once
+without touching them. A worker reads the sequence at most every
+RESULT_CACHE_GENERATION_TTL seconds, which bounds how long it serves a
+result from before another worker's write. It also counts its own
+writes, which keeps its entries correct at once, and if a bump fails;
+RESULT_CACHE_MAX_AGE then bounds the staleness for the other workers. With
+SINGLE_FLIGHT on, concurrent misses of the same listing at the same
+generation share one query.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+from flask_restx.utils import unpack
+from service.models import Promotion, on_write, reads_write_generation
+from . import metrics
+from .db_routing import read_bind
+from .single_flight import SingleFlight
+
+metrics.describe("promotions_result_cache_requests_total", "counter",
+                 "Listing result cache lookups by result (hit or miss)")
+metrics.describe("promotions_result_cache_hit_ratio", "gauge",
+                 "Share of listing result cache lookups that were hits")
+metrics.describe("promotions_result_cache_bytes", "gauge",
+                 "Approximate memory used by the listing result cache")
+metrics.describe("promotions_result_cache_evictions_total", "counter",
+                 "Listing results evicted to stay within the byte budget")
+
+
+def approximate_size(value) -> int:
+    """ Returns the approximate deep size in bytes of a JSON-like value """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(key) + approximate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approximate_size(item) for item in value)
+    return size
+
+
+class ResultCache:
+    """
+    LRU cache of values stamped with a generation
+
+    Args:
+        max_bytes (int): the budget for the approximate size of the values
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (generation, stored at, value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, generation, max_age):
+        """ Returns the value cached for key at generation, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] != generation or time.monotonic() - entry[1] > max_age):
+                self._discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def peek(self, key):
+        """ Returns the (generation, stored at, value) entry for key, however old, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[:3]
+
+    def put(self, key, generation, value):
+        """ Caches value for key at generation, evicting the least recently used entries """
+        size = approximate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (generation, time.monotonic(), value, size)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                metrics.inc("promotions_result_cache_evictions_total")
+
+    def clear(self):
+        """ Drops every entry """
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[3]
+
+    def hit_ratio(self) -> float:
+        """ Share of lookups that were hits """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+_generation = 0
+_generation_lock = threading.Lock()
+_shared_generation = (0, float("-inf"))  # (database-wide write generation, monotonic time read)
+_cache = None
+_flights = SingleFlight("listing")
+
+
+def generation():
+    """
+    Returns the current write generation: this worker's, and the database-wide
+    one as read at most RESULT_CACHE_GENERATION_TTL seconds ago
+    """
+    global _shared_generation  # pylint: disable=global-statement
+    value, read_at = _shared_generation
+    now = time.monotonic()
+    if now - read_at > current_app.config["RESULT_CACHE_GENERATION_TTL"]:
+        value = Promotion.write_generation()
+        _shared_generation = (value, now)
+    return _generation, value
+
+
+def invalidate():
+    """ Bumps this worker's write generation, invalidating every result it cached """
+    global _generation  # pylint: disable=global-statement
+    with _generation_lock:
+        _generation += 1
+
+
+@reads_write_generation
+def _reads_generation(config) -> bool:
+    # the stale-while-revalidate cache stamps its entries with this generation too
+    return config["RESULT_CACHE"] or config["STALE_WHILE_REVALIDATE"]
+
+
+@on_write
+def _track_write(promo_id, record):  # pylint: disable=unused-argument
+    # the writer's transaction has bumped the database-wide generation for the other workers
+    invalidate()
+
+
+def get_cache() -> ResultCache:
+    """ Returns this worker's cache, made on first use """
+    global _cache  # pylint: disable=global-statement
+    if _cache is None:
+        _cache = ResultCache(current_app.config["RESULT_CACHE_MAX_BYTES"])
+    return _cache
+
+
+def cache_key(args) -> tuple:
+    """ Normalizes query arguments into a cache key: order and empty values do not matter """
+    return tuple(sorted((name, value) for name, values in args.lists()
+                        for value in values if value != ""))
+
+
+def cached(func):
+    """
+    Caches the responses of a listing by its query arguments
+
+    Place it above the marshalling decorator so that marshalled
+    responses are cached; errors raised by func are not cached.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        if not config["RESULT_CACHE"]:
+            return func(*args, **kwargs)
+        cache = get_cache()
+        # results read from a lagging replica are never served to read-your-writes requests
+        key = (read_bind(), cache_key(request.args))
+        current = generation()  # read before the query: a write during it makes the entry stale
+        response = cache.get(key, current, config["RESULT_CACHE_MAX_AGE"])
+        if response is not None:
+            metrics.inc("promotions_result_cache_requests_total", result="hit")
+        else:
+            metrics.inc("promotions_result_cache_requests_total", result="miss")
+            if config["SINGLE_FLIGHT"]:
+                response = _flights.do((key, current), lambda: unpack(func(*args, **kwargs)),
+                                       config["SINGLE_FLIGHT_TIMEOUT"])
+            else:
+                response = unpack(func(*args, **kwargs))
+            cache.put(key, current, response)
+        metrics.set_gauge("promotions_result_cache_hit_ratio", cache.hit_ratio())
+        metrics.set_gauge("promotions_result_cache_bytes", cache.size_bytes)
+        return response
+    return wrapper
@@ -0,0 +1,175 @@
+"""
+Shared Record Cache
+
+A cache of promotion records that every worker process on a host shares
+through one memory-mapped file, so the cache is warmed and held once
+rather than once per worker.
+
+The file is a small header followed by fixed-width slots, one record per
+slot, direct-mapped by id. Each slot starts with a sequence number that
+writers make odd while they rewrite the slot and even again afterwards
+(a seqlock): readers retry when the number is odd or changed under them,
+so they never see a torn record and never block. Writers serialize on a
+file lock. The header also holds a write generation that every write
+bumps, which lets other caches tell whether any worker wrote since they
+filled an entry.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+
+MAGIC = b"PROMOC01"
+HEADER = struct.Struct("<8sIIQ")  # magic, slot count, slot size, generation
+HEADER_SIZE = 64
+GENERATION = struct.Struct("<Q")
+GENERATION_OFFSET = 16
+SEQUENCE = struct.Struct("<I")
+NAME_BYTES = 64
+# sequence, version, id, customer, stored at, discount, start and end ordinals,
+# type, flags, name length, padding, name
+SLOT = struct.Struct(f"<IIqqdiiiBBBx{NAME_BYTES}s")
+HAS_DISCOUNT, HAS_CUSTOMER, HAS_NAME, HAS_TYPE = 1, 2, 4, 8
+READ_RETRIES = 100
+
+
+class SharedRecordCache:
+    """
+    Memory-mapped, seqlocked cache of promotion records
+
+    Records are tuples in PromotionRecord field order: (id, name, type,
+    discount, customer, start_date, end_date, version), with the type as
+    its int value. Names longer than NAME_BYTES of UTF-8 are not cached.
+
+    Args:
+        path (str): the file shared by the workers; created if missing
+        slots (int): the number of records the file holds
+    """
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()  # the file lock does not exclude threads of one process
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = HEADER_SIZE + slots * SLOT.size
+        with self._file_lock():
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            magic, file_slots, slot_size, _ = HEADER.unpack_from(self._map, 0)
+            if (magic, file_slots, slot_size) != (MAGIC, slots, SLOT.size):
+                self._map[:] = bytes(size)
+                HEADER.pack_into(self._map, 0, MAGIC, slots, SLOT.size, 1)
+
+    @contextmanager
+    def _file_lock(self):
+        """ Excludes the writers of every worker """
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _begin_write(self, offset) -> int:
+        """ Makes the slot's sequence odd and returns it """
+        sequence = (SEQUENCE.unpack_from(self._map, offset)[0] + 1) & 0xFFFFFFFF
+        SEQUENCE.pack_into(self._map, offset, sequence)
+        return sequence
+
+    def _end_write(self, offset, sequence):
+        SEQUENCE.pack_into(self._map, offset, (sequence + 1) & 0xFFFFFFFF)
+
+    def _offset(self, record_id):
+        return HEADER_SIZE + (record_id % self.slots) * SLOT.size
+
+    def generation(self) -> int:
+        """ Returns the write generation shared by all workers """
+        return GENERATION.unpack_from(self._map, GENERATION_OFFSET)[0]
+
+    def bump(self):
+        """ Bumps the shared write generation """
+        with self._file_lock():
+            GENERATION.pack_into(self._map, GENERATION_OFFSET, self.generation() + 1)
+
+    def get(self, record_id, max_age):
+        """ Returns the cached record with the id, or None """
+        offset = self._offset(record_id)
+        for _ in range(READ_RETRIES):
+            before = SEQUENCE.unpack_from(self._map, offset)[0]
+            if before & 1:
+                continue  # a writer is in the slot
+            fields = SLOT.unpack_from(self._map, offset)
+            if SEQUENCE.unpack_from(self._map, offset)[0] == before:
+                break
+        else:
+            return None
+        _, version, slot_id, customer, stored_at, discount, start, end, promo_type, flags, length, name = fields
+        if slot_id != record_id or time.time() - stored_at > max_age:
+            return None
+        return (slot_id,
+                name[:length].decode("utf-8") if flags & HAS_NAME else None,
+                promo_type if flags & HAS_TYPE else None,
+                discount if flags & HAS_DISCOUNT else None,
+                customer if flags & HAS_CUSTOMER else None,
+                date.fromordinal(start) if start else None,
+                date.fromordinal(end) if end else None,
+                version or None)
+
+    def put(self, record, generation=None) -> bool:
+        """
+        Caches a record, unless generation is given and a write happened
+        since (the record may be stale) or the slot holds a newer version
+        of it; returns whether it was cached
+        """
+        record_id, name, promo_type, discount, customer, start_date, end_date, version = record
+        encoded = name.encode("utf-8") if name is not None else b""
+        if len(encoded) > NAME_BYTES:
+            return False
+        flags = ((HAS_NAME if name is not None else 0) | (HAS_TYPE if promo_type is not None else 0)
+                 | (HAS_DISCOUNT if discount is not None else 0) | (HAS_CUSTOMER if customer is not None else 0))
+        offset = self._offset(record_id)
+        with self._file_lock():
+            if generation is not None and generation != self.generation():
+                return False
+            _, slot_version, slot_id = SLOT.unpack_from(self._map, offset)[:3]
+            if slot_id == record_id and version is not None and slot_version > version:
+                return False
+            sequence = self._begin_write(offset)
+            SLOT.pack_into(self._map, offset, sequence, version or 0, record_id,
+                           customer or 0, time.time(), discount or 0,
+                           start_date.toordinal() if start_date else 0,
+                           end_date.toordinal() if end_date else 0,
+                           promo_type or 0, flags, len(encoded), encoded)
+            self._end_write(offset, sequence)
+        return True
+
+    def remove(self, record_id):
+        """ Drops the record with the id if it is cached """
+        offset = self._offset(record_id)
+        with self._file_lock():
+            if SLOT.unpack_from(self._map, offset)[2] != record_id:
+                return
+            sequence = self._begin_write(offset)
+            SLOT.pack_into(self._map, offset, sequence, 0, 0, 0, 0.0, 0, 0, 0, 0, 0, 0, b"")
+            self._end_write(offset, sequence)
+
+    def clear(self):
+        """ Drops every record and bumps the generation """
+        with self._file_lock():
+            for slot in range(self.slots):
+                offset = HEADER_SIZE + slot * SLOT.size
+                sequence = self._begin_write(offset)
+                self._map[offset + SEQUENCE.size:offset + SLOT.size] = bytes(SLOT.size - SEQUENCE.size)
+                self._end_write(offset, sequence)
+            GENERATION.pack_into(self._map, GENERATION_OFFSET, self.generation() + 1)
+
+    def close(self):
+        """ Unmaps the file """
+        self._map.close()
+        os.close(self._fd)
@@ -0,0 +1,77 @@
+"""
+Single Flight
+
+Coalesces concurrent identical reads: the first caller for a key runs
+the fetch, and callers that arrive while it is in flight wait for its
+result (or its exception) instead of repeating it. Only results that
+are safe to share between threads, such as immutable records or
+marshalled responses, should go through it.
+"""
+import threading
+from . import metrics
+
+metrics.describe("promotions_single_flight_total", "counter",
+                 "Coalesced reads by role: leader (ran the fetch) or follower (shared its result)")
+
+
+class SingleFlightTimeout(TimeoutError):
+    """ Used when a follower waited too long for the fetch it joined """
+
+
+class _Call:
+    """ A fetch in flight """
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Per-key coalescing of concurrent calls
+
+    Args:
+        name (str): the label of its metrics
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fetch, timeout):
+        """
+        Returns fetch(), sharing one call among concurrent callers with the same key
+
+        Args:
+            key (hashable): identifies identical calls
+            fetch (callable): runs the read
+            timeout (float): seconds a follower waits for the leader before
+                raising SingleFlightTimeout
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if leader:
+            metrics.inc("promotions_single_flight_total", flight=self.name, role="leader")
+            try:
+                call.result = fetch()
+                return call.result
+            except Exception as error:
+                call.error = error
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        metrics.inc("promotions_single_flight_total", flight=self.name, role="follower")
+        if not call.done.wait(timeout):
+            raise SingleFlightTimeout(f"Timed out waiting for a concurrent {self.name} read")
+        if call.error is not None:
+            raise call.error
+        return call.result
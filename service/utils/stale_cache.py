@@ -0,0 +1,177 @@
+"""
+Stale-While-Revalidate
+
+Keeps the last good response of each read (single Promotions and
+listings) in a per-worker LRU bounded by STALE_CACHE_MAX_BYTES, so that
+reads keep being answered when the database is slow or down. With
+STALE_WHILE_REVALIDATE on, a read is served:
+
+* from a response younger than STALE_SOFT_TTL seconds, if no write
+  happened since, with an Age header;
+* from an older one, up to STALE_MAX_AGE seconds, if no write happened
+  since, at once and with a ``Warning: 110`` header, while a background
+  thread refreshes it (retrying with backoff to reconnect when the
+  database is down);
+* otherwise from the database, falling back to any response up to
+  STALE_MAX_AGE seconds old, written over or not, with a
+  ``Warning: 111`` header when the database fails.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from flask import current_app, request
+from flask_restx.utils import unpack
+from retry.api import retry_call
+from sqlalchemy.exc import SQLAlchemyError
+from service.models import db
+from . import metrics, result_cache, status
+from .db_routing import read_bind
+from .single_flight import SingleFlightTimeout
+
+STALE_WARNING = '110 - "Response is Stale"'
+REVALIDATION_FAILED_WARNING = '111 - "Revalidation Failed"'
+
+metrics.describe("promotions_stale_cache_requests_total", "counter",
+                 "Reads by how they were served: fresh, stale (refreshing) or fallback (database failed) "
+                 "from the stale cache, or miss")
+metrics.describe("promotions_stale_cache_refreshes_total", "counter",
+                 "Background refreshes of stale responses by result")
+
+_cache = None
+_executor = None
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def get_cache() -> result_cache.ResultCache:
+    """ Returns this worker's cache of last good responses, made on first use """
+    global _cache  # pylint: disable=global-statement
+    with _lock:
+        if _cache is None:
+            _cache = result_cache.ResultCache(current_app.config["STALE_CACHE_MAX_BYTES"])
+    return _cache
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor  # pylint: disable=global-statement
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(current_app.config["STALE_REFRESH_WORKERS"],
+                                           thread_name_prefix="stale-refresh")
+    return _executor
+
+
+def refreshing() -> bool:
+    """ Returns True while background refreshes are queued or running """
+    with _lock:
+        return bool(_refreshing)
+
+
+def _with_age(entry, warning=None):
+    """ Returns the cached response of entry with its Age (and Warning) headers """
+    _, stored_at, (data, code, headers) = entry
+    headers = dict(headers or {})
+    headers["Age"] = str(int(time.monotonic() - stored_at))
+    if warning:
+        headers["Warning"] = warning
+    return data, code, headers
+
+
+def _store(key, generation, response):
+    if response[1] == status.HTTP_200_OK:
+        get_cache().put(key, generation, response)
+
+
+def _fetch(func, args, kwargs):
+    try:
+        return unpack(func(*args, **kwargs))
+    except SQLAlchemyError:
+        db.session.remove()  # the next try checks out a new connection
+        raise
+
+
+def _refresh(app, key, query_string, func, args, kwargs):
+    """ Runs a read again outside of its request and stores its response """
+    config = app.config
+    try:
+        with app.test_request_context(key[0], query_string=query_string):
+            generation = result_cache.generation()
+            response = retry_call(_fetch, fargs=(func, args, kwargs), exceptions=SQLAlchemyError,
+                                  tries=config["STALE_REFRESH_TRIES"], delay=config["STALE_REFRESH_DELAY"],
+                                  backoff=2, logger=app.logger)
+            _store(key, generation, response)
+        metrics.inc("promotions_stale_cache_refreshes_total", result="success")
+    except Exception:  # pylint: disable=broad-except
+        app.logger.exception("Could not refresh %s", key[0])
+        metrics.inc("promotions_stale_cache_refreshes_total", result="failure")
+    finally:
+        db.session.remove()
+        with _lock:
+            _refreshing.discard(key)
+
+
+def _schedule_refresh(key, func, args, kwargs):
+    """ Refreshes the response for key in the background, unless that is already under way """
+    with _lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    _get_executor().submit(_refresh, current_app._get_current_object(),  # pylint: disable=protected-access
+                           key, request.query_string, func, args, kwargs)
+
+
+def _serve_current(entry, key, func, args, kwargs):
+    """
+    Returns the response of an entry of the current generation while it
+    is fresh, or stale but within STALE_MAX_AGE (refreshing it in the
+    background), else None
+    """
+    config = current_app.config
+    age = time.monotonic() - entry[1]
+    if age <= config["STALE_SOFT_TTL"]:
+        metrics.inc("promotions_stale_cache_requests_total", result="fresh")
+        return _with_age(entry)
+    if age <= config["STALE_MAX_AGE"]:
+        _schedule_refresh(key, func, args, kwargs)
+        metrics.inc("promotions_stale_cache_requests_total", result="stale")
+        return _with_age(entry, STALE_WARNING)
+    return None
+
+
+def stale_while_revalidate(func):
+    """
+    Serves a read from its last good response when that is fresh enough
+    or when the database fails
+
+    Place it above the other caching and marshalling decorators so that
+    it sees the errors of the whole read.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        if not config["STALE_WHILE_REVALIDATE"]:
+            return func(*args, **kwargs)
+        key = (request.path, read_bind(), result_cache.cache_key(request.args))
+        try:
+            # read before the query: a write during it makes the entry stale
+            generation = result_cache.generation()
+        except SQLAlchemyError:
+            generation = None  # the database is down: the read below fails over to the entry
+        entry = get_cache().peek(key)
+        if entry is not None and entry[0] == generation:
+            cached = _serve_current(entry, key, func, args, kwargs)
+            if cached is not None:
+                return cached
+        try:
+            response = unpack(func(*args, **kwargs))
+        except (SQLAlchemyError, SingleFlightTimeout) as error:
+            if entry is None or time.monotonic() - entry[1] > config["STALE_MAX_AGE"]:
+                raise
+            current_app.logger.warning("Serving a stale response for %s: %s", request.path, error)
+            metrics.inc("promotions_stale_cache_requests_total", result="fallback")
+            return _with_age(entry, REVALIDATION_FAILED_WARNING)
+        metrics.inc("promotions_stale_cache_requests_total", result="miss")
+        _store(key, generation, response)
+        return response
+    return wrapper
@@ -0,0 +1,186 @@
+"""
+Promotion Statistics
+
+Counts of the Promotions by type, by discount bucket and by status
+(active, upcoming, expired or cancelled), for dashboards. By default
+every request runs one grouped query. With STATS_SUMMARY on, a
+per-worker StatsSummary answers instead, in constant time: it is built
+on the first request, kept current by the model's write notifications,
+and rebuilt every STATS_SUMMARY_REFRESH seconds (to pick up writes made
+by other workers) and when the day changes (as statuses depend on it).
+Writes notified during a rebuild are replayed onto the new summary.
+A Promotion whose end date is its start date, as the cancel action
+leaves it, counts as cancelled, including one created that way.
+"""
+import math
+import threading
+import time
+from collections import Counter
+from datetime import date
+from flask import current_app
+from service.models import DISCOUNT_BUCKET_WIDTH, Promotion, PromoType, on_write
+from . import metrics
+
+STATUSES = ("active", "upcoming", "expired", "cancelled")
+
+metrics.describe("promotions_stats_requests_total", "counter",
+                 "Statistics requests by the source that served them (summary or query)")
+
+
+def discount_bucket(discount):
+    """ Returns the histogram bucket of a discount, rounded toward zero like the SQL query """
+    if discount is None:
+        return None
+    return discount - int(math.fmod(discount, DISCOUNT_BUCKET_WIDTH))
+
+
+def status_on(start_date, end_date, today) -> str:
+    """ Returns the status of a Promotion on a day, like the SQL query """
+    if end_date == start_date:
+        return "cancelled"
+    if end_date < today:
+        return "expired"
+    if start_date > today:
+        return "upcoming"
+    return "active"
+
+
+def summarize(groups, today) -> dict:
+    """ Folds (type, discount bucket, status, count) groups into the statistics response """
+    by_type = dict.fromkeys(PromoType.__members__, 0)
+    by_status = dict.fromkeys(STATUSES, 0)
+    by_discount = Counter()
+    total = 0
+    for promo_type, bucket, state, count in groups:
+        if not count:
+            continue
+        by_type[PromoType(promo_type).name] += count
+        by_status[state] += count
+        by_discount[bucket] += count
+        total += count
+    no_discount = by_discount.pop(None, 0)
+    return {
+        "as_of": today.isoformat(),
+        "total": total,
+        "by_type": by_type,
+        "by_status": by_status,
+        "by_discount": [{"min": bucket, "max": bucket + DISCOUNT_BUCKET_WIDTH - 1, "count": count}
+                        for bucket, count in sorted(by_discount.items())],
+        "no_discount": no_discount,
+    }
+
+
+class StatsSummary:
+    """
+    Incrementally maintained counts of the Promotions by type, discount
+    bucket and status on one day
+
+    Args:
+        today (date): the day the statuses are computed for
+    """
+
+    def __init__(self, today):
+        self.today = today
+        self._groups = Counter()  # (type, bucket, status) -> count
+        self._keys = {}  # promotion id -> its (type, bucket, status)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, promo_id, promo_type, discount, start_date, end_date):
+        """ Counts a Promotion, replacing what was counted for its id before """
+        key = (PromoType(promo_type).value, discount_bucket(discount), status_on(start_date, end_date, self.today))
+        with self._lock:
+            self._discard(promo_id)
+            self._keys[promo_id] = key
+            self._groups[key] += 1
+
+    def remove(self, promo_id):
+        """ Stops counting a Promotion """
+        with self._lock:
+            self._discard(promo_id)
+
+    def _discard(self, promo_id):
+        key = self._keys.pop(promo_id, None)
+        if key is not None:
+            self._groups[key] -= 1
+
+    def groups(self) -> list:
+        """ Returns the (type, discount bucket, status, count) groups """
+        with self._lock:
+            return [(*key, count) for key, count in self._groups.items()]
+
+
+_summary = None
+_built_at = 0.0
+_build_lock = threading.Lock()
+_pending = None  # the writes notified while the summary is rebuilt, to replay onto it
+_pending_lock = threading.Lock()
+
+
+def reset():
+    """ Drops the summary so that the next request rebuilds it """
+    global _summary  # pylint: disable=global-statement
+    with _build_lock:
+        _summary = None
+
+
+def _apply(summary, promo_id, record) -> bool:
+    """ Applies a write to a summary; returns False when the record cannot be counted """
+    if record is None:
+        summary.remove(promo_id)
+    elif None in (record.type, record.start_date, record.end_date):
+        return False
+    else:
+        summary.add(promo_id, record.type, record.discount, record.start_date, record.end_date)
+    return True
+
+
+def _current_summary(today):
+    """ Returns the summary for today, (re)building it when missing, stale or from another day """
+    global _summary, _built_at, _pending  # pylint: disable=global-statement
+    refresh = current_app.config["STATS_SUMMARY_REFRESH"]
+    summary = _summary
+    if summary is not None and summary.today == today and time.monotonic() - _built_at < refresh:
+        return summary
+    with _build_lock:
+        if _summary is None or _summary.today != today or time.monotonic() - _built_at >= refresh:
+            with _pending_lock:
+                _pending = []
+            summary = StatsSummary(today)
+            try:
+                for record in Promotion.all_records(["type", "discount", "start_date", "end_date"]):
+                    summary.add(record.id, record.type, record.discount, record.start_date, record.end_date)
+            except Exception:
+                with _pending_lock:
+                    _pending = None
+                raise
+            with _pending_lock:
+                # writes committed after the read began would otherwise only reach the old summary
+                replayed = all([_apply(summary, promo_id, record) for promo_id, record in _pending])
+                _pending = None
+                _summary = summary
+                # a write that cannot be counted makes the next request rebuild
+                _built_at = time.monotonic() if replayed else float("-inf")
+    return _summary
+
+
+def statistics(today=None) -> dict:
+    """ Returns the statistics of the Promotions on a day (today by default) """
+    today = today or date.today()
+    if current_app.config["STATS_SUMMARY"]:
+        metrics.inc("promotions_stats_requests_total", source="summary")
+        return summarize(_current_summary(today).groups(), today)
+    metrics.inc("promotions_stats_requests_total", source="query")
+    return summarize(Promotion.statistics(today), today)
+
+
+@on_write
+def _track_write(promo_id, record):
+    with _pending_lock:
+        if _pending is not None:
+            _pending.append((promo_id, record))
+    summary = _summary
+    if summary is not None and not _apply(summary, promo_id, record):
+        reset()  # a partial record cannot be counted; rebuild on the next request
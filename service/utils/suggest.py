@@ -0,0 +1,78 @@
+"""
+Name Suggestions
+
+Serves the name typeahead from a per-worker PrefixIndex so keystrokes do
+not reach the database. The index is built lazily on the first lookup,
+kept current by the model's write notifications, and rebuilt every
+SUGGEST_INDEX_REFRESH seconds to pick up writes made by other workers.
+When the index would not fit in SUGGEST_INDEX_MAX_BYTES, lookups fall
+back to a prefix query against the database.
+"""
+import threading
+import time
+from flask import current_app
+from service.models import Promotion, on_write
+from . import metrics
+from .prefix_index import PrefixIndex
+
+metrics.describe("promotions_suggest_lookups_total", "counter",
+                 "Name suggestion lookups by the source that served them")
+metrics.describe("promotions_suggest_index_bytes", "gauge",
+                 "Approximate memory used by the name prefix index")
+
+_index = None
+_built_at = 0.0
+_build_lock = threading.Lock()
+
+
+def reset():
+    """ Drops the index so that the next lookup rebuilds it """
+    global _index  # pylint: disable=global-statement
+    with _build_lock:
+        _index = None
+
+
+def _current_index():
+    """ Returns the index, (re)building it when missing or stale """
+    global _index, _built_at  # pylint: disable=global-statement
+    config = current_app.config
+    if config["SUGGEST_INDEX_MAX_BYTES"] <= 0:
+        return None
+    if _index is not None and time.monotonic() - _built_at < config["SUGGEST_INDEX_REFRESH"]:
+        return _index
+    with _build_lock:
+        if _index is None or time.monotonic() - _built_at >= config["SUGGEST_INDEX_REFRESH"]:
+            index = PrefixIndex(config["SUGGEST_INDEX_MAX_BYTES"])
+            if not index.build(Promotion.all_names()):
+                current_app.logger.warning("Name index exceeds %d bytes; suggesting from the database",
+                                           index.max_bytes)
+            metrics.set_gauge("promotions_suggest_index_bytes", index.size_bytes)
+            _index, _built_at = index, time.monotonic()
+    return _index
+
+
+def warm():
+    """ Builds the index ahead of the first lookup """
+    _current_index()
+
+
+def suggest(prefix, limit):
+    """ Returns up to limit (id, name) pairs whose name starts with prefix """
+    index = _current_index()
+    if index is not None and index.enabled:
+        metrics.inc("promotions_suggest_lookups_total", source="index")
+        return index.search(prefix, limit)
+    metrics.inc("promotions_suggest_lookups_total", source="database")
+    return Promotion.suggest_names(prefix, limit)
+
+
+@on_write
+def _track_write(promo_id, record):
+    index = _index
+    if index is None:
+        return
+    if record is None:
+        index.remove(promo_id)
+    elif record.name is not None:
+        index.add(promo_id, record.name)
+    metrics.set_gauge("promotions_suggest_index_bytes", index.size_bytes)
@@ -0,0 +1,101 @@
+"""
+Trigram Index
+
+An in-memory n-gram inverted index that ranks names by trigram
+similarity the way Postgres' pg_trgm does: names are lowercased, split
+into alphanumeric words, each word is padded with two spaces in front
+and one behind, and the similarity of two names is the number of
+trigrams they share divided by the number of distinct trigrams in
+either. A search only visits the posting lists of the query's trigrams,
+so its cost follows the number of similar names rather than the size of
+the catalog.
+"""
+import heapq
+import re
+import threading
+from collections import Counter
+
+WORD = re.compile(r"[^\W_]+")
+
+
+def trigrams(text) -> frozenset:
+    """ Returns the set of pg_trgm style trigrams of text """
+    grams = set()
+    for word in WORD.findall(text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def similarity(text, other) -> float:
+    """ Returns the trigram similarity of two strings, from 0 to 1 """
+    left, right = trigrams(text), trigrams(other)
+    if not left or not right:
+        return 0.0
+    shared = len(left & right)
+    return shared / (len(left) + len(right) - shared)
+
+
+class TrigramIndex:
+    """ Inverted index from trigrams to the ids of the names containing them """
+
+    def __init__(self):
+        self._postings = {}  # trigram -> set of ids
+        self._grams = {}  # id -> trigrams of its name
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._grams)
+
+    def build(self, items):
+        """ Replaces the contents with an iterable of (id, name) pairs """
+        postings, grams = {}, {}
+        for item_id, name in items:
+            if name is None:
+                continue
+            grams[item_id] = trigrams(name)
+            for gram in grams[item_id]:
+                postings.setdefault(gram, set()).add(item_id)
+        with self._lock:
+            self._postings, self._grams = postings, grams
+
+    def add(self, item_id, name):
+        """ Adds or renames an item """
+        grams = trigrams(name)
+        with self._lock:
+            self._remove(item_id)
+            self._grams[item_id] = grams
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add(item_id)
+
+    def remove(self, item_id):
+        """ Removes an item if it is indexed """
+        with self._lock:
+            self._remove(item_id)
+
+    def _remove(self, item_id):
+        for gram in self._grams.pop(item_id, ()):
+            posting = self._postings[gram]
+            posting.discard(item_id)
+            if not posting:
+                del self._postings[gram]
+
+    def search(self, text, threshold, limit=None) -> list:
+        """
+        Returns (id, score) pairs of the names at least threshold similar
+        to text, best first (ties by id), at most limit of them
+        """
+        query = trigrams(text)
+        if not query:
+            return []
+        with self._lock:
+            shared = Counter()
+            for gram in query:
+                shared.update(self._postings.get(gram, ()))
+            scored = []
+            for item_id, count in shared.items():
+                score = count / (len(query) + len(self._grams[item_id]) - count)
+                if score >= threshold:
+                    scored.append((score, -item_id))
+        best = heapq.nlargest(limit, scored) if limit is not None else sorted(scored, reverse=True)
+        return [(-negated_id, score) for score, negated_id in best]
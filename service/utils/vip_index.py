@@ -0,0 +1,185 @@
+"""
+VIP Customer Index
+
+Answers "which VIP promotions does this customer have?" for every page
+view of a logged-in customer. Nearly all customers have none, so a
+per-worker Bloom filter of the customers with a VIP promotion turns them
+away without touching the database; the rest are resolved through an
+in-memory customer -> promotion ids map and loaded by primary key.
+
+The index is built lazily and kept current by the model's write
+notifications. A Bloom filter must not turn away a customer who has a
+VIP promotion, so every VIP_INDEX_SYNC seconds the index also reads the
+database-wide write generation and is rebuilt if it moved: that picks
+up whatever other workers created or updated, whatever order their ids
+committed in. It is also rebuilt every VIP_INDEX_REFRESH seconds, which
+drops the Bloom bits of customers that lost their VIP promotions. The
+observed false positive rate is reported in the
+promotions_vip_bloom_false_positive_rate gauge.
+"""
+import threading
+import time
+from flask import current_app
+from service.models import Promotion, PromoType, on_write, reads_write_generation
+from . import metrics
+from .bloom import BloomFilter
+
+metrics.describe("promotions_vip_lookups_total", "counter",
+                 "VIP lookups by outcome: negative (answered by the Bloom filter), "
+                 "hit, or false_positive")
+metrics.describe("promotions_vip_bloom_false_positive_rate", "gauge",
+                 "Share of lookups for customers without VIP promotions that the Bloom filter let through")
+metrics.describe("promotions_vip_bloom_expected_false_positive_rate", "gauge",
+                 "False positive rate expected from the Bloom filter's size and fill")
+metrics.describe("promotions_vip_index_customers", "gauge",
+                 "Customers with VIP promotions in the index")
+
+
+class CustomerIndex:
+    """
+    Customer -> VIP promotion ids, fronted by a Bloom filter
+
+    Args:
+        capacity (int): the number of VIP customers to size the filter for
+        error_rate (float): the false positive rate wanted at capacity
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.negatives = 0  # lookups for customers without VIP promotions
+        self.false_positives = 0  # ... of which the Bloom filter let through
+        self._promotions = {}  # customer -> set of promotion ids
+        self._customers = {}  # promotion id -> customer
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._promotions)
+
+    def add(self, promo_id, customer):
+        """ Records that a VIP promotion belongs to a customer """
+        with self._lock:
+            self._remove(promo_id)
+            self._promotions.setdefault(customer, set()).add(promo_id)
+            self._customers[promo_id] = customer
+            self.bloom.add(customer)
+
+    def remove(self, promo_id):
+        """ Forgets a promotion, e.g. deleted or no longer VIP """
+        with self._lock:
+            self._remove(promo_id)
+
+    def _remove(self, promo_id):
+        customer = self._customers.pop(promo_id, None)
+        if customer is None:
+            return
+        promotions = self._promotions[customer]
+        promotions.discard(promo_id)
+        if not promotions:
+            del self._promotions[customer]
+
+    def lookup(self, customer) -> list:
+        """ Returns the ids of the customer's VIP promotions """
+        if customer not in self.bloom:
+            with self._lock:
+                self.negatives += 1
+            metrics.inc("promotions_vip_lookups_total", outcome="negative")
+            return []
+        with self._lock:
+            promo_ids = sorted(self._promotions.get(customer, ()))
+            if not promo_ids:
+                self.negatives += 1
+                self.false_positives += 1
+        metrics.inc("promotions_vip_lookups_total", outcome="hit" if promo_ids else "false_positive")
+        return promo_ids
+
+    def false_positive_rate(self) -> float:
+        """ Share of lookups for customers without VIP promotions that passed the filter """
+        return self.false_positives / self.negatives if self.negatives else 0.0
+
+
+_index = None
+_built_at = 0.0
+_built_generation = None  # the write generation the index was built at
+_checked_at = 0.0
+_build_lock = threading.Lock()
+_check_lock = threading.Lock()
+
+
+def reset():
+    """ Drops the index so that the next lookup rebuilds it """
+    global _index  # pylint: disable=global-statement
+    with _build_lock:
+        _index = None
+
+
+@reads_write_generation
+def _reads_generation(config) -> bool:
+    return config["VIP_INDEX_SYNC"] > 0
+
+
+def _moved(interval) -> bool:
+    """ Whether the write generation moved since the build, checked at most once per interval """
+    global _checked_at  # pylint: disable=global-statement
+    if interval <= 0 or time.monotonic() - _checked_at < interval or not _check_lock.acquire(blocking=False):
+        return False  # off, not due, or another request is checking
+    try:
+        _checked_at = time.monotonic()
+        return Promotion.write_generation() != _built_generation
+    finally:
+        _check_lock.release()
+
+
+def _current_index():
+    """ Returns the index, (re)building it when missing, old, or behind the write generation """
+    global _index, _built_at, _built_generation, _checked_at  # pylint: disable=global-statement
+    config = current_app.config
+    index = _index
+    if (index is not None and time.monotonic() - _built_at < config["VIP_INDEX_REFRESH"]
+            and not _moved(config["VIP_INDEX_SYNC"])):
+        return index
+    with _build_lock:
+        if _index is index:  # no other request rebuilt it meanwhile
+            # read before the rows: a write committed during the load moves it again
+            generation = Promotion.write_generation() if config["VIP_INDEX_SYNC"] > 0 else None
+            pairs = Promotion.vip_customers()
+            # leave room for the customers added by writes until the next rebuild
+            capacity = max(config["VIP_INDEX_CAPACITY"], 2 * len(pairs))
+            index = CustomerIndex(capacity, config["VIP_INDEX_ERROR_RATE"])
+            for promo_id, customer in pairs:
+                index.add(promo_id, customer)
+            _built_generation = generation
+            _index, _built_at = index, time.monotonic()
+            _checked_at = _built_at
+    return _index
+
+
+def warm():
+    """ Builds the index ahead of the first lookup """
+    _current_index()
+
+
+def vip_promotions(customer, fields=None) -> list:
+    """ Returns the PromotionRecords of the customer's VIP promotions """
+    index = _current_index()
+    promo_ids = index.lookup(customer)
+    metrics.set_gauge("promotions_vip_bloom_false_positive_rate", index.false_positive_rate())
+    metrics.set_gauge("promotions_vip_bloom_expected_false_positive_rate", index.bloom.expected_error_rate())
+    metrics.set_gauge("promotions_vip_index_customers", len(index))
+    if not promo_ids:
+        return []
+    # recheck the ids: another worker may have changed them since the last rebuild
+    still_vip = Promotion.find_by_customer(customer).filter(Promotion.type == PromoType.VIP)
+    records = Promotion.find_records_by_ids(promo_ids, [still_vip], fields)
+    return sorted(records, key=lambda record: record.id)
+
+
+@on_write
+def _track_write(promo_id, record):
+    index = _index
+    if index is None:
+        return
+    if (record is None or record.customer is None or record.type is None
+            or record.promo_type is not PromoType.VIP):
+        index.remove(promo_id)
+    else:
+        index.add(promo_id, record.customer)
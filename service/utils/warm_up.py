@@ -0,0 +1,91 @@
+"""
+Cache Warm-Up
+
+Builds the suggest, name search and VIP indexes and, with SHARED_CACHE
+on, loads the currently active promotions into the shared record cache
+before a worker takes traffic, so that a deploy or scale-out does not
+open with a burst of database reads. The listing caches fill from
+traffic. WARM_UP selects when it runs:
+
+* ``preload``: while the app is imported, which with gunicorn
+  ``--preload`` is before the workers are forked, so they inherit the
+  indexes; database connections and the shared cache mapping are
+  released afterwards so that no two workers share them
+* ``background``: in a thread of each worker, right after it starts;
+  as /health is answered by whichever worker accepts the probe, the pod
+  may be reported ready while its other workers are still warming up
+
+/health reports 503 until warm-up has finished. A failed warm-up is
+logged and leaves the worker ready with cold caches.
+"""
+import threading
+import time
+from datetime import date
+from service.models import Promotion, db
+from . import metrics, name_search, suggest, vip_index
+
+metrics.describe("promotions_warm_up_seconds", "gauge",
+                 "Seconds the warm-up of the read caches and indexes took")
+metrics.describe("promotions_warm_up_records", "gauge",
+                 "Active promotions loaded by the warm-up")
+
+_ready = threading.Event()
+_seconds = None
+
+
+def is_ready() -> bool:
+    """ Returns True once warm-up has finished (or was not asked for) """
+    return _ready.is_set()
+
+
+def seconds():
+    """ Returns how long warm-up took, or None if it has not run """
+    return _seconds
+
+
+def warm_up(app) -> float:
+    """ Warms the caches and indexes, marks the worker ready and returns the seconds it took """
+    global _seconds  # pylint: disable=global-statement
+    start = time.monotonic()
+    loaded = 0
+    with app.app_context():
+        try:
+            cache = Promotion.shared_records()
+            if cache is not None:  # without a record cache there is nothing to load them into
+                records = Promotion.find_matching_any([Promotion.find_by_date_range(active_on=date.today())])
+                loaded = sum(cache.put(record) for record in records)
+            suggest.warm()
+            name_search.warm()
+            vip_index.warm()
+        except Exception:  # pylint: disable=broad-except
+            app.logger.exception("Warm-up failed; serving with cold caches")
+        finally:
+            db.session.remove()
+    _seconds = time.monotonic() - start
+    metrics.set_gauge("promotions_warm_up_seconds", _seconds)
+    metrics.set_gauge("promotions_warm_up_records", loaded)
+    app.logger.info("Warm-up loaded %d active promotions in %.3f seconds", loaded, _seconds)
+    _ready.set()
+    return _seconds
+
+
+def release_for_fork(app):
+    """ Closes what forked workers must not share: pooled connections and the cache mapping """
+    with app.app_context():
+        for bind in [None, *app.config["SQLALCHEMY_BINDS"]]:
+            db.get_engine(app, bind).dispose()
+    Promotion.close_shared_records()
+
+
+def init_warm_up(app):
+    """ Starts the warm-up selected by WARM_UP """
+    mode = app.config["WARM_UP"]
+    if mode == "preload":
+        warm_up(app)
+        release_for_fork(app)
+    elif mode == "background":
+        threading.Thread(target=warm_up, args=(app,), name="warm-up", daemon=True).start()
+    else:
+        if mode:
+            app.logger.warning("Unknown WARM_UP mode %r; not warming up", mode)
+        _ready.set()
@@ -0,0 +1,56 @@
+"""
+Test cases for Admission Control
+"""
+import threading
+import time
+from unittest import TestCase
+from service.utils import metrics, status
+from service.utils.admission import AdmissionLimiter, AdmissionRejected
+
+
+class TestAdmissionLimiter(TestCase):
+    """Test the per route class concurrency limiter"""
+
+    def test_admits_up_to_limit(self):
+        """It should admit requests up to the limit and reject when the queue is full"""
+        limiter = AdmissionLimiter("test_full", limit=2, max_queue=0, timeout=0.1)
+        limiter.acquire()
+        limiter.acquire()
+        with self.assertRaises(AdmissionRejected) as context:
+            limiter.acquire()
+        self.assertEqual(context.exception.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(metrics.get("promotions_admission_rejected_total",
+                                     route_class="test_full", reason="queue_full"), 1)
+        limiter.release()
+        limiter.acquire()
+        self.assertEqual(limiter.active, 2)
+
+    def test_queue_timeout(self):
+        """It should reject a queued request that waits past the timeout"""
+        limiter = AdmissionLimiter("test_timeout", limit=1, max_queue=1, timeout=0.05)
+        limiter.acquire()
+        with self.assertRaises(AdmissionRejected) as context:
+            limiter.acquire()
+        self.assertEqual(context.exception.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(limiter.waiting, 0)
+
+    def test_queued_request_admitted_on_release(self):
+        """It should admit a queued request when a slot is released"""
+        limiter = AdmissionLimiter("test_queue", limit=1, max_queue=1, timeout=5)
+        limiter.acquire()
+        admitted = threading.Event()
+
+        def waiter():
+            limiter.acquire()
+            admitted.set()
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        while limiter.waiting == 0:
+            time.sleep(0.001)
+        self.assertEqual(metrics.get("promotions_admission_queue_depth", route_class="test_queue"), 1)
+        limiter.release()
+        self.assertTrue(admitted.wait(5))
+        thread.join()
+        self.assertEqual(limiter.active, 1)
+        self.assertEqual(limiter.waiting, 0)
@@ -0,0 +1,33 @@
+"""
+Test cases for the Bloom Filter
+"""
+from unittest import TestCase
+from service.utils.bloom import BloomFilter
+
+
+class TestBloomFilter(TestCase):
+    """Test the Bloom filter"""
+
+    def test_no_false_negatives(self):
+        """It should contain every key added"""
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for key in range(1000):
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in range(1000)))
+        self.assertEqual(bloom.count, 1000)
+
+    def test_false_positive_rate(self):
+        """It should keep false positives near the error rate it was sized for"""
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for key in range(1000):
+            bloom.add(key)
+        false_positives = sum(key in bloom for key in range(1000, 21000))
+        self.assertLess(false_positives / 20000, 0.02)
+        self.assertAlmostEqual(bloom.expected_error_rate(), 0.01, delta=0.002)
+        self.assertLess(bloom.size_bytes, 1300)
+
+    def test_empty(self):
+        """It should contain nothing when empty"""
+        bloom = BloomFilter(capacity=0, error_rate=0.01)
+        self.assertNotIn("key", bloom)
+        self.assertEqual(bloom.expected_error_rate(), 0.0)
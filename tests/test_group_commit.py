@@ -0,0 +1,72 @@
+"""
+Test cases for Group Commit
+"""
+import threading
+from unittest import TestCase
+from service.utils.group_commit import GroupCommitter
+
+
+class TestGroupCommitter(TestCase):
+    """Test the write batching"""
+
+    def setUp(self):
+        self.flushed = []
+
+    def flush(self, values):
+        """Commits values unless one of them is bad"""
+        if "bad" in values:
+            raise ValueError("bad value")
+        self.flushed.append(list(values))
+        return [f"id-{value}" for value in values]
+
+    def submit_concurrently(self, committer, values):
+        """Submits each value from its own thread and returns the results"""
+        results = {}
+
+        def submit(value):
+            try:
+                results[value] = committer.submit(value)
+            except ValueError as error:
+                results[value] = error
+
+        threads = [threading.Thread(target=submit, args=(value,)) for value in values]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_write(self):
+        """It should flush a lone write when the window closes"""
+        committer = GroupCommitter(self.flush, window=0.001, max_batch=10)
+        self.assertEqual(committer.submit("a"), "id-a")
+        self.assertEqual(self.flushed, [["a"]])
+        with self.assertRaises(ValueError):
+            committer.submit("bad")
+
+    def test_concurrent_writes_share_a_batch(self):
+        """It should coalesce concurrent writes and give each its own result"""
+        committer = GroupCommitter(self.flush, window=0.5, max_batch=8)
+        values = [str(i) for i in range(8)]
+        results = self.submit_concurrently(committer, values)
+        self.assertEqual(results, {value: f"id-{value}" for value in values})
+        # the batch filled up before the window closed
+        self.assertEqual(committer.batches, 1)
+        self.assertEqual(sorted(self.flushed[0]), values)
+
+    def test_failed_batch_isolates_errors(self):
+        """It should retry a failed batch one write at a time"""
+        committer = GroupCommitter(self.flush, window=0.5, max_batch=3)
+        results = self.submit_concurrently(committer, ["a", "bad", "b"])
+        self.assertEqual(results["a"], "id-a")
+        self.assertEqual(results["b"], "id-b")
+        self.assertIsInstance(results["bad"], ValueError)
+
+    def test_batches_never_exceed_max_batch(self):
+        """It should start a new batch once the current one is full"""
+        committer = GroupCommitter(self.flush, window=0.2, max_batch=3)
+        values = [str(i) for i in range(20)]
+        results = self.submit_concurrently(committer, values)
+        self.assertEqual(results, {value: f"id-{value}" for value in values})
+        self.assertTrue(all(len(batch) <= 3 for batch in self.flushed), self.flushed)
+        self.assertEqual(sorted(value for batch in self.flushed for value in batch), sorted(values))
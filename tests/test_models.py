@@ -5,10 +5,13 @@ Test cases for Promotion Model
 import os
 import logging
 import unittest
+from unittest.mock import patch
 from datetime import date
 from service import app
 from service.utils import status
-from service.models import Promotion, PromoType, DataValidationError, db
+from sqlalchemy import text
+from service.models import (Explain, Promotion, PromotionRecord, PromoType, DataValidationError, IdempotencyKey,
+                            VersionMismatchError, db, upgrade_schema)
 from tests.factories import PromoFactory
 
 DATABASE_URI = os.getenv(
@@ -139,6 +142,48 @@ class TestPromotionModel(unittest.TestCase):
         self.assertEqual(promotions[0].id, original_id)
         self.assertEqual(promotions[0].type, PromoType.BUY_ONE_GET_ONE)
 
+    def test_update_by_id(self):
+        """It should update a promotion in a single statement"""
+        promotion = PromoFactory()
+        promotion.create()
+        record = Promotion.update_by_id(promotion.id, {"name": "renamed", "discount": 10})
+        self.assertEqual(record.id, promotion.id)
+        self.assertEqual(record.name, "renamed")
+        self.assertEqual(record.discount, 10)
+        self.assertEqual(record.promo_type, promotion.type)
+        self.assertEqual(Promotion.find(promotion.id).name, "renamed")
+        self.assertIsNone(Promotion.update_by_id(promotion.id + 1, {"name": "missing"}))
+
+    def test_update_by_id_version(self):
+        """It should only update a promotion at one of the expected versions"""
+        promotion = PromoFactory()
+        promotion.create()
+        self.assertEqual(promotion.version, 1)
+        record = Promotion.update_by_id(promotion.id, {"name": "renamed"}, versions=[1])
+        self.assertEqual(record.version, 2)
+        with self.assertRaises(VersionMismatchError):
+            Promotion.update_by_id(promotion.id, {"name": "stale"}, versions=[1])
+        with self.assertRaises(VersionMismatchError):
+            Promotion.cancel(promotion.id, versions=[])
+        self.assertIsNone(Promotion.update_by_id(promotion.id + 1, {"name": "missing"}, versions=[1]))
+        self.assertEqual(Promotion.cancel(promotion.id, versions=[2]).version, 3)
+        # ORM updates bump the version too
+        promotion = Promotion.find(promotion.id)
+        promotion.name = "orm"
+        promotion.update()
+        self.assertEqual(promotion.version, 4)
+
+    def test_deserialize_changes(self):
+        """It should deserialize full and partial changes"""
+        data = PromoFactory().serialize()
+        changes = Promotion.deserialize_changes(data)
+        self.assertEqual(set(changes), {"name", "type", "discount", "customer", "start_date", "end_date"})
+        self.assertIsInstance(changes["type"], PromoType)
+        self.assertEqual(changes["start_date"], date.fromisoformat(data["start_date"]))
+        self.assertEqual(Promotion.deserialize_changes({"name": "x"}, partial=True), {"name": "x"})
+        self.assertRaises(DataValidationError, Promotion.deserialize_changes, {"name": "x"})
+        self.assertRaises(DataValidationError, Promotion.deserialize_changes, "not a dict", True)
+
     def test_update_no_id(self):
         """It should not update a promotion with no id"""
         promotion = PromoFactory()
@@ -155,6 +200,73 @@ class TestPromotionModel(unittest.TestCase):
         promotion.delete()
         self.assertEqual(len(Promotion.all()), 0)
 
+    def test_delete_by_id(self):
+        """It should Delete a Promotion by ID in a single statement"""
+        promotion = PromoFactory()
+        promotion.create()
+        promo_id = promotion.id
+        self.assertTrue(Promotion.delete_by_id(promo_id))
+        self.assertEqual(Promotion.all_records(), [])
+        self.assertFalse(Promotion.delete_by_id(promo_id))
+
+    def test_upgrade_baseline_schema(self):
+        """It should add the version column to a promotion table made before it existed"""
+        promotion = PromoFactory()
+        promotion.create()
+        db.session.execute(text("ALTER TABLE promotion DROP COLUMN version"))
+        db.session.commit()
+        try:
+            with db.engine.begin() as connection:
+                upgrade_schema(connection)
+                upgrade_schema(connection)  # a second start changes nothing
+        finally:
+            db.session.execute(text("ALTER TABLE promotion ADD COLUMN IF NOT EXISTS version "
+                                    "INTEGER NOT NULL DEFAULT 1"))
+            db.session.commit()
+        self.assertEqual(Promotion.find_record(promotion.id).version, 1)
+        self.assertEqual(Promotion.cancel(promotion.id, versions=[1]).version, 2)
+
+    def test_cancel_a_promotion(self):
+        """It should cancel a Promotion by ending it on its start date"""
+        promotion = PromoFactory()
+        promotion.create()
+        record = Promotion.cancel(promotion.id)
+        self.assertEqual(record.end_date, promotion.start_date)
+        self.assertEqual(Promotion.find_record(promotion.id), record)
+        self.assertIsNone(Promotion.cancel(promotion.id + 1))
+
+    def test_cancel_many_promotions(self):
+        """It should cancel many Promotions in one statement and report each write"""
+        promotions = PromoFactory.create_batch(3)
+        for promotion in promotions:
+            promotion.create()
+        ids = [promotion.id for promotion in promotions[:2]]
+        with patch("service.models.notify_write") as notify:
+            records = Promotion.cancel_many(ids + [promotions[2].id + 1])
+        self.assertEqual(sorted(record.id for record in records), ids)
+        self.assertEqual(sorted(call.args[0] for call in notify.call_args_list), ids)
+        for record in records:
+            self.assertEqual(record.end_date, record.start_date)
+            self.assertEqual(record.version, 2)
+        self.assertNotEqual(Promotion.find_record(promotions[2].id).end_date, promotions[2].start_date)
+
+    def test_write_generation_once_per_transaction(self):
+        """It should bump the write generation once per committed transaction, and only if something reads it"""
+        promotions = PromoFactory.create_batch(16)
+        Promotion.create_many(promotions)
+        ids = [promotion.id for promotion in promotions]
+        generation = Promotion.write_generation()
+        Promotion.cancel_many(ids)
+        self.assertEqual(Promotion.write_generation(), generation + 1)
+        PromoFactory().create()
+        self.assertEqual(Promotion.write_generation(), generation + 2)
+        db.session.execute(Promotion.__table__.update().values(discount=1))
+        db.session.rollback()
+        self.assertEqual(Promotion.write_generation(), generation + 2)
+        with patch.dict(app.config, {"RESULT_CACHE": False, "STALE_WHILE_REVALIDATE": False, "VIP_INDEX_SYNC": 0}):
+            Promotion.cancel_many(ids)
+        self.assertEqual(Promotion.write_generation(), generation + 2)
+
     def test_find_promotion_by_id(self):
         """It should find a promotion by id"""
         promo = PromoFactory()
@@ -186,3 +298,136 @@ class TestPromotionModel(unittest.TestCase):
         print(f"Created a promotion, name = {type}")
         inserted_promo = Promotion.find_by_type(type)
         self.assertIsNotNone(inserted_promo)
+
+    def test_promotion_record_serialize(self):
+        """It should serialize a PromotionRecord exactly like its Promotion"""
+        promo = PromoFactory()
+        promo.discount = 25
+        promo.create()
+        record = Promotion.find_record(promo.id)
+        self.assertIsInstance(record, PromotionRecord)
+        self.assertEqual(record.type, promo.type.value)
+        self.assertEqual(record.promo_type, promo.type)
+        self.assertEqual(record.serialize(), promo.serialize())
+        self.assertRaises(AttributeError, setattr, record, "name", "bar")
+        self.assertIsNone(Promotion.find_record(promo.id + 1))
+
+    def test_list_all_promotion_records(self):
+        """It should list all promotions in the database as PromotionRecords"""
+        self.assertEqual(Promotion.all_records(), [])
+        for _ in range(3):
+            PromoFactory().create()
+        records = Promotion.all_records()
+        self.assertEqual(len(records), 3)
+        self.assertEqual(sorted(record.serialize()["id"] for record in records),
+                         sorted(promo.id for promo in Promotion.all()))
+
+    def test_find_record_fields(self):
+        """It should only load the requested columns of a promotion"""
+        promo = PromoFactory()
+        promo.discount = 5
+        promo.create()
+        record = Promotion.find_record(promo.id, ["discount"])
+        self.assertEqual(record.id, promo.id)
+        self.assertEqual(record.discount, 5)
+        self.assertIsNone(record.name)
+        self.assertIsNone(record.serialize()["start_date"])
+
+    def test_find_matching_any(self):
+        """It should return the union of several filters once each"""
+        for name, discount in (("foo", 10), ("bar", 20), ("foobar", 30)):
+            promo = PromoFactory()
+            promo.name = name
+            promo.discount = discount
+            promo.create()
+        records = Promotion.find_matching_any(
+            [Promotion.find_by_name("foo"), Promotion.find_by_discount(20)])
+        self.assertEqual(sorted(record.name for record in records), ["bar", "foo", "foobar"])
+        self.assertEqual(len(Promotion.find_matching_any([])), 3)
+
+    def test_find_matching_any_sorted_pages(self):
+        """It should page through sorted promotions with keysets, NULLs last ascending"""
+        for discount in (10, None, 5, 10, None, 20):
+            promo = PromoFactory()
+            promo.discount = discount
+            promo.create()
+        everything = Promotion.find_matching_any([])
+        for descending in (False, True):
+            expected = sorted(everything, key=lambda record: (record.discount is None, record.discount or 0,
+                                                              record.id))
+            if descending:
+                expected.reverse()
+            pages, after = [], None
+            while True:
+                page = Promotion.find_matching_any([], ["name"], "discount", descending, after, 2)
+                pages.extend(record.id for record in page)
+                if len(page) < 2:
+                    break
+                after = (page[-1].discount, page[-1].id)
+            self.assertEqual(pages, [record.id for record in expected])
+
+    def test_sorted_page_uses_index(self):
+        """It should read a sorted page in the order of its (field, id) index, without sorting"""
+        condition = Promotion._keyset_ranges("name", False, ("m", 5))[0]  # pylint: disable=protected-access
+        statement = Promotion.record_query().filter(condition).order_by(
+            Promotion.name, Promotion.id).limit(10).statement
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        db.session.execute(text("SET LOCAL enable_bitmapscan = off"))
+        plan = db.session.execute(Explain(statement)).scalar()[0]["Plan"]
+        db.session.rollback()
+        nodes = []
+        while plan:
+            nodes.append(plan)
+            plan = plan.get("Plans", [None])[0]
+        self.assertNotIn("Sort", [node["Node Type"] for node in nodes])
+        self.assertIn("ix_promotion_name_id", [node.get("Index Name") for node in nodes])
+
+    def test_count_matching_any(self):
+        """It should count promotions without loading them"""
+        for name in ("foo", "bar", "foobar"):
+            promo = PromoFactory()
+            promo.name = name
+            promo.create()
+        self.assertEqual(Promotion.count_matching_any([]), 3)
+        self.assertEqual(Promotion.count_matching_any([Promotion.find_by_name("foo")]), 2)
+        self.assertEqual(Promotion.count_matching_any([Promotion.find_by_name("foo")], estimate=True), 2)
+        # the planner estimate itself is a non-negative number of rows
+        self.assertGreaterEqual(Promotion._estimate_rows([Promotion.find_by_name("foo")]), 0)
+
+    def test_find_records_by_ids(self):
+        """It should load the records with the given ids that match any filter"""
+        ids = []
+        for name in ("foo", "bar", "foobar"):
+            promo = PromoFactory()
+            promo.name = name
+            promo.create()
+            ids.append(promo.id)
+        records = Promotion.find_records_by_ids(ids[:2], fields=["name"])
+        self.assertEqual(sorted(record.name for record in records), ["bar", "foo"])
+        records = Promotion.find_records_by_ids(ids, [Promotion.find_by_name("foo")])
+        self.assertEqual(sorted(record.name for record in records), ["foo", "foobar"])
+
+    def test_has_trigram_search(self):
+        """It should tell whether the database it searches has the pg_trgm extension"""
+        with db.engine.connect() as conn:
+            installed = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar()
+        self.assertEqual(Promotion.has_trigram_search(), installed is not None)
+
+    def test_idempotency_key_lifecycle(self):
+        """It should claim, complete and prune idempotency keys"""
+        db.session.query(IdempotencyKey).delete()
+        db.session.commit()
+        self.assertTrue(IdempotencyKey.claim("key-1", "abc", ttl=60, lock_timeout=30))
+        self.assertFalse(IdempotencyKey.claim("key-1", "abc", ttl=60, lock_timeout=30))
+        self.assertIsNone(IdempotencyKey.lookup("key-1").status_code)
+        IdempotencyKey.complete("key-1", 201, '{"id": 1}', "http://localhost/api/promotions/1")
+        stored = IdempotencyKey.lookup("key-1")
+        self.assertEqual(stored.status_code, 201)
+        self.assertEqual(stored.fingerprint, "abc")
+        # an in flight key whose owner went away is taken over
+        self.assertTrue(IdempotencyKey.claim("key-2", "def", ttl=60, lock_timeout=30))
+        self.assertTrue(IdempotencyKey.claim("key-2", "def", ttl=60, lock_timeout=-1))
+        IdempotencyKey.release("key-2")
+        self.assertIsNone(IdempotencyKey.lookup("key-2"))
+        IdempotencyKey.prune(ttl=60, max_keys=0)
+        self.assertIsNone(IdempotencyKey.lookup("key-1"))
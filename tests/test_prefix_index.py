@@ -0,0 +1,43 @@
+"""
+Test cases for the Prefix Index
+"""
+from unittest import TestCase
+from service.utils.prefix_index import PrefixIndex
+
+
+class TestPrefixIndex(TestCase):
+    """Test the sorted array name index"""
+
+    def setUp(self):
+        self.index = PrefixIndex(max_bytes=1024 * 1024)
+        self.index.build([(1, "Summer Sale"), (2, "spring sale"), (3, "SUMMER shoes"), (4, None)])
+
+    def test_search_by_prefix(self):
+        """It should find names by prefix ignoring case, in name order"""
+        self.assertTrue(self.index.enabled)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.search("summer", 10), [(1, "Summer Sale"), (3, "SUMMER shoes")])
+        self.assertEqual(self.index.search("S", 2), [(2, "spring sale"), (1, "Summer Sale")])
+        self.assertEqual(self.index.search("winter", 10), [])
+        self.assertEqual(len(self.index.search("", 10)), 3)
+
+    def test_add_and_remove(self):
+        """It should add, rename and remove names"""
+        self.index.add(5, "Winter")
+        self.index.add(1, "Autumn Sale")
+        self.assertEqual(self.index.search("summer", 10), [(3, "SUMMER shoes")])
+        self.assertEqual(self.index.search("a", 10), [(1, "Autumn Sale")])
+        size = self.index.size_bytes
+        self.index.remove(5)
+        self.index.remove(42)
+        self.assertEqual(self.index.search("w", 10), [])
+        self.assertLess(self.index.size_bytes, size)
+
+    def test_memory_budget(self):
+        """It should disable itself rather than exceed its memory budget"""
+        index = PrefixIndex(max_bytes=self.index.size_bytes)
+        self.assertTrue(index.build([(1, "Summer Sale"), (2, "spring sale"), (3, "SUMMER shoes")]))
+        index.add(5, "one more name")
+        self.assertFalse(index.enabled)
+        self.assertEqual(index.search("s", 10), [])
+        self.assertFalse(PrefixIndex(max_bytes=10).build([(1, "Summer Sale")]))
@@ -6,12 +6,25 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import tempfile
+import csv
+import gzip
+import io
+import json
 import logging
+import threading
+import time
+import tracemalloc
+import uuid
+import msgpack
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
 from service import app, routes
-from service.models import PromoType, db, Promotion
-from service.utils import status  # HTTP Status Codes
+from service.models import Job, PromoType, db, Promotion
+from service.utils import (jobs, metrics, name_search, result_cache, stale_cache, stats, status, suggest,
+                           vip_index, warm_up)  # HTTP Status Codes
 # helper functions for dealing with datetimes as created by Postgres
 from service.utils.time_management import str_to_dt
 from tests.factories import PromoFactory
@@ -53,6 +66,7 @@ class TestPromotionServer(TestCase):
         # some sort of naming expectation conflict in provided code; use both for now
         db.session.query(Promotion).delete()  # clean up the last tests
         db.session.commit()
+        result_cache.invalidate()  # the bulk delete bypasses the write notifications
 
     def tearDown(self):
         """ This runs after each test """
@@ -63,6 +77,8 @@ class TestPromotionServer(TestCase):
         promo = []
         for _ in range(count):
             test_promotion = PromoFactory()
+            # unique names so that the duplicate check never rejects one
+            test_promotion.name = f"promotion {test_promotion.id}"
             response = self.client.post(
                 BASE_URL, json=test_promotion.serialize())
             self.assertEqual(
@@ -93,6 +109,29 @@ class TestPromotionServer(TestCase):
         data = response.get_json()
         self.assertEqual(data['message'], 'OK')
 
+    def test_metrics(self):
+        """It should expose metrics in the Prometheus text format"""
+        self.client.get(BASE_URL)
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b"promotions_admission_in_flight", response.data)
+
+    def test_admission_rejects_over_budget(self):
+        """It should shed requests over the admission budget with Retry-After"""
+        limiter = app.extensions["admission"]["reads"]
+        limit, max_queue = limiter.limit, limiter.max_queue
+        limiter.limit, limiter.max_queue = 0, 0
+        try:
+            response = self.client.get(f"{BASE_URL}/1")
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertIn("Retry-After", response.headers)
+            # probes are never shed
+            response = self.client.get("/health")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        finally:
+            limiter.limit, limiter.max_queue = limit, max_queue
+        self.assertEqual(limiter.active, 0)
+
     def test_create_promotion(self):
         """ It should create various kinds of promotions """
         test_promo = PromoFactory()
@@ -173,6 +212,14 @@ class TestPromotionServer(TestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_create_promo_reversed_dates(self):
+        """It should not create a Promotion that ends before it starts"""
+        test_promo = PromoFactory().serialize()
+        test_promo["start_date"], test_promo["end_date"] = "2022-07-10", "2022-07-09"
+        response = self.client.post(BASE_URL, json=test_promo)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("end_date is before start_date", response.get_json()["message"])
+
     def test_create_promo_bad_method(self):
         """It should not create a Promotion via a GET request"""
         test_promo = PromoFactory()
@@ -295,10 +342,13 @@ class TestPromotionServer(TestCase):
         id = new_promo["id"]
         logging.debug(new_promo)
         new_promo["name"] = "GOOD"
-        response = self.client.put(BASE_URL + '/' + str(id), json=new_promo)
+        response = self.client.put(BASE_URL + '/' + str(id), json=new_promo,
+                                   headers={"If-Match": response.headers["ETag"]})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         updated_promo = response.get_json()
         self.assertEqual(updated_promo["name"], "GOOD")
+        self.assertEqual(updated_promo["version"], new_promo["version"] + 1)
+        self.assertEqual(response.headers["ETag"], f'"{updated_promo["version"]}"')
         
     def test_update_promotion_not_exists(self):
         """It should not update a Promotion that does not exist"""
@@ -312,9 +362,63 @@ class TestPromotionServer(TestCase):
         id = new_promo["id"] + 1
         logging.debug(new_promo)
         new_promo["name"] = "GOOD"
-        response = self.client.put(BASE_URL + '/' + str(id), json=new_promo)
+        response = self.client.put(BASE_URL + '/' + str(id), json=new_promo, headers={"If-Match": '"1"'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_patch_promotion(self):
+        """It should update only the posted fields of an existing Promotion"""
+        test_promo = PromoFactory()
+        response = self.client.post(BASE_URL, json=test_promo.serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        new_promo = response.get_json()
+        response = self.client.patch(f"{BASE_URL}/{new_promo['id']}",
+                                     json={"name": "PATCHED", "discount": 15},
+                                     headers={"If-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        patched_promo = response.get_json()
+        self.assertEqual(patched_promo["name"], "PATCHED")
+        self.assertEqual(patched_promo["discount"], 15)
+        for key in ("id", "type", "customer", "start_date", "end_date"):
+            self.assertEqual(patched_promo[key], new_promo[key])
+        response = self.client.get(f"{BASE_URL}/{new_promo['id']}")
+        self.assertEqual(response.get_json(), patched_promo)
+
+    def test_patch_promotion_bad_data(self):
+        """It should not patch a Promotion with bad data"""
+        new_promo = self._create_promotion(1)[0]
+        response = self.client.patch(f"{BASE_URL}/{new_promo.id}", json={"type": "NOPE"},
+                                     headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(f"{BASE_URL}/{new_promo.id}", json={"end_date": "soon"},
+                                     headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_patch_promotion_reversed_dates(self):
+        """It should not patch a Promotion to end before it starts"""
+        new_promo = self._create_promotion(1)[0]
+        url = f"{BASE_URL}/{new_promo.id}"
+        for body in ({"start_date": "2022-08-02", "end_date": "2022-08-01"},
+                     {"end_date": "2022-06-30"}, {"start_date": "2022-11-01"}):
+            response = self.client.patch(url, json=body, headers={"If-Match": "*"})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+        response = self.client.patch(url, json={"end_date": "2022-06-30"}, headers={"If-Match": "0"})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.patch(url, json={"end_date": "2022-07-31"}, headers={"If-Match": "1"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["version"], 2)
+
+    def test_patch_promotion_not_exists(self):
+        """It should not patch a Promotion that does not exist"""
+        response = self.client.patch(f"{BASE_URL}/1", json={"name": "GOOD"}, headers={"If-Match": "*"})
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_update_promotion_missing_field(self):
+        """It should not update a Promotion when a field is missing"""
+        new_promo = self._create_promotion(1)[0].serialize()
+        del new_promo["end_date"]
+        response = self.client.put(f"{BASE_URL}/{new_promo['id']}", json=new_promo, headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_cancel_promotion(self):
         """It should early cancel a Promotion that exists by setting end_date equal to start_date"""
         # create a Promotion to cancel
@@ -324,11 +428,45 @@ class TestPromotionServer(TestCase):
         self.assertEqual(response_1.status_code, status.HTTP_201_CREATED)
         # cancel the Promotion that was just created
         promo_id = new_promo["id"]
-        response_2 = self.client.put(BASE_URL + '/' + str(promo_id) + "/cancel")
+        response_2 = self.client.put(BASE_URL + '/' + str(promo_id) + "/cancel",
+                                     headers={"If-Match": response_1.headers["ETag"]})
         updated_promo = response_2.get_json()
         self.assertEqual(response_2.status_code, status.HTTP_200_OK)
         self.assertEqual(updated_promo["start_date"], updated_promo["end_date"])
 
+    def test_write_requires_if_match(self):
+        """It should refuse writes without If-Match or with a stale version"""
+        response = self.client.post(BASE_URL, json=PromoFactory().serialize())
+        promo = response.get_json()
+        etag = response.headers["ETag"]
+        self.assertEqual(etag, '"1"')
+        url = f"{BASE_URL}/{promo['id']}"
+        self.assertEqual(self.client.get(url).headers["ETag"], etag)
+        response = self.client.put(url, json=promo)
+        self.assertEqual(response.status_code, status.HTTP_428_PRECONDITION_REQUIRED)
+        response = self.client.patch(url, json={"name": "GOOD"})
+        self.assertEqual(response.status_code, status.HTTP_428_PRECONDITION_REQUIRED)
+        response = self.client.put(f"{url}/cancel")
+        self.assertEqual(response.status_code, status.HTTP_428_PRECONDITION_REQUIRED)
+        # the first writer with the current version wins, the second one is told it is stale
+        response = self.client.patch(url, json={"name": "first"}, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.patch(url, json={"name": "second"}, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.put(f"{url}/cancel", headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.patch(url, json={}, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.get(url)
+        self.assertEqual(response.get_json()["name"], "first")
+        self.assertEqual(response.headers["ETag"], '"2"')
+        # any of several versions, or any version at all
+        response = self.client.patch(url, json={"name": "third"}, headers={"If-Match": '"1", "2"'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.put(f"{url}/cancel", headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["version"], 4)
+
     def test_cancel_promotion_not_exists(self):
         """It should not early cancel a Promotion that does not exist"""
         # create a Promotion to generate the highest current ID
@@ -337,7 +475,7 @@ class TestPromotionServer(TestCase):
         new_promo = response_1.get_json()
         self.assertEqual(response_1.status_code, status.HTTP_201_CREATED)
         bad_id = new_promo["id"] + 1
-        response_2 = self.client.put(BASE_URL + '/' + str(bad_id) + "/cancel")
+        response_2 = self.client.put(BASE_URL + '/' + str(bad_id) + "/cancel", headers={"If-Match": "*"})
         self.assertEqual(response_2.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_query_promotion(self):
@@ -415,3 +553,807 @@ class TestPromotionServer(TestCase):
     #         "unsupported_key":"123"
     #     })
     #     self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_promotion_date_range(self):
+        """ It should fetch promotions by date range conditions """
+        dates = [
+            (datetime.date(2022, 7, 1), datetime.date(2022, 7, 10)),
+            (datetime.date(2022, 7, 8), datetime.date(2022, 7, 20)),
+            (datetime.date(2022, 8, 1), datetime.date(2022, 8, 31)),
+        ]
+        ids = []
+        for i, (start_date, end_date) in enumerate(dates):
+            test_promo = PromoFactory()
+            test_promo.name = f"range {i}"
+            test_promo.start_date = start_date
+            test_promo.end_date = end_date
+            response = self.client.post(BASE_URL, json=test_promo.serialize())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            ids.append(response.get_json()["id"])
+
+        def query_ids(**query):
+            response = self.client.get(BASE_URL, query_string=query)
+            if response.status_code == status.HTTP_404_NOT_FOUND:
+                return set()
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return {promo["id"] for promo in response.get_json()}
+
+        self.assertEqual(query_ids(active_on="2022-07-09"), {ids[0], ids[1]})
+        self.assertEqual(query_ids(active_on="2022-07-10"), {ids[0], ids[1]})
+        self.assertEqual(query_ids(overlaps="2022-07-15,2022-08-01"), {ids[1], ids[2]})
+        self.assertEqual(query_ids(overlaps="2022-09-01,2022-09-30"), set())
+        self.assertEqual(query_ids(starts_after="2022-07-01"), {ids[1], ids[2]})
+        self.assertEqual(query_ids(starts_before="2022-07-08"), {ids[0]})
+        self.assertEqual(query_ids(ends_after="2022-07-10", ends_before="2022-08-31"), {ids[1]})
+
+        response = self.client.get(BASE_URL, query_string={"active_on": "July"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string={"overlaps": "2022-08-01,2022-07-01"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string={"overlaps": "2022-08-01"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_promotions_msgpack(self):
+        """It should list Promotions as MessagePack when asked to"""
+        self._create_promotion(3)
+        expected = self.client.get(BASE_URL).get_json()
+        response = self.client.get(BASE_URL, headers={"Accept": "application/msgpack"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/msgpack")
+        self.assertEqual(msgpack.unpackb(response.data), expected)
+
+    def test_list_promotions_csv(self):
+        """It should list Promotions as CSV when asked to"""
+        promos = self._create_promotion(3)
+        response = self.client.get(BASE_URL, headers={"Accept": "text/csv"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/csv")
+        rows = list(csv.DictReader(io.StringIO(response.data.decode("utf-8"))))
+        self.assertEqual(sorted(int(row["id"]) for row in rows), sorted(promo.id for promo in promos))
+        response = self.client.get(f"{BASE_URL}/{promos[0].id}", headers={"Accept": "text/csv"})
+        rows = list(csv.DictReader(io.StringIO(response.data.decode("utf-8"))))
+        self.assertEqual(rows[0]["name"], promos[0].name)
+
+    def test_list_promotions_compressed(self):
+        """It should compress large responses for clients that accept it"""
+        for i in range(20):
+            test_promo = PromoFactory()
+            test_promo.name = f"compressed promotion {i}"
+            self.client.post(BASE_URL, json=test_promo.serialize())
+        expected = self.client.get(BASE_URL).get_json()
+        response = self.client.get(BASE_URL, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertEqual(json.loads(gzip.decompress(response.data)), expected)
+        # small responses are sent as is
+        response = self.client.get(f"{BASE_URL}/{expected[0]['id']}", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_compressed_etag(self):
+        """It should give a compressed response its own ETag, still accepted by If-Match"""
+        promo_id = self._create_promotion(1)[0].id
+        url = f"{BASE_URL}/{promo_id}"
+        with patch.dict(app.config, {"COMPRESSION_MIN_SIZE": 0}):
+            response = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["ETag"], '"1-gzip"')
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertEqual(self.client.get(url).headers["ETag"], '"1"')
+        response = self.client.patch(url, json={"name": "renamed"}, headers={"If-Match": '"1-gzip"'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_sparse_fieldsets(self):
+        """It should return only the requested fields"""
+        promos = self._create_promotion(2)
+        response = self.client.get(BASE_URL, query_string={"fields": "type,discount"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), 2)
+        for promo in data:
+            self.assertEqual(set(promo), {"type", "discount"})
+        response = self.client.get(f"{BASE_URL}/{promos[0].id}", query_string={"fields": "id,name"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"id": promos[0].id, "name": promos[0].name})
+        response = self.client.get(BASE_URL, query_string={"fields": "id,secret"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_api_docs(self):
+        """It should generate valid API docs including the fields parameter"""
+        response = self.client.get("/api/swagger.json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        listing = response.get_json()["paths"]["/promotions"]["get"]
+        self.assertIn("fields", [param["name"] for param in listing["parameters"]])
+        self.assertEqual(listing["responses"]["200"]["schema"]["type"], "array")
+
+    def test_count_promotions(self):
+        """It should count Promotions with HEAD and X-Total-Count"""
+        promos = self._create_promotion(3)
+        response = self.client.get(BASE_URL)
+        self.assertEqual(response.headers["X-Total-Count"], "3")
+        response = self.client.head(BASE_URL)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["X-Total-Count"], "3")
+        self.assertEqual(response.data, b"")
+        response = self.client.head(BASE_URL, query_string={"name": promos[0].name})
+        self.assertEqual(response.headers["X-Total-Count"], "1")
+        response = self.client.head(BASE_URL, query_string={"name": "nothing like it"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.headers["X-Total-Count"], "0")
+        response = self.client.head(BASE_URL, query_string={"count": "guess"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_count_promotions_estimate(self):
+        """It should count Promotions with planner estimates when asked"""
+        self._create_promotion(2)
+        # small estimates are replaced by an exact count
+        response = self.client.head(BASE_URL, query_string={"count": "estimate"})
+        self.assertEqual(response.headers["X-Total-Count"], "2")
+        response = self.client.head(BASE_URL, query_string={"count": "estimate", "active_on": "2022-07-31"})
+        self.assertEqual(response.headers["X-Total-Count"], "2")
+
+    def test_create_promotion_idempotency_key(self):
+        """It should replay the first response for a repeated Idempotency-Key"""
+        test_promo = PromoFactory()
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        response_1 = self.client.post(BASE_URL, json=test_promo.serialize(), headers=headers)
+        self.assertEqual(response_1.status_code, status.HTTP_201_CREATED)
+        response_2 = self.client.post(BASE_URL, json=test_promo.serialize(), headers=headers)
+        self.assertEqual(response_2.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response_2.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(response_2.headers["Location"], response_1.headers["Location"])
+        self.assertEqual(response_2.get_json(), response_1.get_json())
+        self.assertEqual(len(Promotion.all_records()), 1)
+        # the same key with another body is refused
+        test_promo.name = "something else"
+        response_3 = self.client.post(BASE_URL, json=test_promo.serialize(), headers=headers)
+        self.assertEqual(response_3.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_create_promotion_idempotency_key_failure(self):
+        """It should not store failed requests so that they can be retried"""
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        response = self.client.post(BASE_URL, json={}, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(BASE_URL, json=PromoFactory().serialize(), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_create_promotion_idempotency_key_concurrent(self):
+        """It should coalesce concurrent requests with the same Idempotency-Key"""
+        body = PromoFactory().serialize()
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        responses = []
+
+        def post():
+            response = app.test_client().post(BASE_URL, json=body, headers=headers)
+            responses.append((response.status_code, response.get_json()["id"]))
+
+        threads = [threading.Thread(target=post) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(responses), 5)
+        self.assertEqual({code for code, _ in responses}, {status.HTTP_201_CREATED})
+        self.assertEqual(len({promo_id for _, promo_id in responses}), 1)
+        self.assertEqual(len(Promotion.all_records()), 1)
+
+    def test_suggest_names(self):
+        """It should suggest Promotion names by prefix and track writes"""
+        suggest.reset()
+        for name in ("Summer Sale", "summer shoes", "Spring Sale"):
+            body = PromoFactory().serialize()
+            body["name"] = name
+            self.client.post(BASE_URL, json=body)
+        response = self.client.get(f"{BASE_URL}/suggest", query_string={"prefix": "SUM"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([promo["name"] for promo in response.get_json()], ["Summer Sale", "summer shoes"])
+        response = self.client.get(f"{BASE_URL}/suggest", query_string={"prefix": "s", "limit": 1})
+        self.assertEqual(len(response.get_json()), 1)
+        # writes after the index was built are visible to the next lookup
+        body = PromoFactory().serialize()
+        body["name"] = "Summit"
+        promo_id = self.client.post(BASE_URL, json=body).get_json()["id"]
+        response = self.client.get(f"{BASE_URL}/suggest", query_string={"prefix": "summi"})
+        self.assertEqual(response.get_json(), [{"id": promo_id, "name": "Summit"}])
+        self.client.delete(f"{BASE_URL}/{promo_id}")
+        response = self.client.get(f"{BASE_URL}/suggest", query_string={"prefix": "summi"})
+        self.assertEqual(response.get_json(), [])
+        self.assertGreaterEqual(metrics.get("promotions_suggest_lookups_total", source="index"), 4)
+
+    def test_suggest_names_database_fallback(self):
+        """It should suggest from the database when the index is over budget"""
+        suggest.reset()
+        body = PromoFactory().serialize()
+        body["name"] = "100%_off"
+        self.client.post(BASE_URL, json=body)
+        with patch.dict(app.config, {"SUGGEST_INDEX_MAX_BYTES": 1}):
+            response = self.client.get(f"{BASE_URL}/suggest", query_string={"prefix": "100%_"})
+            self.assertEqual([promo["name"] for promo in response.get_json()], ["100%_off"])
+            response = self.client.get(f"{BASE_URL}/suggest", query_string={"prefix": "100_"})
+            self.assertEqual(response.get_json(), [])
+        suggest.reset()
+
+    def test_suggest_names_bad_args(self):
+        """It should reject a missing prefix or an out of range limit"""
+        response = self.client.get(f"{BASE_URL}/suggest")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/suggest", query_string={"prefix": "a", "limit": 500})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_promotions(self):
+        """It should rank Promotions by name similarity for a q= search"""
+        name_search.reset()
+        for name, promo_type in (("Summer Sale", "VIP"), ("summer shoes", "FREE_SHIPPING"),
+                                 ("Winter Clearance", "VIP")):
+            body = PromoFactory().serialize()
+            body["name"], body["type"] = name, promo_type
+            self.client.post(BASE_URL, json=body)
+        response = self.client.get(BASE_URL, query_string={"q": "summer sael"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.get_json()
+        self.assertEqual([promo["name"] for promo in results], ["Summer Sale", "summer shoes"])
+        self.assertAlmostEqual(results[0]["score"], 4 / 7)
+        self.assertEqual(response.headers["X-Total-Count"], "2")
+        response = self.client.get(BASE_URL, query_string={"q": "summer sael", "limit": 1, "fields": "name,score"})
+        self.assertEqual(response.get_json(), [{"name": "Summer Sale", "score": results[0]["score"]}])
+        # the count is of every match, not just of the page
+        self.assertEqual(response.headers["X-Total-Count"], "2")
+        response = self.client.head(BASE_URL, query_string={"q": "summer sael", "limit": 1})
+        self.assertEqual(response.headers["X-Total-Count"], "2")
+        response = self.client.head(BASE_URL, query_string={"q": "summer sael", "type": "VIP"})
+        self.assertEqual(response.headers["X-Total-Count"], "1")
+        # other filters narrow the search
+        response = self.client.get(BASE_URL, query_string={"q": "summer sael", "type": "FREE_SHIPPING"})
+        self.assertEqual([promo["name"] for promo in response.get_json()], ["summer shoes"])
+        response = self.client.head(BASE_URL, query_string={"q": "summer sael"})
+        self.assertEqual(response.headers["X-Total-Count"], "2")
+        # writes are searchable straight away
+        self.client.delete(f"{BASE_URL}/{results[0]['id']}")
+        response = self.client.get(BASE_URL, query_string={"q": "xyzzy"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(BASE_URL, query_string={"q": "sumer", "limit": 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string={"q": "summer sale"})
+        self.assertEqual([promo["name"] for promo in response.get_json()], ["summer shoes"])
+
+    def test_search_promotions_pg_trgm(self):
+        """It should let Postgres rank and count a q= search when it has pg_trgm"""
+        record = Promotion.find_record(self._create_promotion(1)[0].id)
+        threshold = app.config["SEARCH_SIMILARITY_THRESHOLD"]
+        with patch.object(Promotion, "has_trigram_search", return_value=True), \
+                patch.object(Promotion, "search_by_similarity", return_value=[(record, 0.5)]) as search, \
+                patch.object(Promotion, "count_by_similarity", return_value=3) as count:
+            response = self.client.get(BASE_URL, query_string={"q": "pg_trgm search", "limit": 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(promo["id"], promo["score"]) for promo in response.get_json()], [(record.id, 0.5)])
+        self.assertEqual(response.headers["X-Total-Count"], "3")
+        search.assert_called_once_with("pg_trgm search", 1, threshold, [], None)
+        count.assert_called_once_with("pg_trgm search", threshold, [])
+
+    def test_vip_promotions(self):
+        """It should list the VIP Promotions of a customer and track writes"""
+        vip_index.reset()
+        vip = PromoFactory(type=PromoType.VIP, customer=7)
+        vip.create()
+        other = PromoFactory(type=PromoType.FREE_SHIPPING, customer=8)
+        other.create()
+        response = self.client.get(f"{BASE_URL}/vip/7")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([promo["id"] for promo in response.get_json()], [vip.id])
+        # customers without VIP promotions are turned away by the Bloom filter
+        negatives = metrics.get("promotions_vip_lookups_total", outcome="negative")
+        with patch.object(Promotion, "find_records_by_ids") as find:
+            for customer in (8, 9, 10):
+                response = self.client.get(f"{BASE_URL}/vip/{customer}")
+                self.assertEqual(response.get_json(), [])
+        find.assert_not_called()
+        self.assertEqual(metrics.get("promotions_vip_lookups_total", outcome="negative"), negatives + 3)
+        # writes after the index was built are visible to the next lookup
+        response = self.client.put(f"{BASE_URL}/{other.id}", json=dict(other.serialize(), type="VIP"),
+                                   headers={"If-Match": f'"{other.version}"'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([promo["id"] for promo in self.client.get(f"{BASE_URL}/vip/8").get_json()], [other.id])
+        self.client.delete(f"{BASE_URL}/{vip.id}")
+        self.assertEqual(self.client.get(f"{BASE_URL}/vip/7").get_json(), [])
+        # the Bloom filter still has customer 7 until the next rebuild: a false positive
+        self.assertGreater(metrics.get("promotions_vip_bloom_false_positive_rate"), 0)
+
+    def test_vip_promotions_written_elsewhere(self):
+        """It should find the VIP Promotions other workers created or updated once the index syncs"""
+        vip_index.reset()
+        other = PromoFactory(type=PromoType.FREE_SHIPPING, customer=8)
+        other.create()
+        with patch.dict(app.config, {"VIP_INDEX_SYNC": 60}):
+            self.assertEqual(self.client.get(f"{BASE_URL}/vip/7").get_json(), [])
+            with patch("service.models.notify_write"):  # as if another worker wrote them
+                vip = PromoFactory(type=PromoType.VIP, customer=7)
+                vip.create()
+                Promotion.update_by_id(other.id, {"type": PromoType.VIP})  # an older id turned VIP
+            self.assertEqual(self.client.get(f"{BASE_URL}/vip/7").get_json(), [])
+            with patch.object(vip_index, "_checked_at", float("-inf")):  # the sync is due
+                response = self.client.get(f"{BASE_URL}/vip/7")
+            self.assertEqual([promo["id"] for promo in response.get_json()], [vip.id])
+            response = self.client.get(f"{BASE_URL}/vip/8")
+            self.assertEqual([promo["id"] for promo in response.get_json()], [other.id])
+
+    def test_create_promotion_group_commit(self):
+        """It should coalesce concurrent creates when group commit is on"""
+        committer = Promotion.group_committer()
+        batches = committer.batches
+        responses = []
+
+        def post(number):
+            body = PromoFactory().serialize()
+            body["name"] = f"grouped {number}"
+            response = app.test_client().post(BASE_URL, json=body)
+            responses.append((response.status_code, response.get_json()["id"]))
+
+        with patch.dict(app.config, {"GROUP_COMMIT": True}), \
+                patch.object(committer, "window", 0.2), patch.object(committer, "max_batch", 4):
+            threads = [threading.Thread(target=post, args=(number,)) for number in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual({code for code, _ in responses}, {status.HTTP_201_CREATED})
+        self.assertEqual(len({promo_id for _, promo_id in responses}), 4)
+        self.assertLess(committer.batches - batches, 4)
+        for _, promo_id in responses:
+            response = self.client.get(f"{BASE_URL}/{promo_id}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_promotions_cached(self):
+        """It should serve repeated listings from the result cache until a write"""
+        self._create_promotion(2)
+        hits = metrics.get("promotions_result_cache_requests_total", result="hit")
+        response = self.client.get(BASE_URL, query_string={"type": "VIP", "active_on": "2022-08-01"})
+        first = (response.status_code, response.get_json())
+        with patch.object(Promotion, "find_matching_any") as find:
+            # the same filters in another order
+            response = self.client.get(BASE_URL, query_string=[("active_on", "2022-08-01"), ("type", "VIP")])
+            find.assert_not_called()
+        self.assertEqual((response.status_code, response.get_json()), first)
+        self.assertEqual(metrics.get("promotions_result_cache_requests_total", result="hit"), hits + 1)
+        self.assertGreater(metrics.get("promotions_result_cache_hit_ratio"), 0)
+        # a write invalidates the cache
+        body = PromoFactory().serialize()
+        body.update(name="cached", type="VIP", start_date="2022-07-01", end_date="2022-08-31")
+        self.client.post(BASE_URL, json=body)
+        response = self.client.get(BASE_URL, query_string={"type": "VIP", "active_on": "2022-08-01"})
+        self.assertIn("cached", [promo["name"] for promo in response.get_json()])
+
+    def test_list_promotions_cached_other_worker_write(self):
+        """It should invalidate cached listings on a write made by another worker, once it reads the generation"""
+        self._create_promotion(1)
+        with patch.dict(app.config, {"RESULT_CACHE_GENERATION_TTL": 60}):
+            self.assertEqual(len(self.client.get(BASE_URL).get_json()), 1)
+            with patch("service.models.notify_write"):  # another worker's write: it only bumps the database
+                PromoFactory().create()
+            self.assertEqual(len(self.client.get(BASE_URL).get_json()), 1)
+        with patch.dict(app.config, {"RESULT_CACHE_GENERATION_TTL": 0}):
+            self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+
+    def test_read_promotion_shared_cache(self):
+        """It should serve single reads from the shared record cache and write through to it"""
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        config = {"SHARED_CACHE": True, "SHARED_CACHE_PATH": path, "SHARED_CACHE_SLOTS": 64}
+        with patch.dict(app.config, config), patch("service.models._shared_records", None):
+            promo = self._create_promotion(1)[0]
+            url = f"{BASE_URL}/{promo.id}"
+            first = self.client.get(url).get_json()
+            with patch.object(Promotion, "record_query") as query:
+                response = self.client.get(url)
+                query.assert_not_called()
+            self.assertEqual(response.get_json(), first)
+            self.assertEqual(response.headers["ETag"], '"1"')
+            self.client.patch(url, json={"name": "renamed"}, headers={"If-Match": '"1"'})
+            with patch.object(Promotion, "record_query") as query:
+                response = self.client.get(url, query_string={"fields": "name"})
+                query.assert_not_called()
+            self.assertEqual(response.get_json(), {"name": "renamed"})
+            self.client.delete(url)
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+            Promotion.shared_records().close()
+        os.remove(path)
+
+    def test_read_promotion_single_flight(self):
+        """It should make concurrent identical reads share one query"""
+        promo = self._create_promotion(1)[0]
+        queries = []
+
+        def slow(fetch):
+            def wrapper(*args, **kwargs):
+                queries.append(args)
+                threading.Event().wait(0.3)  # keep the fetch in flight while the others arrive
+                return fetch(*args, **kwargs)
+            return wrapper
+
+        responses = []
+
+        def get(url):
+            response = app.test_client().get(url)
+            responses.append((response.status_code, response.get_json()))
+
+        for url, query in ((f"{BASE_URL}/{promo.id}", "record_query"),
+                           (f"{BASE_URL}?name={promo.name}", "find_matching_any")):
+            queries.clear()
+            responses.clear()
+            with patch.object(Promotion, query, side_effect=slow(getattr(Promotion, query))):
+                threads = [threading.Thread(target=get, args=(url,)) for _ in range(6)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(len(queries), 1)
+            self.assertEqual(len(responses), 6)
+            self.assertEqual({code for code, _ in responses}, {status.HTTP_200_OK})
+            self.assertTrue(all(body == responses[0][1] for _, body in responses))
+
+    def test_read_promotion_stale_while_revalidate(self):
+        """It should serve the last good responses, marked stale, when the database fails"""
+        promo = self._create_promotion(1)[0]
+        url = f"{BASE_URL}/{promo.id}"
+        config = {"STALE_WHILE_REVALIDATE": True, "STALE_SOFT_TTL": 60, "STALE_REFRESH_TRIES": 1}
+        down = OperationalError("SELECT", {}, Exception("server closed the connection"))
+        with patch.dict(app.config, config), patch("service.utils.stale_cache._cache", None):
+            first = self.client.get(url)
+            self.assertEqual(first.headers.get("Age"), None)
+            listing = self.client.get(BASE_URL, query_string={"name": promo.name})
+            # fresh enough: served without the database
+            with patch.object(Promotion, "find_record") as find:
+                response = self.client.get(url)
+                find.assert_not_called()
+            self.assertEqual(response.get_json(), first.get_json())
+            self.assertEqual(response.headers["Age"], "0")
+            self.assertNotIn("Warning", response.headers)
+            # written over, then the database goes down: the last good responses are served
+            self.client.patch(url, json={"name": "renamed"}, headers={"If-Match": '"1"'})
+            with patch.object(Promotion, "find_record", side_effect=down), \
+                    patch.object(Promotion, "find_matching_any", side_effect=down):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.get_json(), first.get_json())
+                self.assertEqual(response.headers["Warning"], stale_cache.REVALIDATION_FAILED_WARNING)
+                self.assertIn("Age", response.headers)
+                response = self.client.get(BASE_URL, query_string={"name": promo.name})
+                self.assertEqual(response.get_json(), listing.get_json())
+                self.assertEqual(response.headers["Warning"], stale_cache.REVALIDATION_FAILED_WARNING)
+            # past the soft TTL: served stale while refreshed in the background
+            self.assertEqual(self.client.get(url).get_json()["name"], "renamed")
+            later = MagicMock(monotonic=lambda: time.monotonic() + 120)
+            with patch.object(stale_cache, "time", later):
+                response = self.client.get(url)
+            self.assertEqual(response.headers["Warning"], stale_cache.STALE_WARNING)
+            self.assertEqual(response.get_json()["name"], "renamed")
+            self._wait_for_refreshes()
+            db.session.execute(text("UPDATE promotion SET name = 'refreshed' WHERE id = :id"),
+                               {"id": promo.id})
+            db.session.commit()
+            with patch.object(stale_cache, "time", later):
+                response = self.client.get(url)
+            self.assertEqual(response.headers["Warning"], stale_cache.STALE_WARNING)
+            self._wait_for_refreshes()
+            response = self.client.get(url)
+            self.assertNotIn("Warning", response.headers)
+            self.assertEqual(response.get_json()["name"], "refreshed")
+
+    @staticmethod
+    def _wait_for_refreshes():
+        """Waits until the background refreshes of stale responses are done"""
+        while stale_cache.refreshing():
+            time.sleep(0.01)
+
+    def test_health_warm_up(self):
+        """It should report ready on /health only once warm-up has loaded the caches"""
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self._create_promotion(1)  # ended in 2022
+        body = PromoFactory().serialize()
+        today = datetime.date.today()
+        body.update(start_date=str(today), end_date=str(today + datetime.timedelta(days=7)))
+        promo_id = self.client.post(BASE_URL, json=body).get_json()["id"]
+        config = {"SHARED_CACHE": True, "SHARED_CACHE_PATH": path, "SHARED_CACHE_SLOTS": 64}
+        with patch.dict(app.config, config), patch("service.models._shared_records", None), \
+                patch.object(warm_up, "_ready", threading.Event()), patch.object(warm_up, "_seconds", None):
+            response = self.client.get("/health")
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            suggest.reset()
+            vip_index.reset()
+            warm_up.warm_up(app)
+            self.assertTrue(warm_up.is_ready())
+            self.assertIsNotNone(suggest._index)  # pylint: disable=protected-access
+            self.assertIsNotNone(vip_index._index)  # pylint: disable=protected-access
+            self.assertIsNotNone(Promotion.shared_records().get(promo_id, 60))
+            self.assertEqual(metrics.get("promotions_warm_up_records"), 1)
+            response = self.client.get("/health")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()["warm_up_seconds"], warm_up.seconds())
+            Promotion.close_shared_records()
+        os.remove(path)
+
+    def test_warm_up_without_record_cache(self):
+        """It should only build the indexes when there is no record cache to load"""
+        self._create_promotion(1)
+        with patch.object(warm_up, "_ready", threading.Event()), patch.object(warm_up, "_seconds", None), \
+                patch.object(Promotion, "find_matching_any") as find:
+            vip_index.reset()
+            warm_up.warm_up(app)
+            find.assert_not_called()
+            self.assertTrue(warm_up.is_ready())
+            self.assertIsNotNone(vip_index._index)  # pylint: disable=protected-access
+        self.assertEqual(metrics.get("promotions_warm_up_records"), 0)
+
+    def test_lookup_promotions(self):
+        """It should look up Promotions by ID in one query, in order, marking the missing ones"""
+        promos = self._create_promotion(3)
+        ids = [promos[2].id, 0, promos[0].id, promos[2].id]
+        record_query = Promotion.record_query
+        with patch.object(Promotion, "record_query", side_effect=record_query) as query:
+            response = self.client.post(f"{BASE_URL}/lookup", json={"ids": ids})
+            self.assertEqual(query.call_count, 1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.get_json()
+        self.assertEqual([result["id"] for result in results], ids)
+        self.assertEqual([result["found"] for result in results], [True, False, True, True])
+        self.assertIsNone(results[1]["promotion"])
+        self.assertEqual(results[0]["promotion"]["name"], promos[2].name)
+        self.assertEqual(results[2]["promotion"]["name"], promos[0].name)
+        self.assertEqual(results[0]["promotion"]["version"], 1)
+
+    def test_lookup_promotions_bad_request(self):
+        """It should reject lookups that are not a list of integers"""
+        for body in ({}, {"ids": []}, {"ids": "1,2"}, {"ids": [1, "2"]}, {"ids": [True]},
+                     {"ids": list(range(app.config["LOOKUP_MAX_IDS"] + 1))}, [1, 2]):
+            response = self.client.post(f"{BASE_URL}/lookup", json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+        self.assertEqual(routes.route_class(MagicMock(path=f"{BASE_URL}/lookup", method="POST",
+                                                      endpoint="promotion_lookup")), "reads")
+
+    def test_list_promotions_sorted_pages(self):
+        """It should sort listings and page through them with cursors"""
+        for number, discount in enumerate((30, None, 10, 30, 20)):
+            body = PromoFactory().serialize()
+            body.update(name=f"sorted {number}", discount=discount)
+            self.client.post(BASE_URL, json=body)
+        everything = self.client.get(BASE_URL).get_json()
+        self.assertEqual([promo["id"] for promo in everything], sorted(promo["id"] for promo in everything))
+        for sort, key in (("discount", lambda promo: (promo["discount"] is None, promo["discount"] or 0, promo["id"])),
+                          ("-name", lambda promo: (promo["name"], promo["id"])),
+                          ("-start_date", lambda promo: (promo["start_date"], promo["id"]))):
+            expected = sorted(everything, key=key, reverse=sort.startswith("-"))
+            response = self.client.get(BASE_URL, query_string={"sort": sort})
+            self.assertEqual(response.get_json(), expected)
+            names, url = [], f"{BASE_URL}?sort={sort}&limit=2&fields=name"
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertNotIn("X-Total-Count", response.headers)
+                names.extend(promo["name"] for promo in response.get_json())
+                url = response.headers.get("Link", "")[1:].partition(">")[0]
+            self.assertEqual(names, [promo["name"] for promo in expected])
+        cursor = routes.encode_cursor(Promotion.find_record(everything[0]["id"]), "name", False)
+        for args in ({"sort": "type"}, {"sort": "id", "cursor": cursor}, {"cursor": "not a cursor"},
+                     {"limit": "0"}, {"q": "sorted", "sort": "name"}):
+            response = self.client.get(BASE_URL, query_string=args)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, args)
+
+    def test_promotion_stats(self):
+        """It should count Promotions by type, status and discount, from a query or a summary"""
+        today = datetime.date.today()
+        for promo_type, discount, start, end in (
+                ("VIP", None, today, today + datetime.timedelta(days=7)),
+                ("PERCENT_DISCOUNT", 25, today - datetime.timedelta(days=9), today - datetime.timedelta(days=2)),
+                ("PERCENT_DISCOUNT", 20, today + datetime.timedelta(days=1), today + datetime.timedelta(days=9))):
+            body = PromoFactory().serialize()
+            body.update(name=f"stats {promo_type} {discount}", type=promo_type, discount=discount,
+                        start_date=str(start), end_date=str(end))
+            self.client.post(BASE_URL, json=body)
+        expected = {
+            "as_of": str(today), "total": 3,
+            "by_type": {"BUY_ONE_GET_ONE": 0, "PERCENT_DISCOUNT": 2, "FREE_SHIPPING": 0, "VIP": 1, "UNKNOWN": 0},
+            "by_status": {"active": 1, "upcoming": 1, "expired": 1, "cancelled": 0},
+            "by_discount": [{"min": 20, "max": 29, "count": 2}],
+            "no_discount": 1,
+        }
+        response = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), expected)
+        with patch.dict(app.config, {"STATS_SUMMARY": True}):
+            stats.reset()
+            self.assertEqual(self.client.get(f"{BASE_URL}/stats").get_json(), expected)
+            # writes keep the summary current without queries
+            promo = self._create_promotion(1)[0]
+            self.client.put(f"{BASE_URL}/{promo.id}/cancel", headers={"If-Match": "*"})
+            with patch.object(Promotion, "statistics") as query, patch.object(Promotion, "all_records") as load:
+                summarized = self.client.get(f"{BASE_URL}/stats").get_json()
+                query.assert_not_called()
+                load.assert_not_called()
+            self.assertEqual(summarized["by_status"]["cancelled"], 1)
+            self.assertEqual(summarized["total"], 4)
+            self.client.delete(f"{BASE_URL}/{promo.id}")
+            self.assertEqual(self.client.get(f"{BASE_URL}/stats").get_json(), expected)
+        self.assertEqual(self.client.get(f"{BASE_URL}/stats").get_json(), expected)
+
+    def test_promotion_stats_write_during_rebuild(self):
+        """It should count a write committed while the summary was being rebuilt"""
+        self._create_promotion(2)
+        all_records = Promotion.all_records
+
+        def load_then_write(fields):
+            records = all_records(fields)
+            PromoFactory(name="written during the rebuild").create()
+            return records
+
+        with patch.dict(app.config, {"STATS_SUMMARY": True}):
+            stats.reset()
+            with patch.object(Promotion, "all_records", side_effect=load_then_write):
+                self.assertEqual(self.client.get(f"{BASE_URL}/stats").get_json()["total"], 3)
+            self.assertEqual(self.client.get(f"{BASE_URL}/stats").get_json()["total"], 3)
+
+    def _wait_for_job(self, url):
+        """Polls a job until it has finished"""
+        for _ in range(200):
+            job = self.client.get(url).get_json()
+            if job["state"] in ("succeeded", "failed"):
+                return job
+            time.sleep(0.05)
+        self.fail(f"{url} did not finish")
+
+    def test_jobs(self):
+        """It should run bulk imports, cancels and exports as jobs and report their progress"""
+        bodies = []
+        for number in range(3):
+            body = PromoFactory().serialize()
+            body["name"] = f"imported {number}"
+            bodies.append(body)
+        bodies.insert(1, {"name": "no dates", "type": "VIP"})
+        response = self.client.post("/api/jobs", json={"kind": "import", "promotions": bodies})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.get_json()["total"], 4)
+        job = self._wait_for_job(response.headers["Location"])
+        self.assertEqual(job["state"], "succeeded")
+        self.assertEqual(job["done"], 4)
+        created = job["result"]["created"]
+        self.assertEqual(len(created), 3)
+        self.assertEqual([rejected["index"] for rejected in job["result"]["rejected"]], [1])
+        self.assertEqual(self.client.get(f"{BASE_URL}/{created[0]}").get_json()["name"], "imported 0")
+
+        response = self.client.post("/api/jobs", json={"kind": "cancel", "ids": [created[2], 0]})
+        job = self._wait_for_job(response.headers["Location"])
+        self.assertEqual(job["result"], {"cancelled": [created[2]], "not_found": [0]})
+        promo = self.client.get(f"{BASE_URL}/{created[2]}").get_json()
+        self.assertEqual(promo["end_date"], promo["start_date"])
+
+        with patch.dict(app.config, {"JOB_BATCH_SIZE": 2}):
+            response = self.client.post("/api/jobs", json={"kind": "export"})
+            job = self._wait_for_job(response.headers["Location"])
+        self.assertEqual(job["total"], 3)
+        self.assertEqual(job["result"], {"pages": 2, "exported": 3})
+        url, exported = f"/api/jobs/{job['id']}/result", []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            exported.extend(promo["id"] for promo in response.get_json())
+            url = response.headers.get("Link", "").partition(">")[0].lstrip("<")
+        self.assertEqual(exported, sorted(created))
+        self.assertEqual(self.client.get(f"/api/jobs/{job['id']}/result?cursor=2").status_code,
+                         status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(f"/api/jobs/{job['id']}/result?cursor=-1").status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        response = self.client.get("/api/jobs/0/result")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(f"/api/jobs/{job['id'] - 1}/result")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        # pruning a job removes its pages
+        Job.prune(-1)
+        self.assertIsNone(Job.page(job["id"], 0))
+
+    def test_jobs_import_bad_values(self):
+        """It should reject the promotions the database would refuse without failing the import"""
+        good, bad, long_name = PromoFactory().serialize(), PromoFactory().serialize(), PromoFactory().serialize()
+        bad["discount"] = "ten"
+        long_name["name"] = "x" * 64
+        with patch.dict(app.config, {"JOB_BATCH_SIZE": 1}):
+            response = self.client.post("/api/jobs", json={"kind": "import", "promotions": [good, bad, long_name]})
+            job = self._wait_for_job(response.headers["Location"])
+        self.assertEqual(job["state"], "succeeded")
+        self.assertEqual(len(job["result"]["created"]), 1)
+        self.assertEqual([rejected["index"] for rejected in job["result"]["rejected"]], [1, 2])
+
+    def test_jobs_import_duplicates(self):
+        """It should reject the duplicate promotions that the create endpoint would refuse"""
+        existing = PromoFactory()
+        existing.create()
+        duplicate, first = PromoFactory().serialize(), PromoFactory(name="imported").serialize()
+        duplicate.update(name=existing.name, type=existing.type.name)
+        first["customer"] = ""
+        with patch.dict(app.config, {"JOB_BATCH_SIZE": 2}):
+            response = self.client.post("/api/jobs", json={"kind": "import",
+                                                           "promotions": [duplicate, first, dict(first)]})
+            job = self._wait_for_job(response.headers["Location"])
+        self.assertEqual(job["state"], "succeeded")
+        self.assertEqual([rejected["index"] for rejected in job["result"]["rejected"]], [0, 2])
+        self.assertEqual(len(job["result"]["created"]), 1)
+        promo = self.client.get(f"{BASE_URL}/{job['result']['created'][0]}").get_json()
+        self.assertIsNone(promo["customer"])
+        self.assertEqual(self.client.post(BASE_URL, json=duplicate).status_code, status.HTTP_409_CONFLICT)
+
+    def test_jobs_failed_import_keeps_created(self):
+        """It should report the promotions a failed import created before it failed"""
+        bodies = [PromoFactory(name=f"imported {number}").serialize() for number in range(2)]
+        create_many = Promotion.create_many
+        calls = []
+
+        def fail_second(promotions):
+            calls.append(promotions)
+            if len(calls) > 1:
+                raise RuntimeError("database went away")
+            return create_many(promotions)
+
+        with patch.dict(app.config, {"JOB_BATCH_SIZE": 1}), \
+                patch.object(Promotion, "create_many", side_effect=fail_second), \
+                self.assertLogs(app.logger, "ERROR"):
+            response = self.client.post("/api/jobs", json={"kind": "import", "promotions": bodies})
+            job = self._wait_for_job(response.headers["Location"])
+        self.assertEqual(job["state"], "failed")
+        self.assertEqual(job["error"], "database went away")
+        self.assertEqual(len(job["result"]["created"]), 1)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{job['result']['created'][0]}").status_code,
+                         status.HTTP_200_OK)
+
+    def test_jobs_abandoned(self):
+        """It should fail a dead worker's jobs but not those queued in a live one, and skip failed jobs"""
+        runner = jobs.JobRunner(app, 1, 1)
+        waiting, dead = Job.submit("cancel", 1).id, Job.submit("cancel", 1).id
+        runner._queued.add(waiting)  # pylint: disable=protected-access
+        table = Job.__table__
+        db.session.execute(table.update().where(table.c.id.in_([waiting, dead]))
+                           .values(updated_at=datetime.datetime(2022, 1, 1)))
+        db.session.commit()
+        running = Job.submit("cancel", 1).id
+        jobs.JobProgress(running, runner._heartbeat).advance(1)  # pylint: disable=protected-access
+        Job.fail_abandoned(60)
+        self.assertEqual(Job.find(waiting).state, "queued")
+        self.assertEqual(Job.find(dead).state, "failed")
+
+        runner.pending = 1
+        with self.assertLogs(app.logger, "WARNING") as logs:
+            runner._run(dead, "cancel", [0])  # pylint: disable=protected-access
+        self.assertIn("no longer queued", logs.output[0])
+        self.assertEqual(Job.find(dead).error, "Abandoned by its worker")
+        self.assertEqual(runner.pending, 0)
+        for job_id in (waiting, running):  # leave no queued job for later runs to abandon
+            Job.mark(job_id, state="failed")
+
+    def test_jobs_bad_request(self):
+        """It should refuse invalid jobs, jobs beyond the queue, and report unknown jobs"""
+        for body in ({}, {"kind": "delete"}, {"kind": "import"}, {"kind": "cancel", "ids": ["1"]},
+                     {"kind": "import", "promotions": []}):
+            response = self.client.post("/api/jobs", json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+        self.assertEqual(self.client.get("/api/jobs/0").status_code, status.HTTP_404_NOT_FOUND)
+        runner = jobs.get_runner()
+        with patch.object(runner, "pending", runner.capacity):
+            response = self.client.post("/api/jobs", json={"kind": "export"})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_memory_profile(self):
+        """It should report the peak memory of each request, and requests over budget, when profiling"""
+        self._create_promotion(20)
+        endpoint = "promotion_collection"
+        self.client.get(BASE_URL)
+        self.assertEqual(metrics.get("promotions_request_peak_bytes", endpoint=endpoint), 0)
+        with patch.dict(app.config, {"MEMORY_PROFILE": True, "MEMORY_PROFILE_BUDGET": 0}):
+            self.client.get(BASE_URL)
+            self.assertGreater(metrics.get("promotions_request_peak_bytes", endpoint=endpoint), 0)
+            self.assertEqual(metrics.get("promotions_request_over_budget_total", endpoint=endpoint), 0)
+            with patch.dict(app.config, {"MEMORY_PROFILE_BUDGET": 1024}), \
+                    self.assertLogs(app.logger, "WARNING") as logs:
+                self.client.get(BASE_URL)
+            self.assertIn("over the 1 KiB budget", logs.output[0])
+            self.assertEqual(metrics.get("promotions_request_over_budget_total", endpoint=endpoint), 1)
+        tracemalloc.stop()
+        metrics.set_gauge("promotions_request_peak_bytes", 0, endpoint=endpoint)
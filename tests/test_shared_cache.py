@@ -0,0 +1,70 @@
+"""
+Test cases for the Shared Record Cache
+"""
+import multiprocessing
+import os
+import tempfile
+from datetime import date
+from unittest import TestCase
+from service.utils.shared_cache import SharedRecordCache
+
+RECORD = (7, "Summer Sale", 3, None, 42, date(2022, 7, 1), date(2022, 7, 31), 2)
+
+
+def rewrite(path, count):
+    """Rewrites record 1 count times from another process"""
+    cache = SharedRecordCache(path, slots=8)
+    for version in range(1, count + 1):
+        cache.put((1, f"version {version}", 0, version, None, date(2022, 7, 1), date(2022, 7, 31), version))
+    cache.close()
+
+
+class TestSharedRecordCache(TestCase):
+    """Test the memory-mapped record cache"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.cache = SharedRecordCache(self.path, slots=8)
+
+    def tearDown(self):
+        self.cache.close()
+        os.remove(self.path)
+
+    def test_put_and_get(self):
+        """It should round trip a record through its fixed-width slot"""
+        self.assertTrue(self.cache.put(RECORD))
+        self.assertEqual(self.cache.get(7, max_age=60), RECORD)
+        self.assertIsNone(self.cache.get(15, max_age=60))  # same slot, another id
+        self.assertIsNone(self.cache.get(7, max_age=-1))
+        self.assertFalse(self.cache.put((8, "x" * 65, 0, None, None, None, None, 1)))
+        self.cache.remove(7)
+        self.assertIsNone(self.cache.get(7, max_age=60))
+
+    def test_generation_and_versions(self):
+        """It should refuse reads from before a write and older versions"""
+        generation = self.cache.generation()
+        self.cache.bump()
+        self.assertFalse(self.cache.put(RECORD, generation))
+        self.assertTrue(self.cache.put(RECORD, self.cache.generation()))
+        self.assertFalse(self.cache.put(RECORD[:-1] + (1,)))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(7, max_age=60))
+        self.assertEqual(self.cache.generation(), generation + 2)
+
+    def test_shared_between_processes(self):
+        """It should show the writes of other processes and never a torn record"""
+        writer = multiprocessing.get_context("fork").Process(target=rewrite, args=(self.path, 2000))
+        writer.start()
+        while writer.is_alive():
+            record = self.cache.get(1, max_age=60)
+            if record is not None:
+                # every field of a read comes from the same write
+                self.assertEqual(record[1], f"version {record[7]}")
+                self.assertEqual(record[3], record[7])
+        writer.join()
+        self.assertEqual(self.cache.get(1, max_age=60)[7], 2000)
+        # a second mapping of the same file sees the same records
+        other = SharedRecordCache(self.path, slots=8)
+        self.assertEqual(other.get(1, max_age=60)[1], "version 2000")
+        other.close()
@@ -0,0 +1,87 @@
+"""
+Single Flight Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+import threading
+from unittest import TestCase
+from service.utils.single_flight import SingleFlight, SingleFlightTimeout
+
+
+######################################################################
+#  S I N G L E   F L I G H T   T E S T   C A S E S
+######################################################################
+class TestSingleFlight(TestCase):
+    """ Tests for coalescing concurrent calls """
+
+    def setUp(self):
+        self.flights = SingleFlight("test")
+        self.release = threading.Event()
+        self.calls = 0
+
+    def fetch(self, result=None, error=None):
+        """ A fetch that blocks until released """
+        def run():
+            self.calls += 1
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+        return run
+
+    def run_concurrently(self, key, fetch, count, timeout=5):
+        """ Calls do() from count threads, releasing the fetch once they are all waiting """
+        outcomes = []
+
+        def call():
+            try:
+                outcomes.append(("result", self.flights.do(key, fetch, timeout)))
+            except Exception as error:  # pylint: disable=broad-except
+                outcomes.append(("error", error))
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        threading.Event().wait(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_shares_one_call(self):
+        """It should run one fetch for concurrent calls with the same key"""
+        outcomes = self.run_concurrently("key", self.fetch(result=[1, 2]), 8)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(outcomes, [("result", [1, 2])] * 8)
+
+    def test_propagates_errors(self):
+        """It should raise the error of the fetch in every waiting caller"""
+        outcomes = self.run_concurrently("key", self.fetch(error=ValueError("boom")), 4)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(outcomes), 4)
+        for kind, error in outcomes:
+            self.assertEqual(kind, "error")
+            self.assertIsInstance(error, ValueError)
+
+    def test_keys_are_independent(self):
+        """It should not share calls between different keys"""
+        self.release.set()
+        self.assertEqual(self.flights.do("a", self.fetch(result="a"), 1), "a")
+        self.assertEqual(self.flights.do("b", self.fetch(result="b"), 1), "b")
+        self.assertEqual(self.calls, 2)
+
+    def test_calls_after_completion(self):
+        """It should start a new fetch once the previous one finished"""
+        self.release.set()
+        self.flights.do("key", self.fetch(result=1), 1)
+        self.flights.do("key", self.fetch(result=1), 1)
+        self.assertEqual(self.calls, 2)
+
+    def test_follower_timeout(self):
+        """It should time out a caller whose fetch takes too long"""
+        outcomes = self.run_concurrently("key", self.fetch(result=1), 2, timeout=0.01)
+        self.assertIn(("result", 1), outcomes)
+        errors = [error for kind, error in outcomes if kind == "error"]
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], SingleFlightTimeout)
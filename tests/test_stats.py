@@ -0,0 +1,48 @@
+"""
+Test cases for the Promotion statistics summary
+"""
+from datetime import date
+from unittest import TestCase
+from service.models import PromoType
+from service.utils.stats import StatsSummary, discount_bucket, status_on, summarize
+
+TODAY = date(2022, 7, 15)
+
+
+class TestStatsSummary(TestCase):
+    """Test the incrementally maintained statistics"""
+
+    def test_discount_bucket(self):
+        """It should round discounts down to a multiple of 10"""
+        self.assertEqual([discount_bucket(discount) for discount in (0, 9, 10, 25, 100)], [0, 0, 10, 20, 100])
+        self.assertIsNone(discount_bucket(None))
+
+    def test_status_on(self):
+        """It should tell active, upcoming, expired and cancelled Promotions apart"""
+        self.assertEqual(status_on(date(2022, 7, 1), date(2022, 7, 31), TODAY), "active")
+        self.assertEqual(status_on(date(2022, 7, 15), date(2022, 7, 15), TODAY), "cancelled")
+        self.assertEqual(status_on(date(2022, 6, 1), date(2022, 6, 30), TODAY), "expired")
+        self.assertEqual(status_on(date(2022, 8, 1), date(2022, 8, 31), TODAY), "upcoming")
+
+    def test_add_replace_remove(self):
+        """It should keep its counts current as Promotions are added, changed and removed"""
+        summary = StatsSummary(TODAY)
+        summary.add(1, PromoType.VIP.value, None, date(2022, 7, 1), date(2022, 7, 31))
+        summary.add(2, PromoType.PERCENT_DISCOUNT, 15, date(2022, 8, 1), date(2022, 8, 31))
+        summary.add(3, PromoType.PERCENT_DISCOUNT.value, 12, date(2022, 6, 1), date(2022, 6, 30))
+        stats = summarize(summary.groups(), TODAY)
+        self.assertEqual(stats["total"], 3)
+        self.assertEqual(stats["by_type"]["PERCENT_DISCOUNT"], 2)
+        self.assertEqual(stats["by_type"]["BUY_ONE_GET_ONE"], 0)
+        self.assertEqual(stats["by_status"], {"active": 1, "upcoming": 1, "expired": 1, "cancelled": 0})
+        self.assertEqual(stats["by_discount"], [{"min": 10, "max": 19, "count": 2}])
+        self.assertEqual(stats["no_discount"], 1)
+        # cancel 2 and delete 3
+        summary.add(2, PromoType.PERCENT_DISCOUNT.value, 15, date(2022, 8, 1), date(2022, 8, 1))
+        summary.remove(3)
+        summary.remove(4)
+        stats = summarize(summary.groups(), TODAY)
+        self.assertEqual(len(summary), 2)
+        self.assertEqual(stats["total"], 2)
+        self.assertEqual(stats["by_status"], {"active": 1, "upcoming": 0, "expired": 0, "cancelled": 1})
+        self.assertEqual(stats["by_discount"], [{"min": 10, "max": 19, "count": 1}])
@@ -0,0 +1,44 @@
+"""
+Test cases for the Trigram Index
+"""
+from unittest import TestCase
+from service.utils.trigram_index import TrigramIndex, similarity, trigrams
+
+
+class TestTrigramIndex(TestCase):
+    """Test the n-gram inverted index"""
+
+    def setUp(self):
+        self.index = TrigramIndex()
+        self.index.build([(1, "Summer Sale"), (2, "Winter Clearance"), (3, "summer shoes"), (4, None)])
+
+    def test_trigrams(self):
+        """It should split text into pg_trgm style trigrams"""
+        self.assertEqual(trigrams("Cat"), {"  c", " ca", "cat", "at "})
+        self.assertEqual(trigrams("a-b"), {"  a", " a ", "  b", " b "})
+        self.assertEqual(trigrams("!!"), frozenset())
+        self.assertEqual(similarity("word", "word"), 1.0)
+        self.assertEqual(similarity("word", "!!"), 0.0)
+        # the pg_trgm documentation example: similarity('word', 'two words') = 4/11
+        self.assertAlmostEqual(similarity("word", "two words"), 4 / 11)
+
+    def test_search_ranks_misspellings(self):
+        """It should rank names by similarity to a misspelled query"""
+        results = self.index.search("sumer sael", threshold=0.2)
+        self.assertEqual([promo_id for promo_id, _ in results], [1, 3])
+        self.assertGreater(results[0][1], results[1][1])
+        self.assertAlmostEqual(results[0][1], similarity("sumer sael", "Summer Sale"))
+        self.assertEqual(self.index.search("sumer sael", threshold=0.2, limit=1), results[:1])
+        self.assertEqual(self.index.search("winter", threshold=0.9), [])
+        self.assertEqual(self.index.search("", threshold=0.1), [])
+
+    def test_add_and_remove(self):
+        """It should add, rename and remove names"""
+        self.index.add(5, "Summer Sale")
+        self.index.add(1, "Spring Sale")
+        results = self.index.search("summer sale", threshold=0.9)
+        self.assertEqual(results, [(5, 1.0)])
+        self.index.remove(5)
+        self.index.remove(42)
+        self.assertEqual(self.index.search("summer sale", threshold=0.9), [])
+        self.assertEqual(len(self.index), 3)